@@ -0,0 +1,337 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+# Admission control in front of the model (magma_gradio.generate_response and
+# its streaming twin). Gradio's queue serves requests first come, first
+# served, so an interactive user could wait behind a whole batch sweep and
+# requests whose client had already given up still got a prefill. Here every
+# request takes one of `slots` places at the model; while they are all taken,
+# requests wait by priority class:
+#   - "interactive" (the GUIs, the web UI) always goes before "batch"
+#     (pipeline.py sweeps, benchmarks), and `reserved` slots are kept for
+#     interactive requests, so one never waits for a batch request to finish
+#   - a request whose deadline (model_client.py's X-Deadline-Ms) passes while
+#     it waits is dropped before it reaches the processor or the scheduler
+#   - once a class has its budget of requests waiting, further ones are shed
+#     at once with OVERLOADED, which model_client.py retries on another
+#     endpoint or after a backoff
+# The class comes in the X-Priority header; requests without one are interactive.
+#
+#   python admission.py     # deterministic checks of shedding, expiry and slot order
+
+PRIORITIES = ("interactive", "batch")
+DEFAULT_PRIORITY = os.environ.get("MAGMA_DEFAULT_PRIORITY", "interactive")
+# Most requests of a class waiting for a slot before more are shed
+QUEUE_BUDGETS = {
+    "interactive": int(os.environ.get("MAGMA_QUEUE_BUDGET_INTERACTIVE", "16")),
+    "batch": int(os.environ.get("MAGMA_QUEUE_BUDGET_BATCH", "64")),
+}
+# Slots batch requests may not take
+RESERVED_SLOTS = int(os.environ.get("MAGMA_INTERACTIVE_SLOTS", "1"))
+# Deadline for requests that do not send X-Deadline-Ms (0 = none)
+DEFAULT_DEADLINE_MS = float(os.environ.get("MAGMA_DEFAULT_DEADLINE_MS", "0"))
+
+# Error messages the clients recognise (model_client.py)
+OVERLOADED = "server overloaded"
+DEADLINE_EXCEEDED = "deadline exceeded before start"
+
+
+class Rejected(Exception):
+    """A request that was not let through to the model"""
+
+
+class Overloaded(Rejected):
+    pass
+
+
+class Expired(Rejected):
+    pass
+
+
+def request_priority(headers):
+    """Priority class named in the X-Priority header (DEFAULT_PRIORITY if missing or unknown)"""
+    value = (headers.get("X-Priority") or "").strip().lower()
+    return value if value in PRIORITIES else DEFAULT_PRIORITY
+
+
+def request_deadline(headers, now=None):
+    """time.monotonic() instant the client stops waiting (X-Deadline-Ms from now), or None"""
+    value = headers.get("X-Deadline-Ms")
+    try:
+        milliseconds = DEFAULT_DEADLINE_MS if value is None else float(value)
+    except ValueError:
+        return None
+    if value is None and milliseconds <= 0:
+        return None
+    return (time.monotonic() if now is None else now) + milliseconds / 1000
+
+
+class Ticket:
+    """One request's claim on a slot: waiting, then running until released"""
+
+    def __init__(self, priority, deadline):
+        self.priority = priority
+        self.deadline = deadline
+        self.arrived = time.monotonic()
+        self.granted = False
+        self.abandoned = False
+        self.released = False
+
+
+class AdmissionControl:
+    """Priority classes, deadlines and load shedding over `slots` places at the model
+
+    acquire() blocks until the request may run and returns its Ticket, to be
+    release()d when the answer is done; admitted() does both around a block.
+    """
+
+    def __init__(self, slots, budgets=None, reserved=None):
+        self.slots = max(1, slots)
+        self.reserved = max(0, min(RESERVED_SLOTS if reserved is None else reserved, self.slots - 1))
+        self.budgets = dict(QUEUE_BUDGETS, **(budgets or {}))
+        self.condition = threading.Condition()
+        self.waiting = []  # heap of (class rank, arrival order, Ticket)
+        self.order = itertools.count()
+        self.queued = dict.fromkeys(PRIORITIES, 0)
+        self.running = dict.fromkeys(PRIORITIES, 0)
+        self.counters = {priority: {"admitted": 0, "shed": 0, "expired": 0} for priority in PRIORITIES}
+
+    def capacity(self):
+        """Requests that can be running or waiting at once (the front end's concurrency)"""
+        return self.slots + sum(self.budgets.values())
+
+    def _free(self, priority):
+        limit = self.slots if priority == "interactive" else self.slots - self.reserved
+        return sum(self.running.values()) < limit
+
+    def _grant(self):
+        # Free slots go to the head of the queue, in order. A batch head that
+        # finds only reserved slots free has no interactive request behind it.
+        granted = False
+        while self.waiting:
+            ticket = self.waiting[0][2]
+            if ticket.abandoned:
+                heapq.heappop(self.waiting)
+                continue
+            if not self._free(ticket.priority):
+                break
+            heapq.heappop(self.waiting)
+            self.queued[ticket.priority] -= 1
+            self.running[ticket.priority] += 1
+            ticket.granted = granted = True
+        if granted:
+            self.condition.notify_all()
+
+    def acquire(self, priority=DEFAULT_PRIORITY, deadline=None):
+        """Wait for a slot; raises Overloaded if the class's queue is full, Expired once deadline passes"""
+        if priority not in PRIORITIES:
+            raise ValueError(f"unknown priority {priority!r}")
+        ticket = Ticket(priority, deadline)
+        counters = self.counters[priority]
+        with self.condition:
+            if deadline is not None and ticket.arrived >= deadline:
+                counters["expired"] += 1
+                raise Expired(DEADLINE_EXCEEDED)
+            heapq.heappush(self.waiting, (PRIORITIES.index(priority), next(self.order), ticket))
+            self.queued[priority] += 1
+            self._grant()
+            try:
+                if not ticket.granted and self.queued[priority] > self.budgets[priority]:
+                    counters["shed"] += 1
+                    raise Overloaded(f"{OVERLOADED}: {self.queued[priority] - 1} {priority} requests already waiting")
+                while not ticket.granted:
+                    timeout = None if deadline is None else deadline - time.monotonic()
+                    if timeout is not None and timeout <= 0:
+                        counters["expired"] += 1
+                        raise Expired(DEADLINE_EXCEEDED)
+                    self.condition.wait(timeout)
+            finally:
+                if not ticket.granted:
+                    # Left in the heap and skipped by _grant
+                    ticket.abandoned = True
+                    self.queued[priority] -= 1
+            counters["admitted"] += 1
+        metrics.ADMISSION_SECONDS.observe(time.monotonic() - ticket.arrived, priority=priority)
+        return ticket
+
+    def release(self, ticket):
+        with self.condition:
+            if ticket.released:
+                return
+            ticket.released = True
+            self.running[ticket.priority] -= 1
+            self._grant()
+
+    @contextmanager
+    def admitted(self, priority=DEFAULT_PRIORITY, deadline=None):
+        """Hold a slot for the block (may stay open across a generator's yields)"""
+        ticket = self.acquire(priority, deadline)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self):
+        with self.condition:
+            stats = {"slots": self.slots, "reserved": self.reserved}
+            for priority in PRIORITIES:
+                stats[priority] = dict(self.counters[priority], waiting=self.queued[priority],
+                                       running=self.running[priority], budget=self.budgets[priority])
+        return stats
+
+
+
+def _wait_for(control, predicate, timeout=5.0):
+    """Poll predicate() under the control's lock until it holds (False after timeout)"""
+    give_up = time.monotonic() + timeout
+    while time.monotonic() < give_up:
+        with control.condition:
+            if predicate():
+                return True
+        time.sleep(0.001)
+    return False
+
+
+_names = itertools.count()
+
+
+def _acquire_in_thread(control, priority, order, deadline=None):
+    """Start acquire() in a thread; its ticket or error lands in the returned dict"""
+    result = {}
+
+    def run():
+        try:
+            result["ticket"] = control.acquire(priority, deadline)
+            order.append(result["name"])
+        except Rejected as e:
+            result["error"] = e
+
+    result["name"] = f"{priority}-{next(_names)}"
+    result["thread"] = threading.Thread(target=run, daemon=True)
+    result["thread"].start()
+    return result
+
+
+def check_shedding():
+    """A request over its class's queue budget is shed at once; the waiting one still runs"""
+    failures = []
+    control = AdmissionControl(1, budgets={"interactive": 1, "batch": 1}, reserved=0)
+    running = control.acquire("interactive")
+    order = []
+    waiter = _acquire_in_thread(control, "interactive", order)
+    _wait_for(control, lambda: control.queued["interactive"] == 1)
+    try:
+        control.acquire("interactive", deadline=time.monotonic() + 0.5)
+        failures.append("a request over the interactive budget was not shed")
+    except Overloaded as e:
+        if OVERLOADED not in str(e):
+            failures.append(f"shed with {e!r}, which clients do not recognise")
+    except Expired:
+        failures.append("a request over the interactive budget waited instead of being shed")
+    # The batch class has its own budget
+    batch = _acquire_in_thread(control, "batch", order)
+    _wait_for(control, lambda: control.queued["batch"] == 1)
+    control.release(running)
+    waiter["thread"].join(5)
+    if "ticket" not in waiter:
+        failures.append(f"the waiting request did not get the freed slot: {waiter.get('error')!r}")
+    else:
+        control.release(waiter["ticket"])
+    batch["thread"].join(5)
+    if "ticket" not in batch:
+        failures.append(f"the batch request was not admitted: {batch.get('error')!r}")
+    else:
+        control.release(batch["ticket"])
+    stats = control.stats()
+    if stats["interactive"]["shed"] != 1 or stats["batch"]["shed"] != 0:
+        failures.append(f"shed counters {stats['interactive']['shed']}/{stats['batch']['shed']}, expected 1/0")
+    if stats["interactive"]["waiting"] or stats["interactive"]["running"] or stats["batch"]["running"]:
+        failures.append(f"slots or queue left taken: {stats}")
+    return failures
+
+
+def check_expiry():
+    """Requests past their deadline never take a slot, before or while waiting"""
+    failures = []
+    control = AdmissionControl(1, reserved=0)
+    try:
+        control.acquire("interactive", deadline=time.monotonic() - 1)
+        failures.append("a request already past its deadline was admitted")
+    except Expired:
+        pass
+    running = control.acquire("batch")
+    order = []
+    waiter = _acquire_in_thread(control, "interactive", order, deadline=time.monotonic() + 0.05)
+    waiter["thread"].join(5)
+    if not isinstance(waiter.get("error"), Expired):
+        failures.append(f"a request whose deadline passed while waiting got {waiter!r}")
+    # The expired ticket stays in the heap; the freed slot must skip it
+    control.release(running)
+    try:
+        ticket = control.acquire("batch", deadline=time.monotonic() + 1)
+        control.release(ticket)
+    except Rejected as e:
+        failures.append(f"the slot freed after an expiry was not granted: {e!r}")
+    stats = control.stats()
+    if stats["interactive"]["expired"] != 2 or stats["interactive"]["admitted"] != 0:
+        failures.append(f"interactive counters {stats['interactive']}, expected 2 expired and none admitted")
+    if control.waiting and not all(ticket.abandoned for _, _, ticket in control.waiting):
+        failures.append("a live ticket was left in the queue")
+    return failures
+
+
+def check_reserved_slots():
+    """Interactive requests go first and batch requests never take the reserved slot"""
+    failures = []
+    control = AdmissionControl(2, reserved=1)
+    batch = control.acquire("batch")
+    order = []
+    second_batch = _acquire_in_thread(control, "batch", order)
+    _wait_for(control, lambda: control.queued["batch"] == 1)
+    if "ticket" in second_batch:
+        failures.append("a second batch request took the reserved slot")
+    try:
+        interactive = control.acquire("interactive", deadline=time.monotonic() + 1)
+    except Rejected as e:
+        failures.append(f"an interactive request did not get the reserved slot: {e!r}")
+        return failures
+
+    # Both slots taken; an interactive request arriving after the batch one goes first
+    late = _acquire_in_thread(control, "interactive", order)
+    _wait_for(control, lambda: control.queued["interactive"] == 1)
+    control.release(batch)
+    late["thread"].join(5)
+    if order != [late["name"]]:
+        failures.append(f"admitted {order} after a batch slot freed, expected only {late['name']}")
+    # One interactive request running: the free slot is the reserved one
+    control.release(interactive)
+    time.sleep(0.05)
+    if order != [late["name"]]:
+        failures.append(f"a batch request took the reserved slot: {order}")
+    if "ticket" in late:
+        control.release(late["ticket"])
+    second_batch["thread"].join(5)
+    if order != [late["name"], second_batch["name"]]:
+        failures.append(f"admission order {order}, expected {[late['name'], second_batch['name']]}")
+    if "ticket" in second_batch:
+        control.release(second_batch["ticket"])
+    return failures
+
+
+if __name__ == "__main__":
+    import sys
+
+    failed = 0
+    for check in (check_shedding, check_expiry, check_reserved_slots):
+        failures = check()
+        for failure in failures:
+            print(f"{check.__name__}: {failure}")
+        print(f"{check.__name__}: {'ok' if not failures else f'{len(failures)} failures'}")
+        failed += len(failures)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,155 @@
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from browser_pool import BrowserPool, chrome_factory
+from web_capture import capture_page
+
+# Headless batch capture for regression sweeps: screenshot every URL of a list
+# with N pooled Chrome sessions, write the PNGs plus a JSONL manifest, and
+# report throughput and capture latency.
+#   python batch_capture.py urls.txt --output captures/ --workers 4
+#   cat urls.txt | python batch_capture.py - --timeout 20
+#   python batch_capture.py --serve . --repeat 40    # local_server + index.html
+
+
+def read_urls(path):
+    """URLs from a file (or stdin for '-'), one per line; blank lines and # comments skipped"""
+    f = sys.stdin if path == "-" else open(path)
+    try:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def screenshot_name(index, url):
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", re.sub(r"^[a-z]+://", "", url)).strip("_")[:60]
+    return f"{index:05d}_{slug or 'page'}.png"
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def capture_one(pool, index, url, output_dir, timeout):
+    """Capture one URL with a pooled session; returns its manifest record"""
+    record = {"index": index, "url": url, "screenshot": None}
+    started = time.monotonic()
+    session = None
+    try:
+        session = pool.acquire(timeout=timeout)
+        path = os.path.join(output_dir, screenshot_name(index, url))
+        capture = capture_page(session.driver, url, path, timeout=timeout)
+        pool.release(session)
+        session = None
+        readiness = capture.pop("readiness")
+        capture.pop("screenshot")
+        record.update(capture, status="ok", screenshot=path,
+                      ready=readiness["ready"], ended_by=readiness["ended_by"])
+    except Exception as e:
+        # Timeouts and crashes leave the browser in an unknown state: replace it
+        if session is not None:
+            pool.release(session, discard=True)
+        timed_out = "timeout" in type(e).__name__.lower() or "timed out" in str(e).lower()
+        record.update(status="timeout" if timed_out else "error", error=str(e).splitlines()[0] if str(e) else repr(e),
+                      seconds=round(time.monotonic() - started, 3))
+    return record
+
+
+def run_batch(urls, output_dir, workers=4, timeout=30, factory=None, window_size=(600, 600)):
+    """Capture all urls with `workers` browsers in parallel; returns (records, summary)"""
+    os.makedirs(output_dir, exist_ok=True)
+    pool = BrowserPool(size=workers, max_uses=10 ** 9, factory=factory or chrome_factory(True, window_size))
+    pool.start(warm=workers)
+    manifest_path = os.path.join(output_dir, "manifest.jsonl")
+    records = []
+    lock = threading.Lock()
+    started = time.monotonic()
+
+    with open(manifest_path, "w") as manifest:
+        def run(index, url):
+            record = capture_one(pool, index, url, output_dir, timeout)
+            with lock:
+                records.append(record)
+                manifest.write(json.dumps(record) + "\n")
+                manifest.flush()
+                print(f"[{len(records)}/{len(urls)}] {record['status']:>7} {record['seconds']:6.2f}s {url}")
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="capture") as executor:
+            for index, url in enumerate(urls):
+                executor.submit(run, index, url)
+
+    elapsed = time.monotonic() - started
+    pool_stats = pool.stats()
+    pool.close()
+
+    latencies = [r["seconds"] for r in records if r["status"] == "ok"]
+    summary = {
+        "urls": len(urls),
+        "ok": len(latencies),
+        "timeout": sum(1 for r in records if r["status"] == "timeout"),
+        "error": sum(1 for r in records if r["status"] == "error"),
+        "workers": workers,
+        "seconds": round(elapsed, 2),
+        "urls_per_minute": round(len(urls) / elapsed * 60, 1) if elapsed else None,
+        "p50_seconds": percentile(latencies, 0.5),
+        "p95_seconds": percentile(latencies, 0.95),
+        "browsers_launched": pool_stats["launched"],
+        "manifest": manifest_path,
+    }
+    records.sort(key=lambda r: r["index"])
+    return records, summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Screenshot a list of URLs with parallel headless browsers")
+    parser.add_argument("urls", nargs="?", help="file with one URL per line, or - for stdin")
+    parser.add_argument("--output", default="captures", help="directory for screenshots and manifest.jsonl")
+    parser.add_argument("--workers", type=int, default=4, help="browsers running at once")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds allowed per URL")
+    parser.add_argument("--window-size", default="600x600")
+    parser.add_argument("--serve", metavar="DIR", help="serve DIR with local_server and capture its pages")
+    parser.add_argument("--page", default="index.html", help="page captured with --serve and no URL list")
+    parser.add_argument("--repeat", type=int, default=1, help="capture the URL list this many times")
+    args = parser.parse_args()
+
+    httpd = None
+    if args.serve:
+        from local_server import start_background_server
+        httpd, base_url = start_background_server(directory=args.serve)
+        print(f"Serving {args.serve} at {base_url}/")
+    if args.urls:
+        urls = read_urls(args.urls)
+        if httpd is not None:
+            urls = [url if "://" in url else f"{base_url}/{url.lstrip('/')}" for url in urls]
+    elif httpd is not None:
+        urls = [f"{base_url}/{args.page}"]
+    else:
+        parser.error("give a URL list (or -) or --serve DIR")
+    urls = urls * args.repeat
+
+    width, height = (int(v) for v in args.window_size.lower().split("x"))
+    _, summary = run_batch(urls, args.output, workers=args.workers, timeout=args.timeout,
+                           window_size=(width, height))
+    if httpd is not None:
+        httpd.shutdown()
+
+    print(f"{summary['ok']}/{summary['urls']} captured ({summary['timeout']} timed out, {summary['error']} failed) "
+          f"in {summary['seconds']}s with {summary['workers']} browsers")
+    print(f"Throughput {summary['urls_per_minute']} URLs/min, "
+          f"latency p50 {summary['p50_seconds']}s, p95 {summary['p95_seconds']}s")
+    print(f"Manifest: {summary['manifest']}")
+    return 0 if summary["ok"] == summary["urls"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,463 @@
+import queue
+import threading
+import time
+
+import torch
+
+import metrics
+import tracing
+from prefix_cache import cacheable_length, from_legacy_cache, get_image_token_id
+from coordinate_decoding import CoordinateDecoding
+from streaming import eos_token_ids, stream_generate_kwargs
+
+
+class BatchRequest:
+    """A single generate call waiting in the batching queue"""
+
+    def __init__(self, inputs, generation_args, stream=None, coordinate_mode=None):
+        self.inputs = inputs
+        self.generation_args = generation_args
+        self.stream = stream
+        self.coordinate_mode = coordinate_mode
+        self.enqueued_at = time.monotonic()
+        # The submitting request's spans, continued in the scheduler thread
+        self.trace = tracing.current()
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+def batch_key(inputs, generation_args):
+    """Requests can only share a generate call with the same settings and image tensor shape"""
+    pixel_values = inputs.get("pixel_values")
+    pixel_shape = tuple(pixel_values.shape[1:]) if pixel_values is not None else None
+    return (tuple(sorted(generation_args.items())), pixel_shape)
+
+
+def get_pad_token_id(tokenizer):
+    """Pick a token id to pad with (most chat models reuse EOS)"""
+    pad_token_id = getattr(tokenizer, "pad_token_id", None)
+    if pad_token_id is None:
+        pad_token_id = tokenizer.eos_token_id
+    if isinstance(pad_token_id, (list, tuple)):
+        pad_token_id = pad_token_id[0]
+    return pad_token_id
+
+
+def collate_inputs(inputs_list, pad_token_id):
+    """Left-pad input_ids/attention_mask and concatenate the remaining tensors"""
+    if len(inputs_list) == 1:
+        # Nothing to pad; keep the original tensors (cached image tensors stay shared)
+        batch = {k: v for k, v in inputs_list[0].items() if isinstance(v, torch.Tensor)}
+        if "attention_mask" not in batch:
+            batch["attention_mask"] = torch.ones_like(batch["input_ids"])
+        return batch
+
+    max_len = max(inputs["input_ids"].shape[-1] for inputs in inputs_list)
+    input_ids = []
+    attention_mask = []
+    for inputs in inputs_list:
+        ids = inputs["input_ids"]
+        mask = inputs.get("attention_mask")
+        if mask is None:
+            mask = torch.ones_like(ids)
+        pad = max_len - ids.shape[-1]
+        if pad:
+            # Decoder-only models need the padding on the left so every row ends at the prompt
+            ids = torch.cat([ids.new_full((ids.shape[0], pad), pad_token_id), ids], dim=-1)
+            mask = torch.cat([mask.new_zeros((mask.shape[0], pad)), mask], dim=-1)
+        input_ids.append(ids)
+        attention_mask.append(mask)
+
+    batch = {
+        "input_ids": torch.cat(input_ids, dim=0),
+        "attention_mask": torch.cat(attention_mask, dim=0),
+    }
+    for key, value in inputs_list[0].items():
+        if key in batch or not isinstance(value, torch.Tensor):
+            continue
+        batch[key] = torch.cat([inputs[key] for inputs in inputs_list], dim=0)
+    return batch
+
+
+class BatchScheduler:
+    """Dynamic batching in front of model.generate
+
+    Requests submitted from any thread are collected for up to max_wait_ms
+    (or until max_batch_size requests are waiting), left-padded into one batch,
+    run through a single generate call and the decoded outputs are handed back
+    to each caller.
+    """
+
+    def __init__(self, model, processor, max_batch_size=8, max_wait_ms=20):
+        self.model = model
+        self.processor = processor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.pad_token_id = get_pad_token_id(processor.tokenizer)
+        self.requests = queue.Queue()
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock()
+        # Counters for comparing against the unbatched path
+        self.counters = {
+            "requests": 0,
+            "batches": 0,
+            "generated_tokens": 0,
+            "errors": 0,
+            "busy_seconds": 0.0,
+            "coordinate_stops": 0,
+            "coordinate_tokens_saved": 0,
+        }
+        self.batch_sizes = []
+
+    def start(self):
+        """Start the background worker that runs the batches"""
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the worker after the current batch"""
+        self.running = False
+        self.requests.put(None)
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, inputs, generation_args, timeout=None, stream=None, coordinate_mode=None):
+        """Queue one request and block until its decoded response is ready
+        
+        If a TokenStream is given, it receives the tokens as they are generated.
+        coordinate_mode ("stop" or "constrained") ends a grounding answer as
+        soon as its coordinate is complete.
+        """
+        request = BatchRequest(inputs, generation_args, stream, coordinate_mode)
+        self.requests.put(request)
+        if not request.done.wait(timeout):
+            raise TimeoutError("Timed out waiting for batched generation")
+        if request.error is not None:
+            raise request.error
+        return request.response
+
+    def queue_depth(self):
+        return self.requests.qsize()
+
+    def stats(self):
+        """Snapshot of the scheduler counters"""
+        with self.lock:
+            stats = dict(self.counters)
+            sizes = list(self.batch_sizes)
+        stats["queue_depth"] = self.queue_depth()
+        stats["mean_batch_size"] = sum(sizes) / len(sizes) if sizes else 0.0
+        stats["tokens_per_second"] = (
+            stats["generated_tokens"] / stats["busy_seconds"] if stats["busy_seconds"] else 0.0
+        )
+        return stats
+
+    def _collect(self):
+        """Wait for a first request, then gather more until the window closes or the batch is full"""
+        first = self.requests.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self.running = False
+                break
+            batch.append(request)
+        return batch
+
+    def _loop(self):
+        while self.running:
+            batch = self._collect()
+            # Incompatible requests (different settings or image shapes) run as separate groups
+            groups = {}
+            for request in batch:
+                groups.setdefault(batch_key(request.inputs, request.generation_args), []).append(request)
+            for group in groups.values():
+                self._run_group(group)
+
+    def _run_group(self, group):
+        started = time.monotonic()
+        for request in group:
+            tracing.record("queue", request.enqueued_at, started, request.trace)
+            metrics.QUEUE_SECONDS.observe(started - request.enqueued_at, scheduler="static")
+        metrics.BATCH_SIZE.observe(len(group), scheduler="static")
+        decoding = coordinate_decoding(
+            self.model, self.processor, [request.coordinate_mode for request in group], group[0].generation_args
+        )
+        timer = tracing.StageTimer()
+        try:
+            # The batch's stages show up in the trace of every request in it
+            with tracing.attach([context for request in group for context in request.trace]):
+                responses, new_tokens = self.run_batch(
+                    [request.inputs for request in group], group[0].generation_args,
+                    [request.stream for request in group], decoding, timer
+                )
+        except Exception as e:
+            with self.lock:
+                self.counters["errors"] += len(group)
+            for request in group:
+                request.error = e
+                request.done.set()
+            return
+
+        with self.lock:
+            self.counters["requests"] += len(group)
+            self.counters["batches"] += 1
+            self.counters["generated_tokens"] += new_tokens
+            self.counters["busy_seconds"] += time.monotonic() - started
+            record_coordinate_stops(self.counters, decoding)
+            self.batch_sizes.append(len(group))
+            del self.batch_sizes[:-1000]
+        if timer.first_token is not None:
+            for request in group:
+                metrics.TIME_TO_FIRST_TOKEN.observe(timer.first_token - request.enqueued_at, scheduler="static")
+
+        for request, response in zip(group, responses):
+            request.response = response
+            request.done.set()
+
+    def run_batch(self, inputs_list, generation_args, streams=None, decoding=None, timer=None):
+        """Run one padded generate call and return (decoded responses, generated token count)"""
+        return generate_batch(
+            self.model, self.processor, inputs_list, generation_args, self.pad_token_id, streams, decoding, timer
+        )
+
+
+class OneShotGenerator:
+    """The unbatched path: one model.generate call per request, in the caller's thread
+
+    Exposes the same submit()/stats() interface as the schedulers so the
+    throughput counters can be compared directly.
+    """
+
+    def __init__(self, model, processor, prefix_cache=None):
+        self.model = model
+        self.processor = processor
+        self.prefix_cache = prefix_cache
+        self.pad_token_id = get_pad_token_id(processor.tokenizer)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.counters = {
+            "requests": 0,
+            "generated_tokens": 0,
+            "errors": 0,
+            "busy_seconds": 0.0,
+            "coordinate_stops": 0,
+            "coordinate_tokens_saved": 0,
+        }
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    def submit(self, inputs, generation_args, timeout=None, stream=None, coordinate_mode=None):
+        with self.lock:
+            self.in_flight += 1
+        started = time.monotonic()
+        metrics.BATCH_SIZE.observe(1, scheduler="oneshot")
+        decoding = coordinate_decoding(self.model, self.processor, [coordinate_mode], generation_args)
+        timer = tracing.StageTimer()
+        try:
+            if self.prefix_cache is not None:
+                response, new_tokens = generate_with_prefix_cache(
+                    self.model, self.processor, inputs, generation_args, self.prefix_cache,
+                    self.pad_token_id, stream, decoding, timer
+                )
+                responses = [response]
+            else:
+                responses, new_tokens = generate_batch(
+                    self.model, self.processor, [inputs], generation_args, self.pad_token_id, [stream], decoding,
+                    timer
+                )
+        except Exception:
+            with self.lock:
+                self.counters["errors"] += 1
+            raise
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        with self.lock:
+            self.counters["requests"] += 1
+            self.counters["generated_tokens"] += new_tokens
+            self.counters["busy_seconds"] += time.monotonic() - started
+            record_coordinate_stops(self.counters, decoding)
+        if timer.first_token is not None:
+            metrics.TIME_TO_FIRST_TOKEN.observe(timer.first_token - started, scheduler="oneshot")
+        return responses[0]
+
+    def queue_depth(self):
+        return self.in_flight
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["queue_depth"] = self.queue_depth()
+        stats["tokens_per_second"] = (
+            stats["generated_tokens"] / stats["busy_seconds"] if stats["busy_seconds"] else 0.0
+        )
+        if self.prefix_cache is not None:
+            stats["prefix_cache"] = self.prefix_cache.stats()
+        return stats
+
+
+def coordinate_decoding(model, processor, modes, generation_args):
+    """CoordinateDecoding for the rows of one generate call, or None if no row asked for it"""
+    if not any(modes) or int(generation_args.get("num_beams", 1)) > 1:
+        # Beam search keeps num_beams rows per request; it always decodes in full
+        return None
+    return CoordinateDecoding(
+        processor.tokenizer, modes, int(generation_args.get("max_new_tokens", 128)),
+        eos_token_ids(model, processor.tokenizer)
+    )
+
+
+def record_coordinate_stops(counters, decoding):
+    if decoding is not None:
+        counters["coordinate_stops"] += len(decoding.stopped)
+        counters["coordinate_tokens_saved"] += decoding.tokens_saved()
+
+
+def merge_generate_kwargs(*parts):
+    """Combine extra generate() arguments, concatenating stopping criteria and logits processors"""
+    merged = {}
+    for part in parts:
+        for key, value in part.items():
+            if key in ("stopping_criteria", "logits_processor") and key in merged:
+                merged[key].extend(value)
+            else:
+                merged[key] = value
+    return merged
+
+
+def generate_batch(model, processor, inputs_list, generation_args, pad_token_id=None, streams=None,
+                   decoding=None, timer=None):
+    """Run one padded generate call and return (decoded responses, generated token count)
+
+    A tracing.StageTimer passed as timer notes when the first token came out.
+    """
+    if pad_token_id is None:
+        pad_token_id = get_pad_token_id(processor.tokenizer)
+    with tracing.span("collate", batch_size=len(inputs_list)):
+        batch = collate_inputs(inputs_list, pad_token_id)
+        device = next(model.parameters()).device
+        batch = {k: v.to(device) for k, v in batch.items()}
+
+    kwargs = stream_generate_kwargs(model, processor.tokenizer, streams, generation_args)
+    if decoding is not None:
+        kwargs = merge_generate_kwargs(kwargs, decoding.generate_kwargs(batch["input_ids"].shape[-1]))
+    with tracing.span("generate", batch_size=len(inputs_list), prompt_tokens=batch["input_ids"].shape[-1]) as span:
+        timer = tracing.stage_timer(timer)
+        if timer is not None:
+            kwargs = merge_generate_kwargs(kwargs, {"logits_processor": [timer]})
+            timer.start()
+        with torch.inference_mode():
+            generate_ids = model.generate(**batch, pad_token_id=pad_token_id, **generation_args, **kwargs)
+        if timer is not None:
+            timer.record(span.context)
+
+    generate_ids = generate_ids[:, batch["input_ids"].shape[-1]:]
+    with tracing.span("processor.decode"):
+        responses = [processor.decode(ids, skip_special_tokens=True).strip() for ids in generate_ids]
+    new_tokens = int((generate_ids != pad_token_id).sum())
+    return responses, new_tokens
+
+
+def generate_with_prefix_cache(model, processor, inputs, generation_args, prefix_cache, pad_token_id=None,
+                               stream=None, decoding=None, timer=None):
+    """Generate for a single request, reusing and refreshing the cached KV of its prompt prefix"""
+    if pad_token_id is None:
+        pad_token_id = get_pad_token_id(processor.tokenizer)
+    device = next(model.parameters()).device
+    batch = {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in inputs.items()}
+    prompt_ids = inputs["input_ids"][0]
+
+    kwargs = stream_generate_kwargs(model, processor.tokenizer, [stream], generation_args)
+    if decoding is not None:
+        kwargs = merge_generate_kwargs(kwargs, decoding.generate_kwargs(prompt_ids.shape[-1]))
+    # generate() drops the image inputs once the cache is non-empty, so a cached
+    # prefix can only be resumed for text-only prompts (and beam search would
+    # need it expanded per beam)
+    if batch.get("pixel_values") is None and int(generation_args.get("num_beams", 1)) == 1:
+        prefix_length, past = prefix_cache.match(prompt_ids)
+        if past is not None:
+            kwargs["past_key_values"] = from_legacy_cache(past)
+    else:
+        prefix_cache.record_miss(len(prompt_ids))
+
+    with tracing.span("generate", batch_size=1, prompt_tokens=prompt_ids.shape[-1],
+                      cached_prefix=kwargs.get("past_key_values") is not None) as span:
+        timer = tracing.stage_timer(timer)
+        if timer is not None:
+            kwargs = merge_generate_kwargs(kwargs, {"logits_processor": [timer]})
+            timer.start()
+        with torch.inference_mode():
+            outputs = model.generate(
+                **batch, pad_token_id=pad_token_id, return_dict_in_generate=True, **generation_args, **kwargs
+            )
+        if timer is not None:
+            timer.record(span.context)
+
+    sequence = outputs.sequences[0]
+    # Beam search reorders the cache, so it no longer matches this sequence
+    if int(generation_args.get("num_beams", 1)) == 1 and outputs.past_key_values is not None:
+        # The cache covers the prompt and all generated tokens but the last one
+        cached_ids = sequence[:-1].cpu()
+        cached_ids = cached_ids[:cacheable_length(cached_ids, get_image_token_id(processor))]
+        prefix_cache.store(cached_ids, outputs.past_key_values)
+
+    generate_ids = sequence[prompt_ids.shape[-1]:]
+    with tracing.span("processor.decode"):
+        response = processor.decode(generate_ids, skip_special_tokens=True).strip()
+    return response, int((generate_ids != pad_token_id).sum())
+
+
+if __name__ == "__main__":
+    # Throughput comparison against one-request-at-a-time generation on the tiny stand-in model
+    import sys
+    from concurrent.futures import ThreadPoolExecutor
+    from tiny_magma import load_tiny_magma
+
+    num_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    model, processor = load_tiny_magma()
+    generation_args = {"max_new_tokens": 32, "do_sample": False, "num_beams": 1, "use_cache": True}
+    prompts = [
+        processor.tokenizer.apply_chat_template(
+            [{"role": "system", "content": "You are agent that can see, talk and act."},
+             {"role": "user", "content": f"Where is button {i}?" + " please" * (i % 5)}],
+            tokenize=False, add_generation_prompt=True)
+        for i in range(num_requests)
+    ]
+    all_inputs = [processor(texts=prompt, return_tensors="pt") for prompt in prompts]
+
+    scheduler = BatchScheduler(model, processor, max_batch_size=1, max_wait_ms=0).start()
+    start = time.monotonic()
+    for inputs in all_inputs:
+        scheduler.submit(dict(inputs), generation_args)
+    sequential = time.monotonic() - start
+    scheduler.stop()
+
+    scheduler = BatchScheduler(model, processor, max_batch_size=16, max_wait_ms=20).start()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=num_requests) as pool:
+        list(pool.map(lambda inputs: scheduler.submit(dict(inputs), generation_args), all_inputs))
+    batched = time.monotonic() - start
+    stats = scheduler.stats()
+    scheduler.stop()
+
+    print(f"sequential: {num_requests / sequential:.1f} req/s")
+    print(f"batched:    {num_requests / batched:.1f} req/s (mean batch size {stats['mean_batch_size']:.1f})")
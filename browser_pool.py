@@ -0,0 +1,308 @@
+import itertools
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Pool of warm Selenium WebDriver sessions. Launching Chrome costs far more than
+# loading a page, so sessions are started once (in the background) and lent out
+# to capture and action threads. A session can be pinned after a capture so the
+# click that follows runs on exactly the page state that was captured.
+
+# Between borrowers a session's state is cleared for the whole browser, not
+# just the page it was left on: all cookies, and the storage of every origin
+# its tabs have been to or embed (Chrome DevTools Protocol commands). The old
+# tabs are closed in favour of a fresh one, which drops their history and
+# sessionStorage. Drivers without CDP are recycled instead.
+
+
+def chrome_factory(headless=True, window_size=(600, 600)):
+    """Return a function that launches a Chrome WebDriver with the app's options"""
+    def create():
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+
+        chrome_options = Options()
+        if headless:
+            chrome_options.add_argument("--headless")
+            chrome_options.add_argument("--disable-gpu")
+        chrome_options.add_argument("--no-sandbox")
+        chrome_options.add_argument(f"--window-size={window_size[0]},{window_size[1]}")
+        return webdriver.Chrome(options=chrome_options)
+    return create
+
+
+class BrowserSession:
+    """A pooled WebDriver and its usage bookkeeping"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, driver):
+        self.id = next(self._ids)
+        self.driver = driver
+        self.uses = 0
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        # URL the session was left on by a pinned capture
+        self.pinned_url = None
+
+
+class BrowserPool:
+    """Warm WebDriver sessions shared by the capture and action threads
+
+    acquire() lends a session (launching one if the pool is not full yet),
+    release() health-checks it, clears its state (reset_session) and returns
+    it, and recycles it after max_uses. pin() keeps a session and its page out of the
+    pool until acquire(session_id=...) picks it up again.
+    """
+
+    def __init__(self, size=2, max_uses=50, factory=None, headless=True, window_size=(600, 600)):
+        self.size = size
+        self.max_uses = max_uses
+        self.factory = factory or chrome_factory(headless, window_size)
+        self.idle = []
+        self.pinned = {}
+        self.total = 0  # sessions alive or being launched
+        self.warm = 0  # idle sessions to keep ready
+        self.closed = False
+        self.condition = threading.Condition()
+        self.counters = {
+            "launched": 0,
+            "acquired": 0,
+            "reused": 0,
+            "pinned_reuses": 0,
+            "recycled": 0,
+            "unhealthy": 0,
+            "launch_seconds": 0.0,
+            "wait_seconds": 0.0,
+        }
+
+    def start(self, warm=1):
+        """Keep `warm` idle sessions launched in the background so captures find one ready"""
+        self.warm = warm
+        self._replenish()
+        return self
+
+    def _replenish(self):
+        def launch():
+            try:
+                session = self._launch()
+            except Exception as e:
+                with self.condition:
+                    self.total -= 1
+                    self.condition.notify()
+                print(f"Warning: could not start browser session: {e}")
+                return
+            self._put_idle(session)
+
+        with self.condition:
+            if self.closed:
+                return
+            count = max(0, min(self.warm - len(self.idle), self.size - self.total))
+            self.total += count
+        for _ in range(count):
+            threading.Thread(target=launch, name="browser-warmup", daemon=True).start()
+
+    def _launch(self):
+        started = time.monotonic()
+        session = BrowserSession(self.factory())
+        with self.condition:
+            self.counters["launched"] += 1
+            self.counters["launch_seconds"] += time.monotonic() - started
+        return session
+
+    def _put_idle(self, session):
+        with self.condition:
+            if self.closed:
+                self.total -= 1
+                quit_driver(session.driver)
+                return
+            self.idle.append(session)
+            self.condition.notify()
+
+    def acquire(self, timeout=60, session_id=None):
+        """Borrow a session; with session_id, take back that pinned session if it is still there"""
+        started = time.monotonic()
+        with self.condition:
+            if session_id is not None and session_id in self.pinned:
+                session = self.pinned.pop(session_id)
+                self.counters["pinned_reuses"] += 1
+                return self._lend(session, started)
+
+            while True:
+                if self.closed:
+                    raise RuntimeError("Browser pool is closed")
+                if self.idle:
+                    self.counters["reused"] += 1
+                    return self._lend(self.idle.pop(), started)
+                if self.total < self.size:
+                    self.total += 1
+                    break
+                remaining = timeout - (time.monotonic() - started) if timeout is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("No browser session available")
+                self.condition.wait(remaining)
+
+        try:
+            session = self._launch()
+        except Exception:
+            with self.condition:
+                self.total -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            return self._lend(session, started)
+
+    def _lend(self, session, started):
+        session.uses += 1
+        session.last_used = time.monotonic()
+        self.counters["acquired"] += 1
+        self.counters["wait_seconds"] += session.last_used - started
+        return session
+
+    def release(self, session, discard=False):
+        """Return a borrowed session; broken, worn-out or discarded ones are replaced"""
+        session.pinned_url = None
+        if discard or not self.is_healthy(session):
+            with self.condition:
+                self.counters["unhealthy"] += 1
+            self._retire(session)
+            return
+        if session.uses >= self.max_uses:
+            with self.condition:
+                self.counters["recycled"] += 1
+            self._retire(session)
+            return
+        try:
+            reset_session(session.driver)
+        except Exception:
+            self._retire(session)
+            return
+        self._put_idle(session)
+
+    def pin(self, session, url=None):
+        """Keep a borrowed session (and its current page) for a later acquire(session_id=...)"""
+        session.pinned_url = url
+        with self.condition:
+            if self.closed:
+                self.total -= 1
+                quit_driver(session.driver)
+                return None
+            self.pinned[session.id] = session
+        return session.id
+
+    def unpin(self, session_id):
+        """Give a pinned session back to the pool (e.g. when a newer capture replaces it)"""
+        with self.condition:
+            session = self.pinned.pop(session_id, None)
+        if session is not None:
+            self.release(session)
+
+    def _retire(self, session):
+        quit_driver(session.driver)
+        with self.condition:
+            self.total -= 1
+            self.condition.notify()
+        self._replenish()
+
+    def is_healthy(self, session):
+        try:
+            return session.driver.execute_script("return 1") == 1
+        except Exception:
+            return False
+
+    def close(self):
+        """Quit every session; borrowed ones are quit when they come back"""
+        with self.condition:
+            self.closed = True
+            sessions = self.idle + list(self.pinned.values())
+            self.idle = []
+            self.pinned = {}
+            self.total -= len(sessions)
+            self.condition.notify_all()
+        for session in sessions:
+            quit_driver(session.driver)
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats["idle"] = len(self.idle)
+            stats["pinned"] = len(self.pinned)
+            stats["total"] = self.total
+        stats["mean_launch_seconds"] = stats["launch_seconds"] / stats["launched"] if stats["launched"] else 0.0
+        return stats
+
+
+def _origin(url):
+    parts = urlsplit(url or "")
+    return f"{parts.scheme}://{parts.netloc}" if parts.scheme in ("http", "https") and parts.netloc else None
+
+
+def visited_origins(driver):
+    """Origins of the current tab's history and of the frames on its page"""
+    urls = [entry["url"] for entry in driver.execute_cdp_cmd("Page.getNavigationHistory", {})["entries"]]
+    frames = [driver.execute_cdp_cmd("Page.getFrameTree", {})["frameTree"]]
+    while frames:
+        frame = frames.pop()
+        urls.append(frame["frame"].get("url"))
+        frames.extend(frame.get("childFrames", ()))
+    return {origin for origin in map(_origin, urls) if origin}
+
+
+def reset_session(driver):
+    """Clear everything a borrower left: tabs, history, cookies and every visited origin's storage
+
+    Raises if the driver cannot do it (no CDP), so release() recycles the session.
+    """
+    if not hasattr(driver, "execute_cdp_cmd"):
+        raise RuntimeError("driver has no DevTools access to clear its state")
+    origins = set()
+    old_tabs = driver.window_handles
+    for handle in old_tabs:
+        driver.switch_to.window(handle)
+        origins |= visited_origins(driver)
+    driver.switch_to.new_window("tab")
+    fresh_tab = driver.current_window_handle
+    for handle in old_tabs:
+        driver.switch_to.window(handle)
+        driver.close()
+    driver.switch_to.window(fresh_tab)
+    driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+    for origin in sorted(origins):
+        driver.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+
+
+def quit_driver(driver):
+    try:
+        driver.quit()
+    except Exception:
+        pass
+
+
+if __name__ == "__main__":
+    # Capture latency with a fresh browser per capture vs. a warm pool
+    #   python browser_pool.py http://localhost:8000 10
+    import sys
+
+    url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8000"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    create = chrome_factory()
+
+    started = time.monotonic()
+    for _ in range(count):
+        driver = create()
+        driver.get(url)
+        driver.get_screenshot_as_png()
+        driver.quit()
+    fresh = (time.monotonic() - started) / count
+
+    pool = BrowserPool(size=1).start()
+    started = time.monotonic()
+    for _ in range(count):
+        session = pool.acquire()
+        session.driver.get(url)
+        session.driver.get_screenshot_as_png()
+        pool.release(session)
+    pooled = (time.monotonic() - started) / count
+    print(f"fresh browser: {fresh * 1000:.0f} ms/capture, pooled: {pooled * 1000:.0f} ms/capture")
+    print(pool.stats())
+    pool.close()
@@ -0,0 +1,491 @@
+import queue
+import threading
+import time
+
+import torch
+
+import metrics
+import tracing
+from batching import batch_key, collate_inputs, coordinate_decoding, generate_batch, get_pad_token_id, record_coordinate_stops
+from prefix_cache import cacheable_length, from_legacy_cache, get_image_token_id, to_legacy_cache
+from coordinate_decoding import constrain_logits, get_grammar, has_complete_coordinate
+from streaming import eos_token_ids
+
+def left_pad_cache(legacy, pad):
+    """Prepend `pad` empty positions to every key/value tensor ([batch, heads, seq, dim])"""
+    if pad == 0:
+        return legacy
+    padded = []
+    for key, value in legacy:
+        key = torch.cat([key.new_zeros(key.shape[:2] + (pad,) + key.shape[3:]), key], dim=2)
+        value = torch.cat([value.new_zeros(value.shape[:2] + (pad,) + value.shape[3:]), value], dim=2)
+        padded.append((key, value))
+    return tuple(padded)
+
+
+class Sequence:
+    """One request living in the running batch"""
+
+    def __init__(self, inputs, generation_args, stream=None, coordinate_mode=None):
+        self.inputs = inputs
+        self.generation_args = generation_args
+        self.stream = stream
+        self.coordinate_mode = coordinate_mode
+        self.max_new_tokens = int(generation_args.get("max_new_tokens", 128))
+        self.num_beams = int(generation_args.get("num_beams", 1))
+        self.do_sample = bool(generation_args.get("do_sample", False))
+        self.temperature = float(generation_args.get("temperature") or 0.0)
+        self.tokens = []
+        # Decoded answer so far, kept up to date for coordinate_mode sequences only
+        self.text = ""
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.enqueued_at = time.monotonic()
+        self.first_token_at = None
+        # The submitting request's spans, continued in the decoding loop
+        self.trace = tracing.current()
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+    def append(self, token, tokenizer):
+        """Add a generated token, extending self.text by only the characters it completes"""
+        self.tokens.append(token)
+        if self.coordinate_mode is None:
+            return
+        # Decode the new token together with the previous ones so word-initial
+        # spaces survive, and hold back pieces of an unfinished character
+        prefix = tokenizer.decode(self.tokens[self.prefix_offset:self.read_offset], skip_special_tokens=True)
+        text = tokenizer.decode(self.tokens[self.prefix_offset:], skip_special_tokens=True)
+        if len(text) > len(prefix) and not text.endswith("\ufffd"):
+            self.text += text[len(prefix):]
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.tokens)
+
+
+class ContinuousBatcher:
+    """Iteration-level (continuous) batching scheduler
+
+    Every decoding step runs all active sequences through one forward pass.
+    Between steps finished sequences are evicted from the batch and waiting
+    requests are prefilled and admitted, so short answers never sit idle
+    behind the longest one. Each sequence keeps its own max_new_tokens,
+    temperature and do_sample settings. Beam search requests (num_beams > 1)
+    cannot share a step with other sequences: the loop runs each one through
+    model.generate between two steps, and as with the other schedulers a
+    beam answer is streamed only once it is final and always decodes in full.
+    """
+
+    def __init__(self, model, processor, max_batch_size=8, prefix_cache=None):
+        self.model = model
+        self.processor = processor
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.image_token_id = get_image_token_id(processor)
+        self.pad_token_id = get_pad_token_id(processor.tokenizer)
+        self.eos_token_ids = eos_token_ids(model, processor.tokenizer)
+        self.requests = queue.Queue()
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "beam_search_requests": 0,
+            "decode_steps": 0,
+            "generated_tokens": 0,
+            "errors": 0,
+            "busy_seconds": 0.0,
+            "time_to_first_token_seconds": 0.0,
+            "coordinate_stops": 0,
+            "coordinate_tokens_saved": 0,
+        }
+        self.active_count = 0
+        self.occupancy_sum = 0
+
+        # Running batch state
+        self.active = []
+        self.cache = None
+        self.attention_mask = None
+
+    def start(self):
+        """Start the background decoding loop"""
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self._loop, name="continuous-batcher", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the loop; sequences still running are failed"""
+        self.running = False
+        self.requests.put(None)
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, inputs, generation_args, timeout=None, stream=None, coordinate_mode=None):
+        """Queue one request and block until its decoded response is ready
+        
+        If a TokenStream is given, it receives each token after its decoding step.
+        coordinate_mode ("stop" or "constrained") ends a grounding answer as
+        soon as its coordinate is complete.
+        """
+        sequence = Sequence(inputs, generation_args, stream, coordinate_mode)
+        self.requests.put(sequence)
+        if not sequence.done.wait(timeout):
+            raise TimeoutError("Timed out waiting for generation")
+        if sequence.error is not None:
+            raise sequence.error
+        return sequence.response
+
+    def queue_depth(self):
+        return self.requests.qsize()
+
+    def stats(self):
+        """Snapshot of the scheduler counters"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["active_sequences"] = self.active_count
+            occupancy = self.occupancy_sum
+        stats["queue_depth"] = self.queue_depth()
+        stats["mean_batch_size"] = occupancy / stats["decode_steps"] if stats["decode_steps"] else 0.0
+        stats["tokens_per_second"] = (
+            stats["generated_tokens"] / stats["busy_seconds"] if stats["busy_seconds"] else 0.0
+        )
+        stats["mean_time_to_first_token"] = (
+            stats["time_to_first_token_seconds"] / stats["requests"] if stats["requests"] else 0.0
+        )
+        if self.prefix_cache is not None:
+            stats["prefix_cache"] = self.prefix_cache.stats()
+        return stats
+
+    def _loop(self):
+        while self.running:
+            # Block only when there is nothing to decode
+            waiting = self._take_waiting(block=not self.active)
+            started = time.monotonic()
+            try:
+                if waiting:
+                    self._admit(waiting)
+                if self.active:
+                    self._step()
+            except Exception as e:
+                self._fail_all(e)
+            with self.lock:
+                self.counters["busy_seconds"] += time.monotonic() - started
+                self.active_count = len(self.active)
+        self._fail_all(RuntimeError("Continuous batcher stopped"))
+
+    def _take_waiting(self, block):
+        free = self.max_batch_size - len(self.active)
+        waiting = []
+        while len(waiting) < free:
+            try:
+                sequence = self.requests.get(block=block and not waiting)
+            except queue.Empty:
+                break
+            if sequence is None:
+                self.running = False
+                break
+            waiting.append(sequence)
+        return waiting
+
+    def _admit(self, waiting):
+        """Prefill newly arrived sequences and merge them into the running batch"""
+        groups = {}
+        for sequence in waiting:
+            if sequence.num_beams > 1:
+                self._beam_search(sequence)
+                continue
+            key = batch_key(sequence.inputs, {})
+            # Image prompts are prefilled one at a time: the model expands the image
+            # placeholder internally, so the cache length is only known per sequence.
+            # With a prefix cache every prompt resumes from its own cached prefix.
+            if key[1] is not None or self.prefix_cache is not None:
+                key = (key, id(sequence))
+            groups.setdefault(key, []).append(sequence)
+
+        for group in groups.values():
+            admitted = time.monotonic()
+            for sequence in group:
+                tracing.record("queue", sequence.enqueued_at, admitted, sequence.trace)
+                metrics.QUEUE_SECONDS.observe(admitted - sequence.enqueued_at, scheduler="continuous")
+            try:
+                with tracing.attach([context for sequence in group for context in sequence.trace]), \
+                        tracing.span("prefill", batch_size=len(group), running=len(self.active)):
+                    if self.prefix_cache is not None:
+                        cache, mask, logits = self._prefill_from_prefix(group[0].inputs)
+                    else:
+                        cache, mask, logits = self._prefill([sequence.inputs for sequence in group])
+            except Exception as e:
+                with self.lock:
+                    self.counters["errors"] += len(group)
+                for sequence in group:
+                    sequence.error = e
+                    sequence.done.set()
+                continue
+            self._merge(group, cache, mask)
+            self._append_tokens(group, logits)
+
+        self._evict_finished()
+
+    def _beam_search(self, sequence):
+        """Run one beam search request to completion (the running batch waits)"""
+        started = time.monotonic()
+        tracing.record("queue", sequence.enqueued_at, started, sequence.trace)
+        metrics.QUEUE_SECONDS.observe(started - sequence.enqueued_at, scheduler="continuous")
+        if sequence.stream is not None and sequence.stream.cancelled:
+            sequence.response = ""
+            sequence.done.set()
+            return
+        decoding = coordinate_decoding(self.model, self.processor, [sequence.coordinate_mode], sequence.generation_args)
+        try:
+            with tracing.attach(sequence.trace):
+                responses, new_tokens = generate_batch(
+                    self.model, self.processor, [sequence.inputs], sequence.generation_args, self.pad_token_id,
+                    [sequence.stream], decoding
+                )
+        except Exception as e:
+            with self.lock:
+                self.counters["errors"] += 1
+            sequence.error = e
+            sequence.done.set()
+            return
+        with self.lock:
+            self.counters["beam_search_requests"] += 1
+            self.counters["generated_tokens"] += new_tokens
+            record_coordinate_stops(self.counters, decoding)
+        sequence.response = responses[0]
+        sequence.done.set()
+
+    def _prefill(self, inputs_list):
+        batch = collate_inputs(inputs_list, self.pad_token_id)
+        device = next(self.model.parameters()).device
+        batch = {k: v.to(device) for k, v in batch.items()}
+        if "pixel_values" not in batch:
+            # Positions must skip the left padding, as generate() does
+            position_ids = batch["attention_mask"].long().cumsum(-1) - 1
+            batch["position_ids"] = position_ids.clamp(min=0)
+
+        with torch.inference_mode():
+            outputs = self.model(**batch, use_cache=True)
+
+        cache = to_legacy_cache(outputs.past_key_values)
+        mask = batch["attention_mask"]
+        cache_len = cache[0][0].shape[2]
+        if cache_len != mask.shape[-1]:
+            # Image tokens were expanded inside the model (single, unpadded sequence)
+            mask = mask.new_ones((mask.shape[0], cache_len))
+        return cache, mask, outputs.logits[:, -1, :]
+
+    def _prefill_from_prefix(self, inputs):
+        """Prefill only the tokens after the longest cached prefix of this prompt"""
+        prompt_ids = inputs["input_ids"][0]
+        if inputs.get("pixel_values") is not None:
+            # The image must go through the model's own prefill pass
+            self.prefix_cache.record_miss(len(prompt_ids))
+            return self._prefill([inputs])
+        prefix_length, past = self.prefix_cache.match(prompt_ids)
+        if past is None:
+            return self._prefill([inputs])
+
+        device = next(self.model.parameters()).device
+        total = prompt_ids.shape[-1]
+        mask = torch.ones((1, total), dtype=torch.long, device=device)
+        with torch.inference_mode():
+            outputs = self.model(
+                input_ids=inputs["input_ids"][:, prefix_length:].to(device),
+                attention_mask=mask,
+                position_ids=torch.arange(prefix_length, total, device=device).unsqueeze(0),
+                past_key_values=from_legacy_cache(past),
+                use_cache=True,
+            )
+        return to_legacy_cache(outputs.past_key_values), mask, outputs.logits[:, -1, :]
+
+    def _store_prefix(self, row, sequence):
+        """Cache the KV of a finished sequence (prompt + answer) for the next turn"""
+        # The cache holds the prompt and every generated token except the last one
+        token_ids = torch.cat([sequence.inputs["input_ids"][0].cpu(), torch.tensor(sequence.tokens[:-1], dtype=torch.long)])
+        token_ids = token_ids[:cacheable_length(token_ids, self.image_token_id)]
+        columns = self.attention_mask[row].nonzero().flatten()[:len(token_ids)]
+        legacy = tuple((k[row:row + 1, :, columns], v[row:row + 1, :, columns]) for k, v in self.cache)
+        self.prefix_cache.store(token_ids, legacy)
+
+    def _merge(self, group, cache, mask):
+        if not self.active:
+            self.active = list(group)
+            self.cache = cache
+            self.attention_mask = mask
+            return
+
+        current_len = self.attention_mask.shape[-1]
+        new_len = mask.shape[-1]
+        length = max(current_len, new_len)
+        self.cache = tuple(
+            (torch.cat([k1, k2], dim=0), torch.cat([v1, v2], dim=0))
+            for (k1, v1), (k2, v2) in zip(
+                left_pad_cache(self.cache, length - current_len), left_pad_cache(cache, length - new_len)
+            )
+        )
+        self.attention_mask = torch.cat([
+            torch.cat([self.attention_mask.new_zeros((self.attention_mask.shape[0], length - current_len)),
+                       self.attention_mask], dim=-1),
+            torch.cat([mask.new_zeros((mask.shape[0], length - new_len)), mask], dim=-1),
+        ], dim=0)
+        self.active.extend(group)
+
+    def _step(self):
+        """Run one decoding step for every active sequence"""
+        device = self.attention_mask.device
+        input_ids = torch.tensor([[sequence.tokens[-1]] for sequence in self.active], device=device)
+        # The new token's position is the number of real tokens before it
+        position_ids = self.attention_mask.sum(-1, keepdim=True).long()
+        self.attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones((len(self.active), 1))], dim=-1
+        )
+
+        with torch.inference_mode():
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=self.attention_mask,
+                position_ids=position_ids,
+                past_key_values=from_legacy_cache(self.cache),
+                use_cache=True,
+            )
+        self.cache = to_legacy_cache(outputs.past_key_values)
+
+        with self.lock:
+            self.counters["decode_steps"] += 1
+            self.occupancy_sum += len(self.active)
+        metrics.BATCH_SIZE.observe(len(self.active), scheduler="continuous")
+
+        self._append_tokens(self.active, outputs.logits[:, -1, :])
+        self._evict_finished()
+
+    def _append_tokens(self, sequences, logits):
+        """Pick the next token for each sequence with its own sampling settings"""
+        if any(sequence.coordinate_mode == "constrained" for sequence in sequences):
+            logits = logits.clone()
+        for row, sequence in enumerate(sequences):
+            if sequence.coordinate_mode == "constrained":
+                grammar = get_grammar(self.processor.tokenizer, self.eos_token_ids)
+                logits[row] = constrain_logits(logits[row], grammar.allowed_token_ids(sequence.text))
+        next_tokens = logits.argmax(dim=-1)
+        for row, sequence in enumerate(sequences):
+            if sequence.do_sample and sequence.temperature > 0:
+                probs = torch.softmax(logits[row].float() / sequence.temperature, dim=-1)
+                next_tokens[row] = torch.multinomial(probs, num_samples=1)[0]
+
+        now = time.monotonic()
+        for sequence, token in zip(sequences, next_tokens.tolist()):
+            if sequence.first_token_at is None:
+                sequence.first_token_at = now
+            sequence.append(token, self.processor.tokenizer)
+            if sequence.stream is not None and token not in self.eos_token_ids:
+                sequence.stream.put([token])
+        with self.lock:
+            self.counters["generated_tokens"] += len(sequences)
+
+    def _is_finished(self, sequence):
+        if not sequence.tokens:
+            return False
+        if sequence.stream is not None and sequence.stream.cancelled:
+            return True
+        if sequence.tokens[-1] in self.eos_token_ids or len(sequence.tokens) >= sequence.max_new_tokens:
+            return True
+        if sequence.coordinate_mode is not None and has_complete_coordinate(sequence.text):
+            with self.lock:
+                self.counters["coordinate_stops"] += 1
+                self.counters["coordinate_tokens_saved"] += sequence.max_new_tokens - len(sequence.tokens)
+            return True
+        return False
+
+    def _evict_finished(self):
+        keep = []
+        for row, sequence in enumerate(self.active):
+            if self._is_finished(sequence):
+                if self.prefix_cache is not None:
+                    self._store_prefix(row, sequence)
+                self._finish(sequence)
+            else:
+                keep.append(row)
+        if len(keep) == len(self.active):
+            return
+        if not keep:
+            self.active = []
+            self.cache = None
+            self.attention_mask = None
+            return
+
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        mask = self.attention_mask.index_select(0, index)
+        # Drop leading columns that are padding for every remaining sequence
+        start = int((mask.sum(0) > 0).nonzero()[0])
+        self.attention_mask = mask[:, start:]
+        self.cache = tuple(
+            (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+            for k, v in self.cache
+        )
+        self.active = [self.active[row] for row in keep]
+
+    def _finish(self, sequence):
+        # Decoding steps are shared by the whole running batch; each request gets one span for all of its steps
+        tracing.record("decode", sequence.first_token_at, time.monotonic(), sequence.trace,
+                       tokens=len(sequence.tokens))
+        with tracing.attach(sequence.trace), tracing.span("processor.decode"):
+            sequence.response = self.processor.decode(sequence.tokens, skip_special_tokens=True).strip()
+        with self.lock:
+            self.counters["requests"] += 1
+            self.counters["time_to_first_token_seconds"] += sequence.first_token_at - sequence.enqueued_at
+        metrics.TIME_TO_FIRST_TOKEN.observe(sequence.first_token_at - sequence.enqueued_at, scheduler="continuous")
+        sequence.done.set()
+
+    def _fail_all(self, error):
+        with self.lock:
+            self.counters["errors"] += len(self.active)
+        for sequence in self.active:
+            sequence.error = error
+            sequence.done.set()
+        self.active = []
+        self.cache = None
+        self.attention_mask = None
+
+
+if __name__ == "__main__":
+    # Compare one-shot, static and continuous batching on the tiny stand-in model
+    import random
+    import sys
+    from concurrent.futures import ThreadPoolExecutor
+    from batching import BatchScheduler, OneShotGenerator
+    from tiny_magma import load_tiny_magma
+
+    num_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    model, processor = load_tiny_magma()
+    random.seed(0)
+    jobs = []
+    for i in range(num_requests):
+        prompt = processor.tokenizer.apply_chat_template(
+            [{"role": "system", "content": "You are agent that can see, talk and act."},
+             {"role": "user", "content": f"Where is button {i}?"}],
+            tokenize=False, add_generation_prompt=True)
+        # Mix of short coordinate answers and long descriptions
+        max_new_tokens = random.choice([12, 12, 12, 96])
+        jobs.append((processor(texts=prompt, return_tensors="pt"),
+                     {"max_new_tokens": max_new_tokens, "do_sample": False, "num_beams": 1, "use_cache": True}))
+
+    for name, scheduler in [
+        ("one-shot", OneShotGenerator(model, processor)),
+        ("static", BatchScheduler(model, processor, max_batch_size=8, max_wait_ms=20)),
+        ("continuous", ContinuousBatcher(model, processor, max_batch_size=8)),
+    ]:
+        scheduler.start()
+        start = time.monotonic()
+        workers = 1 if name == "one-shot" else num_requests
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda job: scheduler.submit(dict(job[0]), job[1]), jobs))
+        elapsed = time.monotonic() - start
+        stats = scheduler.stats()
+        scheduler.stop()
+        print(f"{name:>10}: {num_requests / elapsed:6.1f} req/s, "
+              f"{stats['generated_tokens'] / elapsed:7.1f} tok/s wall, "
+              f"mean batch {stats.get('mean_batch_size', 1.0):.1f}")
@@ -0,0 +1,184 @@
+import re
+import threading
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+# Decoding modes for grounding requests, chosen per request:
+#   None          - decode until EOS / max_new_tokens (default)
+#   "stop"        - stop as soon as a well-formed Coordinate: (x, y) or
+#                   Coordinate: (x1, y1, x2, y2) has been closed
+#   "constrained" - additionally only allow tokens that keep the answer inside
+#                   that grammar, so the answer is the coordinate and nothing else
+COORDINATE_MODES = (None, "stop", "constrained")
+
+COORDINATE_PREFIX = "Coordinate: ("
+# The shape the grammar produces (coordinate_parser.py reads looser formats too)
+COMPLETE_COORDINATE = re.compile(r"Coordinate: \([0-9.]+, [0-9.]+(?:, [0-9.]+, [0-9.]+)?\)")
+_NUMBER = re.compile(r"[0-9]+(?:\.[0-9]+)?")
+_PARTIAL_NUMBER = re.compile(r"(?:[0-9]+(?:\.[0-9]*)?)?")
+
+# Longest number the grammar allows, so constrained answers always terminate
+MAX_NUMBER_CHARS = 8
+
+INVALID, PARTIAL, COMPLETE = "invalid", "partial", "complete"
+
+
+def has_complete_coordinate(text):
+    return COMPLETE_COORDINATE.search(text) is not None
+
+
+def coordinate_prefix_state(text):
+    """Whether text is a complete coordinate answer, a prefix of one, or neither"""
+    if len(text) <= len(COORDINATE_PREFIX):
+        return PARTIAL if COORDINATE_PREFIX.startswith(text) else INVALID
+    if not text.startswith(COORDINATE_PREFIX):
+        return INVALID
+    body = text[len(COORDINATE_PREFIX):]
+    closed = body.endswith(")")
+    if closed:
+        body = body[:-1]
+    if ")" in body:
+        return INVALID
+    parts = body.split(", ")
+    if len(parts) > 4 or any(len(part.rstrip(",")) > MAX_NUMBER_CHARS for part in parts):
+        return INVALID
+    if not all(_NUMBER.fullmatch(part) for part in parts[:-1]):
+        return INVALID
+    last = parts[-1]
+    if closed:
+        return COMPLETE if _NUMBER.fullmatch(last) and len(parts) in (2, 4) else INVALID
+    if last.endswith(","):
+        # Half-way through a ", " separator
+        return PARTIAL if _NUMBER.fullmatch(last[:-1]) and len(parts) < 4 else INVALID
+    return PARTIAL if _PARTIAL_NUMBER.fullmatch(last) else INVALID
+
+
+def grammar_state(text):
+    """Key shared by every partial answer that allows the same next tokens
+
+    Which tokens may follow only depends on how many numbers are done and on
+    the shape of the one being written, not on the digits themselves.
+    """
+    if len(text) <= len(COORDINATE_PREFIX):
+        return text
+    parts = text[len(COORDINATE_PREFIX):].split(", ")
+    return COORDINATE_PREFIX + "0, " * (len(parts) - 1) + re.sub("[0-9]", "0", parts[-1])
+
+
+class CoordinateGrammar:
+    """The tokens of one tokenizer that can appear in a coordinate answer
+
+    Built once per tokenizer (decoding the whole vocabulary takes a moment);
+    use get_grammar(). Allowed tokens are cached per grammar_state().
+    """
+
+    def __init__(self, tokenizer, eos_token_ids):
+        self.eos_token_ids = sorted(eos_token_ids)
+        alphabet = set(COORDINATE_PREFIX + "0123456789.,) ")
+        self.candidates = []
+        for token_id in range(len(tokenizer)):
+            piece = tokenizer.decode([token_id])
+            if piece and set(piece) <= alphabet:
+                self.candidates.append((token_id, piece))
+        self.allowed = {}
+
+    def allowed_token_ids(self, text):
+        """Token ids that keep `text` (the answer so far) inside the grammar"""
+        text = text.lstrip()
+        if coordinate_prefix_state(text) != PARTIAL:
+            # Nothing can follow a complete answer, and appending never repairs an invalid one
+            return self.eos_token_ids
+        key = grammar_state(text)
+        allowed = self.allowed.get(key)
+        if allowed is None:
+            allowed = self.allowed[key] = self._allowed(key)
+        return allowed
+
+    def _allowed(self, text):
+        allowed = [
+            token_id for token_id, piece in self.candidates
+            if coordinate_prefix_state((text + piece).lstrip()) != INVALID
+        ]
+        return allowed or self.eos_token_ids
+
+
+_grammars = {}
+_grammars_lock = threading.Lock()
+
+
+def get_grammar(tokenizer, eos_token_ids):
+    with _grammars_lock:
+        grammar = _grammars.get(id(tokenizer))
+        if grammar is None:
+            grammar = _grammars[id(tokenizer)] = CoordinateGrammar(tokenizer, eos_token_ids)
+        return grammar
+
+
+def constrain_logits(logits, allowed_token_ids):
+    """Set every logit outside allowed_token_ids to -inf (one row)"""
+    masked = torch.full_like(logits, float("-inf"))
+    index = torch.tensor(allowed_token_ids, device=logits.device)
+    masked[index] = logits[index]
+    return masked
+
+
+class CoordinateDecoding:
+    """Early stopping and constrained decoding for the rows of one generate() call
+
+    modes has one entry per batch row (see COORDINATE_MODES). After generate()
+    returns, `stopped` maps each row that was cut short to the number of
+    tokens it generated.
+    """
+
+    def __init__(self, tokenizer, modes, max_new_tokens, eos_token_ids):
+        self.tokenizer = tokenizer
+        self.modes = list(modes)
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_ids = eos_token_ids
+        self.prompt_length = None
+        self.stopped = {}
+
+    def _answer(self, input_ids, row):
+        return self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True)
+
+    def generate_kwargs(self, prompt_length):
+        self.prompt_length = prompt_length
+        kwargs = {"stopping_criteria": StoppingCriteriaList([_CoordinateStoppingCriteria(self)])}
+        if "constrained" in self.modes:
+            grammar = get_grammar(self.tokenizer, self.eos_token_ids)
+            kwargs["logits_processor"] = LogitsProcessorList([_CoordinateLogitsProcessor(self, grammar)])
+        return kwargs
+
+    def tokens_saved(self):
+        """Decoding budget (max_new_tokens) left unused by the rows that stopped early"""
+        return sum(self.max_new_tokens - generated for generated in self.stopped.values())
+
+
+class _CoordinateStoppingCriteria(StoppingCriteria):
+    def __init__(self, decoding):
+        self.decoding = decoding
+
+    def __call__(self, input_ids, scores, **kwargs):
+        decoding = self.decoding
+        done = []
+        for row, mode in enumerate(decoding.modes):
+            stop = row in decoding.stopped
+            if mode is not None and not stop and has_complete_coordinate(decoding._answer(input_ids, row)):
+                decoding.stopped[row] = input_ids.shape[-1] - decoding.prompt_length
+                stop = True
+            done.append(stop)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class _CoordinateLogitsProcessor(LogitsProcessor):
+    def __init__(self, decoding, grammar):
+        self.decoding = decoding
+        self.grammar = grammar
+
+    def __call__(self, input_ids, scores):
+        for row, mode in enumerate(self.decoding.modes):
+            if mode == "constrained" and row not in self.decoding.stopped:
+                allowed = self.grammar.allowed_token_ids(self.decoding._answer(input_ids, row))
+                scores[row] = constrain_logits(scores[row], allowed)
+        return scores
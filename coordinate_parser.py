@@ -0,0 +1,290 @@
+import math
+import random
+import re
+import time
+
+# Coordinates out of model answers, for the server, the desktop and web apps,
+# the pipeline and the evaluation scripts. One precompiled pattern finds every
+# coordinate tuple in a single pass over the text:
+#   Coordinate: (0.52, 0.31)            Magma's own format, also "Coordinates:"
+#   (0.1, 0.2, 0.3, 0.4)  [0.1, 0.2]    bare tuples in parentheses or brackets
+#   <point>0.52 0.31</point>            tags, also <box>(120,340),(560,780)</box>
+#                                       whose values are on a 0-1000 grid
+# Numbers may be signed or in scientific notation; tuples must have 2 or 4
+# values, and only ones inside the image (0 <= value <= 1, x_min <= x_max,
+# y_min <= y_max) count unless validate=False.
+#
+#   python coordinate_parser.py              # micro-benchmark against the old two-regex parser
+#   python coordinate_parser.py --fuzz 100000
+
+# Tuples are matched as a run of number characters and split/converted with
+# float(), which rejects malformed numbers; a pattern that spelled out every
+# number would be several times slower for the same answers. One leading
+# character class keeps the scan fast: the label is looked for behind a match
+# instead of being part of the pattern.
+COORDINATE_PATTERN = re.compile(
+    r"[(\[<](?:([-+\d.eE,\s]{3,100})[)\]]|((?i:box|bbox|point))>([^<]{0,100})</\2>)")
+# Fast path for Magma's own answer, "...text... Coordinate: (x, y[, x, y])":
+# anchored, and only when nothing before it could start a tuple, so the match
+# is the one COORDINATE_PATTERN would find first (and, being labelled, pick)
+ANSWER_PATTERN = re.compile(
+    r"[^(\[<]*Coordinate: \(([\d.]{1,20}), ([\d.]{1,20})(?:, ([\d.]{1,20}), ([\d.]{1,20}))?\)")
+NUMBER_PATTERN = re.compile(r"[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?")
+LABEL = "oordinate"  # Coordinate:, coordinates =, ...
+
+# Tag coordinates above 1 are on this grid (Qwen-VL and Kosmos style)
+TAG_GRID = 1000.0
+
+
+def _coords(text, match):
+    """(values, labelled) of a pattern match; values is None if malformed"""
+    body = match.group(1)
+    if body is not None:
+        if text[match.start()] + text[match.end() - 1] not in ("()", "[]"):
+            return None, False
+        try:
+            values = tuple(map(float, body.split(",")))
+        except ValueError:
+            return None, False
+        # "Coordinate: (" or "coordinates = [" just before the tuple
+        before = text[max(0, match.start() - 16):match.start()].rstrip()
+        return values, before[-1:] in (":", "=") and LABEL in before
+    values = tuple(float(value) for value in NUMBER_PATTERN.findall(match.group(3)))
+    if values and 1 < max(values) <= TAG_GRID:
+        values = tuple(value / TAG_GRID for value in values)
+    return values, True
+
+
+def valid(coords):
+    """Normalized point or box that lies inside the image"""
+    if len(coords) not in (2, 4):
+        return False
+    for value in coords:
+        if not 0.0 <= value <= 1.0:  # also rejects nan
+            return False
+    return len(coords) == 2 or (coords[0] <= coords[2] and coords[1] <= coords[3])
+
+
+def find_coordinates(text, validate=True):
+    """Every coordinate tuple in text, in order: [{'type', 'coords', 'labelled', 'span'}]
+
+    'labelled' marks "Coordinate: (...)" and tagged tuples, which callers
+    prefer over bare ones.
+    """
+    found = []
+    if not text:
+        return found
+    for match in COORDINATE_PATTERN.finditer(text):
+        coords, labelled = _coords(text, match)
+        if coords is None or len(coords) not in (2, 4) or (validate and not valid(coords)):
+            continue
+        found.append({
+            'type': 'bbox' if len(coords) == 4 else 'point',
+            'coords': coords,
+            'labelled': labelled,
+            'span': match.span(),
+        })
+    return found
+
+
+def extract_coordinates(text, validate=True):
+    """{'type': 'bbox' | 'point', 'coords': (...)} of the answer's coordinate, else None
+
+    The first labelled tuple wins, else the first bare one.
+    """
+    best = None
+    if not text:
+        return None
+    match = ANSWER_PATTERN.match(text)
+    if match:
+        try:
+            coords = tuple(float(value) for value in match.groups() if value is not None)
+        except ValueError:
+            coords = None
+        if coords is not None and (not validate or valid(coords)):
+            return {'type': 'bbox' if len(coords) == 4 else 'point', 'coords': coords}
+    for match in COORDINATE_PATTERN.finditer(text):
+        coords, labelled = _coords(text, match)
+        if coords is None or len(coords) not in (2, 4) or (validate and not valid(coords)):
+            continue
+        if labelled:
+            best = coords
+            break
+        if best is None:
+            best = coords
+    if best is None:
+        return None
+    return {'type': 'bbox' if len(best) == 4 else 'point', 'coords': best}
+
+
+def parse_coordinates(text, validate=True):
+    """(x, y) or (x_min, y_min, x_max, y_max) of the answer's coordinate, else None"""
+    found = extract_coordinates(text, validate)
+    return found['coords'] if found else None
+
+
+# Inputs with known answers, and seeds for the fuzzer
+CORPUS = [
+    ("Coordinate: (0.52, 0.31)", (0.52, 0.31)),
+    ("Coordinate: (0.1, 0.2, 0.3, 0.4)", (0.1, 0.2, 0.3, 0.4)),
+    ("The button is here. Coordinate: (0.5, 0.5) Done.", (0.5, 0.5)),
+    ("coordinates: [0.25, 0.75]", (0.25, 0.75)),
+    ("Coordinate=(1, 0)", (1.0, 0.0)),
+    ("Coordinate: (.5, 5e-1)", (0.5, 0.5)),
+    ("Coordinate: (+0.5, 2.5E-1)", (0.5, 0.25)),
+    ("Coordinate: ( 0.5 ,0.5 )", (0.5, 0.5)),
+    ("(0.1, 0.2, 0.3, 0.4)", (0.1, 0.2, 0.3, 0.4)),
+    ("[0.9, 0.1]", (0.9, 0.1)),
+    ("see (2, 3) then Coordinate: (0.2, 0.3)", (0.2, 0.3)),
+    ("(0.7, 0.8) or (0.2, 0.3)", (0.7, 0.8)),
+    ("<point>0.52 0.31</point>", (0.52, 0.31)),
+    ("<box>(120,340),(560,780)</box>", (0.12, 0.34, 0.56, 0.78)),
+    ("<BOX>0.1, 0.2, 0.3, 0.4</BOX>", (0.1, 0.2, 0.3, 0.4)),
+    ("Coordinate: (-0.1, 0.5)", None),
+    ("Coordinate: (0.5, 1.5)", None),
+    ("Coordinate: (0.6, 0.2, 0.3, 0.4)", None),
+    ("Coordinate: (0.1, 0.2, 0.3)", None),
+    ("Coordinate: (0.1, 0.2", None),
+    ("Coordinate: (0.1, 0.2]", None),
+    ("Coordinate: (nan, 0.2)", None),
+    ("Coordinate: (0.5.5, 0.2)", None),
+    ("Coordinate: (1e400, 0.2)", None),
+    ("<box>1200 50 1300 60</box>", None),
+    ("No coordinate here.", None),
+    ("", None),
+]
+
+
+def legacy_extract_coordinates(text):
+    """The parser this module replaced, kept for the benchmark"""
+    match = re.search(r"Coordinate: \(([0-9.]+), ([0-9.]+), ([0-9.]+), ([0-9.]+)\)", text)
+    if match:
+        try:
+            return {'type': 'bbox', 'coords': tuple(float(v) for v in match.groups())}
+        except ValueError:
+            return None
+    match = re.search(r"Coordinate: \(([0-9.]+), ([0-9.]+)\)", text)
+    if match:
+        try:
+            return {'type': 'point', 'coords': tuple(float(v) for v in match.groups())}
+        except ValueError:
+            return None
+    return None
+
+
+def check_corpus():
+    failures = []
+    for text, expected in CORPUS:
+        actual = parse_coordinates(text)
+        if actual is None or expected is None:
+            ok = actual is expected
+        else:
+            ok = len(actual) == len(expected) and all(math.isclose(a, b) for a, b in zip(actual, expected))
+        if not ok:
+            failures.append((text, expected, actual))
+    return failures
+
+
+_ALPHABET = "0123456789.,-+eE ()[]<>/:=Coordinate boxpint\n"
+
+
+def mutate(text, rng):
+    """text with a few random character insertions, deletions and replacements"""
+    chars = list(text)
+    for _ in range(rng.randint(1, 4)):
+        op = rng.random()
+        position = rng.randint(0, len(chars))
+        if op < 0.4 or not chars:
+            chars.insert(position, rng.choice(_ALPHABET))
+        elif op < 0.7:
+            del chars[min(position, len(chars) - 1)]
+        else:
+            chars[min(position, len(chars) - 1)] = rng.choice(_ALPHABET)
+    return "".join(chars)
+
+
+def random_answer(rng):
+    """A well-formed answer with random in-range values, and those values"""
+    coords = [round(rng.random(), rng.randint(0, 6)) for _ in range(rng.choice((2, 4)))]
+    if len(coords) == 4:
+        coords = [min(coords[0], coords[2]), min(coords[1], coords[3]),
+                  max(coords[0], coords[2]), max(coords[1], coords[3])]
+    body = ", ".join(rng.choice(("{:g}", "{:.6f}", "{:e}")).format(value) for value in coords)
+    template = rng.choice(("Coordinate: ({})", "Sure. Coordinate: ({}) ", "[{}]", "coordinates = ({})"))
+    return template.format(body), tuple(coords)
+
+
+def fuzz(cases, seed=0):
+    """Parse mutated and random answers; returns a list of (text, problem)
+
+    Checked: the parser never raises, whatever it returns is valid, and
+    well-formed answers parse back to their values.
+    """
+    rng = random.Random(seed)
+    seeds = [text for text, _ in CORPUS if text]
+    problems = []
+    for _ in range(cases):
+        answer, expected = random_answer(rng)
+        try:
+            parsed = parse_coordinates(answer)
+        except Exception as e:
+            problems.append((answer, f"raised {e!r}"))
+            continue
+        if parsed is None or not all(math.isclose(a, b, abs_tol=1e-9) for a, b in zip(parsed, expected)):
+            problems.append((answer, f"parsed {parsed}, expected {expected}"))
+        text = mutate(rng.choice(seeds + [answer]), rng)
+        try:
+            found = find_coordinates(text)
+        except Exception as e:
+            problems.append((text, f"raised {e!r}"))
+            continue
+        for item in found:
+            if not valid(item['coords']):
+                problems.append((text, f"invalid result {item['coords']}"))
+    return problems
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark and fuzz the coordinate parser")
+    parser.add_argument("--answers", type=int, default=200_000, help="answers per benchmark run")
+    parser.add_argument("--fuzz", type=int, default=0, help="fuzz this many cases instead of benchmarking")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    failures = check_corpus()
+    for text, expected, actual in failures:
+        print(f"corpus: {text!r}: expected {expected}, got {actual}")
+    print(f"corpus: {len(CORPUS) - len(failures)}/{len(CORPUS)} ok")
+    if args.fuzz:
+        problems = fuzz(args.fuzz, args.seed)
+        for text, problem in problems[:20]:
+            print(f"fuzz: {text!r}: {problem}")
+        print(f"fuzz: {args.fuzz} cases, {len(problems)} problems")
+        return
+
+    rng = random.Random(args.seed)
+    # Typical model output: a sentence and a Coordinate: (...) the old parser
+    # also reads, one answer in ten without a coordinate
+    answers = []
+    for i in range(args.answers):
+        coords = [rng.random() for _ in range(2 if i % 3 else 4)]
+        if len(coords) == 4:
+            coords = [min(coords[0], coords[2]), min(coords[1], coords[3]),
+                      max(coords[0], coords[2]), max(coords[1], coords[3])]
+        answer = "Coordinate: (" + ", ".join(f"{value:.3f}" for value in coords) + ")"
+        answers.append(f"The element is the blue button. {answer}" if i % 10 else "I could not find that element.")
+    for name, function in (("two regexes", legacy_extract_coordinates), ("coordinate_parser", extract_coordinates)):
+        started = time.perf_counter()
+        hits = sum(1 for answer in answers if function(answer) is not None)
+        seconds = time.perf_counter() - started
+        print(f"{name:>18}: {seconds / len(answers) * 1e6:6.2f} us/answer, "
+              f"{len(answers) / seconds:10,.0f} answers/s, {hits} with coordinates")
+    # Formats only the new parser reads: brackets, tags, scientific notation
+    others = [random_answer(rng)[0] for _ in range(args.answers // 10)]
+    print(f"other formats: old parser reads {sum(1 for a in others if legacy_extract_coordinates(a))}, "
+          f"new {sum(1 for a in others if extract_coordinates(a))} of {len(others)}")
+
+if __name__ == "__main__":
+    main()
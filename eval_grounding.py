@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageDraw
+
+from coordinate_parser import parse_coordinates
+from fast_loader import peak_rss_mb
+
+# Offline grounding benchmark: runs a local dataset of (screenshot,
+# instruction, target box) through magma_gradio.generate_response in this
+# process - the same scheduler, caches and parsing the server uses - from
+# several threads at once, and reports accuracy (point-in-box, IoU) next to
+# latency percentiles, tokens/s, images/s and peak memory.
+#   python eval_grounding.py data/grounding.jsonl --concurrency 8 --batch-size 8
+#   python eval_grounding.py data/grounding.jsonl --scheduler continuous --output report.json
+#   python eval_grounding.py --tiny                  # stand-in model on CPU, synthetic screenshots
+# Each line of the dataset is {"image": "shot.png", "instruction": "...",
+# "box": [x_min, y_min, x_max, y_max]}, with the image path relative to the
+# file and the box normalized (or in pixels, when any value is above 1).
+
+SYSTEM_PROMPT = "You are agent that can see, talk and act."
+SCHEDULERS = ("oneshot", "static", "continuous")
+
+
+def load_dataset(path):
+    """[{'name', 'image', 'instruction', 'box'}] with normalized target boxes"""
+    root = os.path.dirname(os.path.abspath(path))
+    samples = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            image = Image.open(os.path.join(root, record["image"])).convert("RGB")
+            box = [float(value) for value in record["box"]]
+            if len(box) != 4:
+                raise ValueError(f"{path}:{line_number}: box needs 4 values, got {record['box']}")
+            if max(box) > 1:
+                width, height = image.size
+                box = [box[0] / width, box[1] / height, box[2] / width, box[3] / height]
+            samples.append({"name": record["image"], "image": image,
+                            "instruction": record["instruction"], "box": tuple(box)})
+    if not samples:
+        raise ValueError(f"No samples in {path}")
+    return samples
+
+
+def synthetic_dataset(count=16, size=(320, 240)):
+    """Plain pages with one coloured button each, and that button as the target"""
+    width, height = size
+    samples = []
+    for i in range(count):
+        image = Image.new("RGB", size, "white")
+        x, y = 20 + 31 * i % 200, 30 + 17 * i % 150
+        ImageDraw.Draw(image).rectangle([x, y, x + 80, y + 30], fill=(40 + 10 * i % 200, 120, 220 - 7 * i % 200))
+        samples.append({"name": f"synthetic_{i}", "image": image,
+                        "instruction": "Find the button in this image and give me its coordinates.",
+                        "box": (x / width, y / height, (x + 80) / width, (y + 30) / height)})
+    return samples
+
+
+def iou(a, b):
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def score(coords, box):
+    """{'hit', 'iou'} of a predicted point or box against the target box"""
+    if coords is None:
+        return {"hit": False, "iou": None}
+    x, y = ((coords[0] + coords[2]) / 2, (coords[1] + coords[3]) / 2) if len(coords) == 4 else coords
+    return {
+        "hit": box[0] <= x <= box[2] and box[1] <= y <= box[3],
+        "iou": round(iou(coords, box), 4) if len(coords) == 4 else None,
+    }
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summarize(results, seconds, tokens):
+    """Accuracy, latency and throughput of a run"""
+    latencies = [result["seconds"] for result in results if result["error"] is None]
+    ious = [result["iou"] for result in results if result["iou"] is not None]
+    count = len(results)
+    summary = {
+        "samples": count,
+        "errors": sum(1 for result in results if result["error"] is not None),
+        "with_coordinates": sum(1 for result in results if result["coords"] is not None),
+        "rejected_coordinates": sum(1 for result in results if result["rejected"]),
+        "point_in_box": round(sum(1 for result in results if result["hit"]) / count, 4) if count else None,
+        "boxes_predicted": len(ious),
+        "mean_iou": round(sum(ious) / len(ious), 4) if ious else None,
+        "iou_at_0.5": round(sum(1 for value in ious if value >= 0.5) / count, 4) if count else None,
+        "seconds": round(seconds, 2),
+        "images_per_second": round(count / seconds, 2) if seconds else None,
+        "tokens_per_second": round(tokens / seconds, 1) if seconds else None,
+        "peak_rss_mb": round(peak_rss_mb()),
+    }
+    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        value = percentile(latencies, fraction)
+        summary[f"latency_{name}_ms"] = round(value * 1000, 1) if value is not None else None
+    try:
+        import torch
+        if torch.cuda.is_available():
+            summary["peak_cuda_mb"] = round(torch.cuda.max_memory_allocated() / 1024 ** 2)
+    except ImportError:
+        pass
+    return summary
+
+
+def configure(args):
+    """Scheduler settings for magma_gradio, which reads them when it is imported"""
+    os.environ["MAGMA_SCHEDULER"] = args.scheduler
+    os.environ["MAGMA_MAX_BATCH_SIZE"] = str(args.batch_size)
+    os.environ["MAGMA_BATCH_WINDOW_MS"] = str(args.batch_window_ms)
+    os.environ["MAGMA_MODEL_ID"] = args.model
+    if "magma_gradio" in sys.modules:
+        raise RuntimeError("magma_gradio was imported before the evaluation configured it")
+    import magma_gradio
+    if args.tiny:
+        from tiny_magma import load_tiny_magma
+        magma_gradio.global_model, magma_gradio.global_processor = load_tiny_magma()
+        magma_gradio.set_load_state(status="ready", progress=1.0)
+    return magma_gradio
+
+
+def run(server, samples, args):
+    """Every sample through server.generate_response, args.concurrency at a time"""
+    _, processor = server.load_model()
+    tokens = 0
+    tokens_lock = threading.Lock()
+
+    def evaluate(sample):
+        nonlocal tokens
+        started = time.perf_counter()
+        try:
+            history, _ = server.generate_response(
+                sample["image"], SYSTEM_PROMPT, sample["instruction"], [],
+                args.max_new_tokens, 0.0, False, 1,
+                stop_at_coordinate=args.coordinate_mode == "stop",
+                constrain_coordinate=args.coordinate_mode == "constrained",
+                tile_grid=args.tile_grid,
+            )
+            answer, error = history[-1][1], None
+        except Exception as e:
+            answer, error = "", str(e)
+        seconds = time.perf_counter() - started
+        count = len(processor.tokenizer.encode(answer)) if answer else 0
+        with tokens_lock:
+            tokens += count
+        coords = parse_coordinates(answer)
+        # A coordinate outside the image (or an unordered box) counts as no answer
+        rejected = coords is None and parse_coordinates(answer, validate=False) is not None
+        return dict({"name": sample["name"], "answer": answer, "coords": coords, "rejected": rejected,
+                     "target": sample["box"], "seconds": round(seconds, 4), "tokens": count, "error": error},
+                    **score(coords, sample["box"]))
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        # Warm-up requests (first batch, caches, lazily built kernels) are not measured
+        list(pool.map(evaluate, samples[:args.warmup]))
+        tokens = 0
+        started = time.perf_counter()
+        results = list(pool.map(evaluate, samples * args.repeat))
+        seconds = time.perf_counter() - started
+    return results, seconds, tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline grounding accuracy and throughput benchmark")
+    parser.add_argument("dataset", nargs="?", help="JSONL of {image, instruction, box}")
+    parser.add_argument("--model", default=os.environ.get("MAGMA_MODEL_ID", "microsoft/Magma-8B"))
+    parser.add_argument("--tiny", action="store_true", help="tiny stand-in model on CPU")
+    parser.add_argument("--synthetic", type=int, default=16, help="synthetic samples when no dataset is given")
+    parser.add_argument("--scheduler", default=os.environ.get("MAGMA_SCHEDULER", "static"), choices=SCHEDULERS)
+    parser.add_argument("--batch-size", type=int, default=8, help="max requests per batch (static/continuous)")
+    parser.add_argument("--batch-window-ms", type=float, default=20)
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--coordinate-mode", default="stop", choices=("off", "stop", "constrained"))
+    parser.add_argument("--tile-grid", default="off", help='"off", "auto" or COLSxROWS')
+    parser.add_argument("--warmup", type=int, default=2, help="unmeasured requests before the run")
+    parser.add_argument("--repeat", type=int, default=1, help="run the dataset this many times")
+    parser.add_argument("--output", help="write the summary and per-sample results here")
+    args = parser.parse_args()
+
+    if args.dataset:
+        samples = load_dataset(args.dataset)
+    elif args.tiny:
+        samples = synthetic_dataset(args.synthetic)
+    else:
+        parser.error("dataset is required unless --tiny is given")
+
+    server = configure(args)
+    try:
+        results, seconds, tokens = run(server, samples, args)
+    finally:
+        if server.global_generator is not None:
+            server.global_generator.stop()
+    summary = summarize(results, seconds, tokens)
+    summary["config"] = {key: getattr(args, key) for key in
+                         ("scheduler", "batch_size", "concurrency", "max_new_tokens", "coordinate_mode", "tile_grid")}
+    summary["config"]["model"] = "tiny" if args.tiny else args.model
+
+    config = summary["config"]
+    print(f"{summary['samples']} samples, {config['scheduler']} scheduler, batch {config['batch_size']}, "
+          f"concurrency {config['concurrency']}")
+    print(f"  accuracy   point-in-box {summary['point_in_box']:.1%}, "
+          f"mean IoU {'n/a' if summary['mean_iou'] is None else summary['mean_iou']} "
+          f"({summary['boxes_predicted']} boxes), {summary['with_coordinates']} answers with coordinates, "
+          f"{summary['rejected_coordinates']} outside the image, {summary['errors']} errors")
+    print(f"  latency    p50 {summary['latency_p50_ms']} ms, p90 {summary['latency_p90_ms']} ms, "
+          f"p99 {summary['latency_p99_ms']} ms")
+    print(f"  throughput {summary['images_per_second']} images/s, {summary['tokens_per_second']} tokens/s "
+          f"over {summary['seconds']} s")
+    print(f"  memory     peak RSS {summary['peak_rss_mb']} MB"
+          + (f", peak CUDA {summary['peak_cuda_mb']} MB" if "peak_cuda_mb" in summary else ""))
+    print(f"Scheduler: {server.scheduler_stats()}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"summary": summary, "results": results}, f, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+import torch
+from safetensors import safe_open
+from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+
+# Streaming loader for safetensors checkpoints.
+# from_pretrained() followed by model.to(device) first materialises the whole
+# model in CPU RAM and then copies it. Here the model skeleton is built on the
+# meta device (no memory), each shard is memory-mapped and its tensors are
+# placed straight onto the target device/dtype, so peak host memory stays
+# around one shard instead of the full model.
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS reports bytes
+    return peak / (1024 ** 2) if sys.platform == "darwin" else peak / 1024
+
+
+def current_rss_mb():
+    """Current resident set size in MB (Linux only, None elsewhere)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError):
+        return None
+
+
+@contextlib.contextmanager
+def empty_weights():
+    """Create parameters on the meta device while building a model
+
+    Buffers are still created for real: non-persistent ones (e.g. rotary
+    inv_freq) are not stored in the checkpoint.
+    """
+    original_register = torch.nn.Module.register_parameter
+
+    def register_meta_parameter(module, name, param):
+        original_register(module, name, param)
+        if param is not None:
+            module._parameters[name] = torch.nn.Parameter(
+                module._parameters[name].to("meta"), requires_grad=param.requires_grad
+            )
+
+    torch.nn.Module.register_parameter = register_meta_parameter
+    try:
+        yield
+    finally:
+        torch.nn.Module.register_parameter = original_register
+
+
+def resolve_checkpoint(model_id):
+    """Local checkpoint directory for a path or Hugging Face model id"""
+    if os.path.isdir(model_id):
+        return model_id
+    from huggingface_hub import snapshot_download
+    return snapshot_download(model_id, allow_patterns=["*.json", "*.safetensors", "*.py", "*.model", "*.txt"])
+
+
+def list_shards(checkpoint_dir):
+    """Safetensors shard file names, in index order"""
+    index_path = os.path.join(checkpoint_dir, "model.safetensors.index.json")
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            weight_map = json.load(f)["weight_map"]
+        return sorted(set(weight_map.values()))
+    if os.path.exists(os.path.join(checkpoint_dir, "model.safetensors")):
+        return ["model.safetensors"]
+    raise FileNotFoundError(f"No safetensors checkpoint found in {checkpoint_dir}")
+
+
+def set_module_tensor(model, name, tensor):
+    """Replace the parameter or buffer called `name` with `tensor`"""
+    module_path, _, attr = name.rpartition(".")
+    module = model.get_submodule(module_path) if module_path else model
+    if attr in module._parameters:
+        module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+    elif attr in module._buffers:
+        module._buffers[attr] = tensor
+    else:
+        raise KeyError(name)
+
+
+def _checkpoint_key_mapper(model, expected):
+    """Map checkpoint tensor names onto the model's (handles a missing/extra base-model prefix)"""
+    prefix = getattr(model, "base_model_prefix", "") or ""
+
+    def map_key(key):
+        if key in expected:
+            return key
+        if prefix and f"{prefix}.{key}" in expected:
+            return f"{prefix}.{key}"
+        if prefix and key.startswith(prefix + ".") and key[len(prefix) + 1:] in expected:
+            return key[len(prefix) + 1:]
+        return None
+
+    return map_key
+
+
+def load_model_streaming(model_id, device="cpu", dtype=None, trust_remote_code=True,
+                         model_class=None, on_shard=None):
+    """Load a causal LM shard by shard from memory-mapped safetensors
+
+    Returns (model, report). The report has per-shard timings plus total time
+    and peak RSS. on_shard(index, total, shard_report) is called after every
+    shard, e.g. to publish load progress.
+    """
+    started = time.monotonic()
+    device = torch.device(device)
+    dtype = dtype or torch.get_default_dtype()
+    checkpoint_dir = resolve_checkpoint(model_id)
+    config = AutoConfig.from_pretrained(checkpoint_dir, trust_remote_code=trust_remote_code)
+
+    with empty_weights():
+        if model_class is not None:
+            model = model_class(config)
+        else:
+            model = AutoModelForCausalLM.from_config(config, trust_remote_code=trust_remote_code)
+
+    expected = set(model.state_dict().keys())
+    map_key = _checkpoint_key_mapper(model, expected)
+    # safetensors can read straight into CUDA memory; other devices go through the mmap'd CPU view
+    open_device = str(device) if device.type == "cuda" else "cpu"
+
+    shards = list_shards(checkpoint_dir)
+    report = {"checkpoint": checkpoint_dir, "device": str(device), "dtype": str(dtype), "shards": []}
+    loaded = set()
+    unexpected = []
+    for index, shard in enumerate(shards):
+        shard_started = time.monotonic()
+        num_bytes = 0
+        with safe_open(os.path.join(checkpoint_dir, shard), framework="pt", device=open_device) as f:
+            for key in f.keys():
+                name = map_key(key)
+                if name is None:
+                    unexpected.append(key)
+                    continue
+                tensor = f.get_tensor(key)
+                if tensor.is_floating_point():
+                    tensor = tensor.to(device=device, dtype=dtype)
+                else:
+                    tensor = tensor.to(device)
+                set_module_tensor(model, name, tensor)
+                loaded.add(name)
+                num_bytes += tensor.numel() * tensor.element_size()
+        shard_report = {
+            "shard": shard,
+            "bytes": num_bytes,
+            "seconds": round(time.monotonic() - shard_started, 3),
+            "rss_mb": current_rss_mb(),
+        }
+        report["shards"].append(shard_report)
+        if on_shard is not None:
+            on_shard(index, len(shards), shard_report)
+
+    model.tie_weights()
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise RuntimeError(f"Checkpoint is missing {len(missing)} weights, e.g. {missing[:5]}")
+
+    # Buffers that are not in the checkpoint were built on the CPU
+    for module in model.modules():
+        for name, buffer in module._buffers.items():
+            if buffer is not None and buffer.device != device:
+                module._buffers[name] = buffer.to(device)
+
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(checkpoint_dir)
+    except OSError:
+        pass
+    model.eval()
+
+    report["unexpected_keys"] = unexpected
+    report["total_seconds"] = round(time.monotonic() - started, 3)
+    report["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    return model, report
+
+
+def load_model(model_id, device="cpu", dtype=None, on_shard=None):
+    """Streaming load, falling back to from_pretrained + .to(device) if it fails
+
+    Returns (model, report); report is None when the fallback was used.
+    """
+    try:
+        return load_model_streaming(model_id, device=device, dtype=dtype, on_shard=on_shard)
+    except Exception as e:
+        # e.g. remote-code modules that cannot be built on the meta device
+        print(f"Streaming load failed ({e}), falling back to from_pretrained")
+    model = AutoModelForCausalLM.from_pretrained(model_id, trust_remote_code=True, torch_dtype=dtype)
+    model.to(device)
+    model.eval()
+    return model, None
+
+
+def print_load_report(report):
+    for shard in report["shards"]:
+        rss = f"{shard['rss_mb']:.0f} MB" if shard["rss_mb"] is not None else "n/a"
+        print(f"  {shard['shard']}: {shard['bytes'] / 1024 ** 2:.1f} MB in {shard['seconds']:.2f}s (rss {rss})")
+    print(f"Loaded {len(report['shards'])} shards in {report['total_seconds']:.2f}s, "
+          f"peak RSS {report['peak_rss_mb']:.0f} MB")
+    if report["unexpected_keys"]:
+        print(f"Skipped {len(report['unexpected_keys'])} unexpected checkpoint tensors")
+
+
+if __name__ == "__main__":
+    # Cold-start comparison against from_pretrained + .to(device). Each loader runs
+    # in a fresh process so peak RSS is measured independently.
+    #   python fast_loader.py --make-tiny /tmp/tiny_magma     # write a small sharded checkpoint
+    #   python fast_loader.py /tmp/tiny_magma --tiny          # compare both loaders on it
+    #   python fast_loader.py microsoft/Magma-8B --device cuda
+    import argparse
+    import subprocess
+
+    parser = argparse.ArgumentParser(description="Measure cold-start time and peak memory of model loading")
+    parser.add_argument("model", nargs="?", default="microsoft/Magma-8B")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dtype", default=None, help="e.g. float32, bfloat16, float16")
+    parser.add_argument("--tiny", action="store_true", help="the checkpoint was written by --make-tiny")
+    parser.add_argument("--make-tiny", metavar="DIR", help="save a sharded tiny stand-in checkpoint to DIR")
+    parser.add_argument("--loader", choices=["streaming", "from_pretrained"], help="run a single loader")
+    args = parser.parse_args()
+
+    if args.make_tiny:
+        from tiny_magma import load_tiny_magma
+        tiny_model, _ = load_tiny_magma(hidden_size=512, num_layers=8)
+        tiny_model.save_pretrained(args.make_tiny, max_shard_size="8MB", safe_serialization=True)
+        print(f"Saved tiny checkpoint to {args.make_tiny}")
+        sys.exit(0)
+
+    dtype = getattr(torch, args.dtype) if args.dtype else None
+    model_class = None
+    if args.tiny:
+        from tiny_magma import TinyMagmaForCausalLM
+        model_class = TinyMagmaForCausalLM
+
+    if args.loader == "streaming":
+        model, report = load_model_streaming(args.model, device=args.device, dtype=dtype, model_class=model_class)
+        print_load_report(report)
+    elif args.loader == "from_pretrained":
+        started = time.monotonic()
+        loader = model_class or AutoModelForCausalLM
+        model = loader.from_pretrained(args.model, trust_remote_code=True, torch_dtype=dtype)
+        model.to(args.device)
+        print(f"from_pretrained + .to({args.device}): {time.monotonic() - started:.2f}s, "
+              f"peak RSS {peak_rss_mb():.0f} MB")
+    else:
+        for loader in ["from_pretrained", "streaming"]:
+            print(f"== {loader}")
+            command = [sys.executable, __file__, args.model, "--device", args.device, "--loader", loader]
+            if args.dtype:
+                command += ["--dtype", args.dtype]
+            if args.tiny:
+                command.append("--tiny")
+            subprocess.run(command, check=True)
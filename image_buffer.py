@@ -0,0 +1,164 @@
+import io
+import os
+import threading
+import time
+
+# In-memory screenshot handoff. The PNG bytes from get_screenshot_as_png() are
+# kept in one buffer and handed to PIL, Qt and the model client from there:
+# each consumer decodes straight from memory, at most once per buffer, and
+# nothing touches the disk unless archiving is asked for (MAGMA_ARCHIVE_DIR).
+
+# When set, captured and result screenshots are also written here
+ARCHIVE_DIR = os.environ.get("MAGMA_ARCHIVE_DIR")
+
+
+class ImageStats:
+    """Encode/decode/disk-write counters for one request (thread-safe)"""
+
+    def __init__(self, label="request"):
+        self.label = label
+        self.lock = threading.Lock()
+        self.counters = {
+            "captures": 0,
+            "encodes": 0,
+            "decodes": 0,
+            "disk_writes": 0,
+            "bytes_captured": 0,
+            "bytes_written": 0,
+            "encode_seconds": 0.0,
+            "decode_seconds": 0.0,
+        }
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+        if self is not TOTALS:
+            TOTALS.count(name, amount)
+
+    def as_dict(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["encode_seconds"] = round(stats["encode_seconds"], 4)
+        stats["decode_seconds"] = round(stats["decode_seconds"], 4)
+        return stats
+
+    def __str__(self):
+        s = self.as_dict()
+        return (f"{self.label}: {s['captures']} captures, {s['encodes']} encodes, {s['decodes']} decodes, "
+                f"{s['disk_writes']} disk writes ({s['bytes_captured'] / 1024:.0f} KB captured)")
+
+
+# Process-wide totals of every ImageStats
+TOTALS = ImageStats("total")
+
+
+class ImageBuffer:
+    """An encoded image (PNG bytes) shared by the GUI, PIL and the model client
+
+    pil() and qimage() decode lazily and cache the result; pil() returns the
+    shared decoded image, so copy it before drawing on it.
+    """
+
+    def __init__(self, data, stats=None, name="screenshot"):
+        self.data = data
+        self.stats = stats or ImageStats()
+        self.name = name
+        self.lock = threading.Lock()
+        self._pil = None
+        self._qimage = None
+
+    @classmethod
+    def from_driver(cls, driver, stats=None, name="screenshot"):
+        """Screenshot of the current page, kept as the PNG bytes the browser produced"""
+        buffer = cls(driver.get_screenshot_as_png(), stats, name)
+        buffer.stats.count("captures")
+        buffer.stats.count("bytes_captured", len(buffer.data))
+        return buffer
+
+    @classmethod
+    def from_file(cls, path, stats=None):
+        with open(path, "rb") as f:
+            return cls(f.read(), stats, os.path.basename(path))
+
+    @classmethod
+    def from_pil(cls, image, stats=None, name="image", format="PNG"):
+        """Encode a PIL image (only needed when bytes must leave the process)"""
+        buffer = cls(None, stats, name)
+        started = time.perf_counter()
+        out = io.BytesIO()
+        image.save(out, format=format)
+        buffer.data = out.getvalue()
+        buffer.stats.count("encodes")
+        buffer.stats.count("encode_seconds", time.perf_counter() - started)
+        buffer._pil = image
+        return buffer
+
+    def __len__(self):
+        return len(self.data)
+
+    def pil(self):
+        with self.lock:
+            if self._pil is None:
+                from PIL import Image
+                started = time.perf_counter()
+                image = Image.open(io.BytesIO(self.data))
+                image.load()
+                self._pil = image
+                self.stats.count("decodes")
+                self.stats.count("decode_seconds", time.perf_counter() - started)
+            return self._pil
+
+    def qimage(self):
+        """QImage of the buffer: reuses the PIL pixels if already decoded, else Qt decodes the bytes"""
+        with self.lock:
+            if self._qimage is None:
+                if self._pil is not None:
+                    self._qimage = pil_to_qimage(self._pil)
+                else:
+                    from PyQt5.QtGui import QImage
+                    started = time.perf_counter()
+                    self._qimage = QImage.fromData(self.data)
+                    self.stats.count("decodes")
+                    self.stats.count("decode_seconds", time.perf_counter() - started)
+            return self._qimage
+
+    def qpixmap(self):
+        from PyQt5.QtGui import QPixmap
+        return QPixmap.fromImage(self.qimage())
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.data)
+        self.stats.count("disk_writes")
+        self.stats.count("bytes_written", len(self.data))
+        return path
+
+    def archive(self, name=None, directory=None):
+        """Write the image to directory (default MAGMA_ARCHIVE_DIR); no-op when archiving is off"""
+        directory = directory or ARCHIVE_DIR
+        if not directory:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        now = time.time()
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + f"-{int(now * 1000) % 1000:03d}"
+        return self.save(os.path.join(directory, f"{stamp}_{name or self.name}.png"))
+
+
+def pil_to_qimage(image):
+    """QImage holding a PIL image's pixels (one memory copy, no PNG encode/decode)"""
+    from PyQt5.QtGui import QImage
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    data = image.tobytes("raw", "RGBA")
+    # copy() detaches the QImage from `data`, which Python frees after return
+    return QImage(data, image.width, image.height, 4 * image.width, QImage.Format_RGBA8888).copy()
+
+
+def to_qpixmap(image):
+    """QPixmap from an ImageBuffer, a PIL image or a file path"""
+    from PyQt5.QtGui import QPixmap
+    if isinstance(image, ImageBuffer):
+        return image.qpixmap()
+    if isinstance(image, str):
+        return QPixmap(image)
+    return QPixmap.fromImage(pil_to_qimage(image))
@@ -0,0 +1,230 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+
+# Keys the processor produces for an image (everything else comes from the text)
+IMAGE_KEYS = ("pixel_values", "image_sizes")
+
+
+def processor_fingerprint(processor):
+    """Digest of the image preprocessing config, so a config change never reuses stale tensors"""
+    image_processor = getattr(processor, "image_processor", processor)
+    if hasattr(image_processor, "to_json_string"):
+        config = image_processor.to_json_string()
+    else:
+        config = repr(sorted(vars(image_processor).items()))
+    return hashlib.blake2b(config.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def image_content_hash(image, fingerprint=""):
+    """Content address of a decoded PIL image: pixels, size and mode plus the processor config"""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:{fingerprint}".encode("utf-8"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def tensor_nbytes(value):
+    """Bytes held by a tensor or a (nested) container of tensors"""
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, dict):
+        return sum(tensor_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(tensor_nbytes(v) for v in value)
+    return 0
+
+
+def find_vision_tower(model):
+    """Locate the vision encoder submodule, if the model has one"""
+    for owner in (model, getattr(model, "model", None)):
+        if owner is None:
+            continue
+        tower = getattr(owner, "vision_tower", None)
+        if isinstance(tower, (list, tuple)) and tower:
+            tower = tower[0]
+        if isinstance(tower, torch.nn.Module):
+            return tower
+    return None
+
+
+class ImageFeatureCache:
+    """Content-addressed LRU cache of processed images and their vision-encoder outputs
+
+    Entries are keyed by a hash of the decoded pixels plus the processor config.
+    Each one keeps the processor's pixel_values/image_sizes (already on the
+    model's device) and, once attach() has wrapped the vision tower, the
+    encoder outputs computed from those exact tensors. Asking another question
+    about the same screenshot then skips both the image preprocessing and the
+    vision encoder. Memory is bounded by max_bytes with LRU eviction.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 ** 2, device=None, dtype=None):
+        self.max_bytes = max_bytes
+        self.device = device
+        # dtype for floating-point image tensors, e.g. bfloat16 for a bf16 model
+        self.dtype = dtype
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.fingerprints = {}
+        # Text tokens must not depend on the image for the cached tensors to be reusable;
+        # checked once against the first full processor call
+        self.text_independent = None
+        # storage pointer of a cached pixel tensor -> entry key
+        self.storages = {}
+        self.lock = threading.Lock()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "vision_hits": 0,
+            "vision_misses": 0,
+            "evictions": 0,
+        }
+
+    def _fingerprint(self, processor):
+        key = id(processor)
+        if key not in self.fingerprints:
+            self.fingerprints[key] = processor_fingerprint(processor)
+        return self.fingerprints[key]
+
+    def process(self, processor, prompt, image):
+        """processor(images=image, texts=prompt) with the image tensors served from the cache"""
+        if image is None or self.text_independent is False:
+            return processor(images=image, texts=prompt, return_tensors="pt") if image is not None \
+                else processor(texts=prompt, return_tensors="pt")
+
+        key = image_content_hash(image, self._fingerprint(processor))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.counters["hits"] += 1
+
+        if entry is not None:
+            inputs = processor(texts=prompt, return_tensors="pt")
+            for name, value in entry["tensors"].items():
+                inputs[name] = value
+            return inputs
+
+        with self.lock:
+            self.counters["misses"] += 1
+        inputs = processor(images=image, texts=prompt, return_tensors="pt")
+        if self.text_independent is None:
+            text_only = processor(texts=prompt, return_tensors="pt")
+            self.text_independent = torch.equal(text_only["input_ids"], inputs["input_ids"])
+            if not self.text_independent:
+                print("Image cache disabled: this processor's text tokens depend on the image")
+                return inputs
+
+        tensors = {}
+        for name in IMAGE_KEYS:
+            value = inputs.get(name)
+            if isinstance(value, torch.Tensor):
+                if self.device is not None:
+                    value = value.to(self.device)
+                if self.dtype is not None and value.is_floating_point():
+                    value = value.to(self.dtype)
+                tensors[name] = value
+                inputs[name] = value
+        self._insert(key, tensors)
+        return inputs
+
+    def _insert(self, key, tensors):
+        entry = {"tensors": tensors, "features": {}, "nbytes": tensor_nbytes(tensors)}
+        if entry["nbytes"] > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.total_bytes += entry["nbytes"]
+            pixel_values = tensors.get("pixel_values")
+            if pixel_values is not None:
+                self.storages[pixel_values.untyped_storage().data_ptr()] = key
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            self._remove(next(iter(self.entries)))
+            self.counters["evictions"] += 1
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry["nbytes"]
+        pixel_values = entry["tensors"].get("pixel_values")
+        if pixel_values is not None:
+            self.storages.pop(pixel_values.untyped_storage().data_ptr(), None)
+
+    def attach(self, model):
+        """Memoize the model's vision tower on pixel tensors that came from this cache
+
+        Returns False when the model has no recognisable vision tower; the
+        processor-level caching still applies in that case.
+        """
+        tower = find_vision_tower(model)
+        if tower is None or getattr(tower, "_image_cache", None) is not None:
+            return tower is not None
+        original_forward = tower.forward
+        cache = self
+
+        def cached_forward(pixel_values, *args, **kwargs):
+            key = cache._feature_key(pixel_values, args, kwargs)
+            if key is None:
+                return original_forward(pixel_values, *args, **kwargs)
+            entry_key, feature_key = key
+            with cache.lock:
+                entry = cache.entries.get(entry_key)
+                features = entry["features"].get(feature_key) if entry is not None else None
+                if features is not None:
+                    cache.counters["vision_hits"] += 1
+                    return features
+            features = original_forward(pixel_values, *args, **kwargs)
+            with cache.lock:
+                cache.counters["vision_misses"] += 1
+                entry = cache.entries.get(entry_key)
+                if entry is not None:
+                    entry["features"][feature_key] = features
+                    nbytes = tensor_nbytes(features)
+                    entry["nbytes"] += nbytes
+                    cache.total_bytes += nbytes
+                    cache._evict()
+            return features
+
+        tower.forward = cached_forward
+        tower._image_cache = self
+        return True
+
+    def _feature_key(self, pixel_values, args, kwargs):
+        """Identify a vision tower call on (a view of) a cached pixel tensor"""
+        if not isinstance(pixel_values, torch.Tensor) or torch.is_grad_enabled():
+            return None
+        with self.lock:
+            entry_key = self.storages.get(pixel_values.untyped_storage().data_ptr())
+        if entry_key is None:
+            return None
+        # The cached storage stays alive (and unmodified) while the entry exists,
+        # so offset/shape/stride pin down exactly which pixels were passed in
+        feature_key = (
+            pixel_values.storage_offset(), tuple(pixel_values.shape), pixel_values.stride(),
+            pixel_values.dtype, repr(args), repr(sorted(kwargs.items())),
+        )
+        return entry_key, feature_key
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.storages.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = self.total_bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        vision_lookups = stats["vision_hits"] + stats["vision_misses"]
+        stats["vision_hit_rate"] = stats["vision_hits"] / vision_lookups if vision_lookups else 0.0
+        return stats
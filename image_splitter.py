@@ -1,42 +1,280 @@
+import argparse
+import math
+import time
+
+import torch
 from PIL import Image
 
-def split_image(image_path, output_prefix="split_image"):
+from batching import batch_key, collate_inputs, coordinate_decoding, get_pad_token_id, merge_generate_kwargs
+from coordinate_parser import parse_coordinates
+from quantization import compute_dtype
+
+# Tiled grounding for high-resolution screenshots. A 4K screen squeezed
+# through the vision encoder at its base resolution loses small buttons and
+# icons; instead the image is cut into an overlapping grid of tiles (cropped
+# in memory), every tile is asked the same question in one batched generate
+# call, and the tile-local "Coordinate: (...)" answers are mapped back to
+# full-image normalized coordinates. Answers from neighbouring tiles that
+# point at the same element (it sits in their overlap) are merged, and the
+# candidates are ranked by the model's mean token log-probability.
+#   python image_splitter.py screenshot.png                     # four quadrant PNGs, as before
+#   python image_splitter.py screenshot.png --grid 3x2 --overlap 0.15 --output-prefix tile
+#   python image_splitter.py screenshot.png --ground "Find the search box" --grid auto --tiny
+
+DEFAULT_OVERLAP = 0.15
+# Answers closer than this (share of the image's width/height) are one element
+MERGE_DISTANCE = 0.02
+# Most tiles auto_grid picks (one generate call runs them all)
+MAX_TILES = 16
+
+
+def parse_grid(value):
+    """(cols, rows) of a "COLSxROWS" grid such as "3x2"; None for "auto" (see auto_grid)"""
+    if value in (None, "", "auto"):
+        return None
+    cols, _, rows = str(value).lower().partition("x")
+    cols, rows = int(cols), int(rows or cols)
+    if cols < 1 or rows < 1:
+        raise ValueError(f"bad tile grid {value!r}")
+    return cols, rows
+
+
+def auto_grid(width, height, max_side=None, overlap=DEFAULT_OVERLAP):
+    """Smallest grid whose tiles fit in max_side pixels, at most MAX_TILES (2x2 if the limit is unknown)"""
+    if not max_side:
+        return 2, 2
+
+    def count(side):
+        if side <= max_side:
+            return 1
+        # n tiles of max_side overlapping by overlap * max_side cover the side
+        return math.ceil((side - overlap * max_side) / ((1 - overlap) * max_side))
+
+    cols, rows = count(width), count(height)
+    while cols * rows > MAX_TILES:
+        if cols >= rows:
+            cols -= 1
+        else:
+            rows -= 1
+    return cols, rows
+
+
+def tile_boxes(width, height, cols=2, rows=2, overlap=0.0):
+    """(left, upper, right, lower) pixel boxes of a cols x rows grid, row by row
+
+    All tiles have the same size, so their processed tensors can share one
+    batch; neighbours overlap by about overlap times the tile size.
     """
-    Split an image into four equal parts and save them as separate files.
-    
-    Args:
-        image_path (str): Path to the input image
-        output_prefix (str): Prefix for the output filenames
+    def spans(side, count):
+        size = min(side, math.ceil(side / (count - (count - 1) * overlap)))
+        step = (side - size) / (count - 1) if count > 1 else 0
+        return [(round(i * step), round(i * step) + size) for i in range(count)]
+
+    return [(left, upper, right, lower)
+            for upper, lower in spans(height, rows)
+            for left, right in spans(width, cols)]
+
+
+class Tile:
+    """One crop of the full image and where it came from"""
+
+    def __init__(self, index, box, image, full_size):
+        self.index = index
+        self.box = box
+        self.image = image
+        self.full_size = full_size
+
+    def to_full(self, coords):
+        """Tile-normalized (x, y) or (x1, y1, x2, y2) -> full-image normalized"""
+        left, upper, right, lower = self.box
+        width, height = self.full_size
+        mapped = []
+        for i, value in enumerate(coords):
+            if i % 2 == 0:
+                mapped.append((left + value * (right - left)) / width)
+            else:
+                mapped.append((upper + value * (lower - upper)) / height)
+        return tuple(mapped)
+
+
+def split_image(image, cols=2, rows=2, overlap=0.0, output_prefix=None):
+    """Cut an image (path or PIL image) into a grid of Tiles in memory
+
+    With output_prefix the tiles are also saved as <prefix>_<n>.png.
     """
-    # Open the image
-    img = Image.open(image_path)
-    
-    # Get dimensions
-    width, height = img.size
-    
-    # Calculate dimensions for each quadrant
-    mid_x = width // 2
-    mid_y = height // 2
-    
-    # Define the four quadrants (left, upper, right, lower)
-    quadrants = [
-        (0, 0, mid_x, mid_y),          # Top-left
-        (mid_x, 0, width, mid_y),      # Top-right
-        (0, mid_y, mid_x, height),     # Bottom-left
-        (mid_x, mid_y, width, height)  # Bottom-right
+    if isinstance(image, str):
+        image = Image.open(image)
+    boxes = tile_boxes(image.width, image.height, cols, rows, overlap)
+    tiles = [Tile(i, box, image.crop(box), image.size) for i, box in enumerate(boxes)]
+    if output_prefix:
+        for tile in tiles:
+            tile.image.save(f"{output_prefix}_{tile.index + 1}.png")
+            print(f"Saved {output_prefix}_{tile.index + 1}.png")
+    return tiles
+
+
+def center(coords):
+    if len(coords) == 4:
+        return (coords[0] + coords[2]) / 2, (coords[1] + coords[3]) / 2
+    return coords
+
+
+def format_coordinates(coords):
+    return "Coordinate: (" + ", ".join(f"{value:.3f}" for value in coords) + ")"
+
+
+def merge_detections(detections, distance=MERGE_DISTANCE):
+    """Deduplicate answers that point at the same element from overlapping tiles
+
+    detections are dicts with "coords" (full-image) and "score"; the best
+    scored answer of each group is kept, with "votes" counting the group.
+    """
+    merged = []
+    for detection in sorted(detections, key=lambda d: d["score"], reverse=True):
+        x, y = center(detection["coords"])
+        for kept in merged:
+            kx, ky = center(kept["coords"])
+            if abs(kx - x) <= distance and abs(ky - y) <= distance:
+                kept["votes"] += 1
+                kept["tiles"].append(detection["tile"])
+                break
+        else:
+            merged.append(dict(detection, votes=1, tiles=[detection["tile"]]))
+    return merged
+
+
+def tile_inputs(model, processor, tile, prompt, image_cache=None):
+    """Model inputs for one tile, prepared like magma_gradio.prepare_request"""
+    if image_cache is not None:
+        inputs = dict(image_cache.process(processor, prompt, tile.image))
+    else:
+        inputs = dict(processor(images=tile.image, texts=prompt, return_tensors="pt"))
+    if inputs.get("pixel_values") is not None:
+        inputs["pixel_values"] = inputs["pixel_values"].unsqueeze(0).to(compute_dtype(model))
+    if inputs.get("image_sizes") is not None:
+        inputs["image_sizes"] = inputs["image_sizes"].unsqueeze(0)
+    return inputs
+
+
+def generate_scored(model, processor, inputs_list, generation_args, decoding=None):
+    """One padded generate call; returns [(answer, mean token log-probability)] per row"""
+    pad_token_id = get_pad_token_id(processor.tokenizer)
+    batch = collate_inputs(inputs_list, pad_token_id)
+    device = next(model.parameters()).device
+    batch = {k: v.to(device) for k, v in batch.items()}
+    prompt_length = batch["input_ids"].shape[-1]
+    kwargs = decoding.generate_kwargs(prompt_length) if decoding is not None else {}
+    kwargs = merge_generate_kwargs(kwargs, {"output_scores": True, "return_dict_in_generate": True})
+    with torch.inference_mode():
+        output = model.generate(**batch, pad_token_id=pad_token_id, **generation_args, **kwargs)
+        scores = model.compute_transition_scores(
+            output.sequences, output.scores, getattr(output, "beam_indices", None), normalize_logits=True
+        )
+    generated = output.sequences[:, prompt_length:]
+    results = []
+    for ids, token_scores in zip(generated, scores):
+        # Padding after a row finished does not count
+        valid = (ids[:len(token_scores)] != pad_token_id) & torch.isfinite(token_scores)
+        score = float(token_scores[valid].float().mean()) if valid.any() else float("-inf")
+        results.append((processor.decode(ids, skip_special_tokens=True).strip(), score))
+    return results
+
+
+def ground_tiles(model, processor, image, instruction, system_prompt="", grid=None, overlap=DEFAULT_OVERLAP,
+                 generation_args=None, coordinate_mode="stop", image_cache=None, max_side=None):
+    """Ask every tile of image the same grounding question; returns the ranked answers
+
+    grid is (cols, rows) or None to pick one from max_side (the processor's
+    useful resolution). Returns {"best", "detections", "responses", "grid",
+    "seconds"}; best (None if no tile answered with a coordinate) and the
+    detections carry full-image "coords", "score", "votes" and "tiles".
+    """
+    started = time.monotonic()
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    cols, rows = grid or auto_grid(image.width, image.height, max_side, overlap)
+    tiles = split_image(image, cols, rows, overlap)
+    generation_args = dict(generation_args or {"max_new_tokens": 32, "do_sample": False, "num_beams": 1})
+    generation_args.setdefault("use_cache", True)
+    convs = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"<image_start><image><image_end>\n{instruction}"},
     ]
-    
-    # Extract and save each quadrant
-    for i, quad in enumerate(quadrants):
-        box = quad
-        region = img.crop(box)
-        region.save(f"{output_prefix}_{i+1}.png")
-        print(f"Saved {output_prefix}_{i+1}.png")
+    prompt = processor.tokenizer.apply_chat_template(convs, tokenize=False, add_generation_prompt=True)
+    inputs = [tile_inputs(model, processor, tile, prompt, image_cache) for tile in tiles]
 
-if __name__ == "__main__":
-    import sys
-    if len(sys.argv) > 1:
-        input_image = sys.argv[1]
-        split_image(input_image)
+    # Equal tiles normally share one shape (one batch); group in case the processor crops them differently
+    groups = {}
+    for tile, tile_input in zip(tiles, inputs):
+        groups.setdefault(batch_key(tile_input, generation_args), []).append((tile, tile_input))
+    responses = [None] * len(tiles)
+    for group in groups.values():
+        decoding = coordinate_decoding(model, processor, [coordinate_mode] * len(group), generation_args)
+        answers = generate_scored(model, processor, [tile_input for _, tile_input in group], generation_args,
+                                  decoding)
+        for (tile, _), answer in zip(group, answers):
+            responses[tile.index] = answer
+
+    detections = []
+    for tile, (text, score) in zip(tiles, responses):
+        # Tile-local answers are normalized; the parser drops anything outside the tile
+        coords = parse_coordinates(text)
+        if coords is not None:
+            detections.append({"coords": tile.to_full(coords), "score": score, "tile": tile.index, "text": text})
+    detections = merge_detections(detections)
+    return {
+        "best": detections[0] if detections else None,
+        "detections": detections,
+        "responses": [{"tile": tile.index, "box": tile.box, "text": text, "score": score}
+                      for tile, (text, score) in zip(tiles, responses)],
+        "grid": (cols, rows),
+        "seconds": round(time.monotonic() - started, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split a screenshot into tiles, optionally grounding on each")
+    parser.add_argument("image")
+    parser.add_argument("--grid", default="2x2", help="COLSxROWS, or auto to fit the processor's resolution")
+    parser.add_argument("--overlap", type=float, default=None,
+                        help=f"share of a tile overlapping its neighbours (default 0, {DEFAULT_OVERLAP} with --ground)")
+    parser.add_argument("--output-prefix", default=None, help="save the tiles as <prefix>_<n>.png")
+    parser.add_argument("--ground", default=None, metavar="INSTRUCTION", help="ask the model about every tile")
+    parser.add_argument("--system-prompt", default="You are agent that can see, talk and act.")
+    parser.add_argument("--tiny", action="store_true", help="use the tiny stand-in model (tiny_magma.py)")
+    args = parser.parse_args()
+
+    if args.ground is None:
+        cols, rows = parse_grid(args.grid) or (2, 2)
+        split_image(args.image, cols, rows, args.overlap or 0.0, args.output_prefix or "split_image")
+        return
+
+    if args.tiny:
+        from tiny_magma import load_tiny_magma
+        model, processor = load_tiny_magma()
     else:
-        print("Usage: python image_splitter.py <image_path>") 
\ No newline at end of file
+        from magma_gradio import load_model
+        model, processor = load_model()
+    from image_transport import processor_max_side
+
+    image = Image.open(args.image).convert("RGB")
+    overlap = DEFAULT_OVERLAP if args.overlap is None else args.overlap
+    if args.output_prefix:
+        split_image(image, *(parse_grid(args.grid) or auto_grid(image.width, image.height,
+                                                                processor_max_side(processor), overlap)),
+                    overlap, args.output_prefix)
+    result = ground_tiles(model, processor, image, args.ground, args.system_prompt, parse_grid(args.grid), overlap,
+                          max_side=processor_max_side(processor))
+    cols, rows = result["grid"]
+    print(f"{cols}x{rows} tiles in {result['seconds']}s")
+    for response in result["responses"]:
+        print(f"  tile {response['tile'] + 1} {response['box']}: {response['text']!r} (log-prob {response['score']:.3f})")
+    for detection in result["detections"]:
+        print(f"{format_coordinates(detection['coords'])} score {detection['score']:.3f} "
+              f"votes {detection['votes']} tiles {[t + 1 for t in detection['tiles']]}")
+    if result["best"] is None:
+        print("No tile answered with a coordinate")
+
+
+if __name__ == "__main__":
+    main()
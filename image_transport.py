@@ -0,0 +1,203 @@
+import hashlib
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+# Compact image uploads between the desktop/web clients and magma_gradio.py.
+# Instead of a full-size PNG through gradio_client.handle_file (decoded to a
+# numpy array on the server and back to PIL), the client (model_client.py)
+# encodes lossless WebP (or raw RGB on fast links), at full size or downscaled
+# to the largest size the processor uses, whichever is fewer bytes, and POSTs
+# them to /images/<hash>. Requests then name the image by reference
+# (image_ref="sha256:..."), so a screenshot the server already holds is never
+# sent twice. The server decodes once, straight into the PIL image the
+# processor takes.
+#   python image_transport.py screenshot.png      # bytes and decode time per mode
+
+FORMATS = ("webp", "raw")
+# Set to "file" to upload full PNGs through gradio's /upload as before
+TRANSPORT = os.environ.get("MAGMA_IMAGE_TRANSPORT", "compact")
+# Client-side override of the server's target resolution (0 = ask the server)
+UPLOAD_MAX_SIDE = int(os.environ.get("MAGMA_UPLOAD_MAX_SIDE", "0"))
+UPLOAD_FORMAT = os.environ.get("MAGMA_UPLOAD_FORMAT", "webp")
+# Largest upload the server accepts
+MAX_UPLOAD_BYTES = 32 * 1024 ** 2
+MAX_UPLOAD_PIXELS = 40_000_000
+
+REF_PREFIX = "sha256:"
+# Part of the error a request gets when the server no longer holds its image
+UNKNOWN_IMAGE = "Unknown image reference"
+
+
+def image_hash(image):
+    """Content hash of the (downscaled) pixels: the same for every encoding of one image"""
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.width}x{image.height}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def downscale(image, max_side):
+    """RGB copy no larger than max_side on its longest side (the image itself if it fits)"""
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if max_side and max(image.size) > max_side:
+        scale = max_side / max(image.size)
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                             Image.LANCZOS)
+    return image
+
+
+def encode(image, format="webp"):
+    """Wire bytes of an RGB image: lossless WebP or raw RGB rows"""
+    if format == "raw":
+        return image.tobytes()
+    out = io.BytesIO()
+    # Lossless at the lowest effort level: on screenshots several times smaller
+    # than PNG and no slower to encode; higher levels save little more and take
+    # up to 10x longer on busy images (seconds for a 1080p photo)
+    image.save(out, format="WEBP", lossless=True, quality=50, method=0)
+    return out.getvalue()
+
+
+def decode(data, format="webp", width=None, height=None):
+    """PIL RGB image from wire bytes (server side)"""
+    if format == "raw":
+        if not width or not height or len(data) != width * height * 3:
+            raise ValueError("raw uploads need width and height matching the data")
+        return Image.frombuffer("RGB", (width, height), data, "raw", "RGB", 0, 1)
+    image = Image.open(io.BytesIO(data))
+    if image.width * image.height > MAX_UPLOAD_PIXELS:
+        raise ValueError("image too large")
+    image.load()
+    return image.convert("RGB") if image.mode != "RGB" else image
+
+
+def processor_max_side(processor):
+    """Longest image side the processor can make use of, or None if unknown
+
+    Upper bound: the base crop size times the number of crops, so downscaling
+    to it never removes detail the processor would have kept.
+    """
+    image_processor = getattr(processor, "image_processor", processor)
+    base = getattr(image_processor, "base_img_size", None) or getattr(image_processor, "image_size", None)
+    if isinstance(base, dict):
+        base = max(base.values())
+    if not base:
+        return None
+    crops = getattr(image_processor, "num_crops", None) or getattr(image_processor, "max_num_crops", None) or 1
+    return int(base) * int(crops)
+
+
+class ImageStore:
+    """Server-side LRU of uploaded images by content hash, within a memory budget"""
+
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.counters = {
+            "uploads": 0,
+            "bytes_received": 0,
+            "decode_seconds": 0.0,
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.images
+
+    def put(self, key, data, format="webp", width=None, height=None):
+        """Decode an upload and keep it under its content hash; returns the image"""
+        started = time.perf_counter()
+        image = decode(data, format, width, height)
+        seconds = time.perf_counter() - started
+        if image_hash(image) != key:
+            # Never serve an image under someone else's hash
+            raise ValueError("content does not match its hash")
+        size = image.width * image.height * 3
+        with self.lock:
+            self.counters["uploads"] += 1
+            self.counters["bytes_received"] += len(data)
+            self.counters["decode_seconds"] += seconds
+            if key in self.images:
+                self.images.move_to_end(key)
+                return self.images[key]
+            self.images[key] = image
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self.images) > 1:
+                _, evicted = self.images.popitem(last=False)
+                self.bytes -= evicted.width * evicted.height * 3
+                self.counters["evictions"] += 1
+        return image
+
+    def get(self, ref):
+        """Image of a "sha256:..." reference; raises KeyError if it is not (or no longer) here"""
+        key = ref[len(REF_PREFIX):] if ref.startswith(REF_PREFIX) else ref
+        with self.lock:
+            image = self.images.get(key)
+            if image is None:
+                self.counters["misses"] += 1
+                raise KeyError(f"{UNKNOWN_IMAGE}: {ref}")
+            self.images.move_to_end(key)
+            self.counters["hits"] += 1
+            return image
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["images"] = len(self.images)
+            stats["mb"] = round(self.bytes / 1024 ** 2, 1)
+        stats["decode_seconds"] = round(stats["decode_seconds"], 4)
+        return stats
+
+
+if __name__ == "__main__":
+    # Bytes on the wire and server-side decode time: handle_file PNG vs compact modes
+    import sys
+    import numpy as np
+
+    if len(sys.argv) > 1:
+        source = Image.open(sys.argv[1]).convert("RGB")
+    else:
+        # Synthetic page: text, a button and a blurred gradient
+        from PIL import ImageDraw, ImageFilter
+        source = Image.new("RGB", (1200, 1200), "#f9f9f9")
+        draw = ImageDraw.Draw(source)
+        for i in range(60):
+            draw.text((40, 20 + i * 19), f"Lorem ipsum dolor sit amet, consectetur adipiscing elit {i}", fill=(20, 20, 20))
+        draw.rounded_rectangle([400, 900, 800, 980], 12, fill=(30, 120, 220))
+        draw.text((560, 930), "Continue", fill="white")
+        gradient = Image.linear_gradient("L").resize((300, 300)).convert("RGB").filter(ImageFilter.GaussianBlur(3))
+        source.paste(gradient, (850, 100))
+    max_side = int(sys.argv[2]) if len(sys.argv) > 2 else 768
+
+    def timed(function, repeat=5):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            result = function()
+        return result, (time.perf_counter() - started) / repeat * 1000
+
+    png = io.BytesIO()
+    source.save(png, format="PNG")
+    png = png.getvalue()
+    # What the server did per request: PNG -> numpy (gradio) -> PIL (process_image)
+    _, png_decode = timed(lambda: Image.fromarray(np.asarray(Image.open(io.BytesIO(png)).convert("RGB"))))
+    print(f"{'mode':>16} {'bytes':>10} {'encode ms':>10} {'decode ms':>10}")
+    print(f"{'png (handle_file)':>16} {len(png):>10} {'-':>10} {png_decode:10.1f}")
+    for format in FORMATS:
+        for side in (None, max_side):
+            image = downscale(source, side)
+            data, encode_ms = timed(lambda: encode(image, format))
+            _, decode_ms = timed(lambda: decode(data, format, image.width, image.height))
+            label = f"{format}@{image.width}x{image.height}"
+            print(f"{label:>16} {len(data):>10} {encode_ms:10.1f} {decode_ms:10.1f}")
+    print("WebP uploads go at whichever of the two sizes is fewer bytes (model_client.PreparedImage)")
+    print("Repeat uploads of the same screenshot send 0 bytes (content hash known to the server)")
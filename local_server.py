@@ -2,6 +2,8 @@ import http.server
 import socketserver
 import os
 import socket
+import threading
+from functools import partial
 
 def find_free_port(start_port=8000, max_attempts=100):
     """Find a free port starting from start_port."""
@@ -39,5 +41,20 @@ def run_simple_server(port=8000):
         print("\nServer stopped")
         httpd.server_close()
 
+def start_background_server(port=None, directory=None):
+    """Serve directory (default: cwd) from a daemon thread; returns (httpd, base_url)."""
+    if port is None:
+        port = find_free_port()
+    handler = partial(QuietHandler, directory=directory or os.getcwd())
+    httpd = socketserver.ThreadingTCPServer(("", port), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="local-server", daemon=True).start()
+    return httpd, f"http://localhost:{port}"
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """Request handler that does not log every request (batch runs make hundreds)."""
+    def log_message(self, format, *args):
+        pass
+
 if __name__ == "__main__":
     run_simple_server() 
\ No newline at end of file
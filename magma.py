@@ -3,12 +3,15 @@ from PIL import Image
 from io import BytesIO
 import requests
 
-from transformers import AutoModelForCausalLM, AutoProcessor
+from transformers import AutoProcessor
+from fast_loader import load_model, print_load_report
 
-# Load the model and processor
-model = AutoModelForCausalLM.from_pretrained("microsoft/Magma-8B", trust_remote_code=True)
+# Load the model and processor (weights are streamed shard by shard onto the GPU,
+# or loaded with from_pretrained if streaming fails)
+model, report = load_model("microsoft/Magma-8B", device="cuda")
+if report is not None:
+    print_load_report(report)
 processor = AutoProcessor.from_pretrained("microsoft/Magma-8B", trust_remote_code=True)
-model.to("cuda")
 
 # Inference
 url = "https://assets-c4akfrf5b4d3f4b7.z01.azurefd.net/assets/2024/04/BMDataViz_661fb89f3845e.png"
@@ -3,48 +3,70 @@ import os
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
                             QLabel, QLineEdit, QPushButton, QTextEdit, QFileDialog,
                             QScrollArea, QSplitter)
-from PyQt5.QtGui import QPixmap, QImage
+from PyQt5.QtGui import QImage
 from PyQt5.QtCore import Qt, QThread, pyqtSignal
 import requests
-from gradio_client import Client, handle_file
-from PIL import Image, ImageDraw
-from io import BytesIO
-import re
+import uuid
+from image_buffer import ImageBuffer, ImageStats, to_qpixmap
+from model_client import shared_client
+from overlay import draw_detections
+from coordinate_parser import extract_coordinates
+from concurrent.futures import CancelledError
 
 class WorkerThread(QThread):
     """Thread for running API calls without freezing the UI"""
     finished = pyqtSignal(list, object)
+    partial = pyqtSignal(list)  # chat history with the answer generated so far
     error = pyqtSignal(str)
     
-    def __init__(self, client, image_path, system_prompt, user_prompt, chat_history):
+    def __init__(self, client, image_path, system_prompt, user_prompt, chat_history, session_id=None):
         super().__init__()
-        self.client = client
+        self.client = client  # model_client.SharedClient
         self.image_path = image_path
         self.system_prompt = system_prompt
         self.user_prompt = user_prompt
         self.chat_history = chat_history
+        self.session_id = session_id
+        self.future = None
     
     def run(self):
         try:
-            result = self.client.predict(
-                image_input=handle_file(self.image_path) if self.image_path else None,
+            # Stream the answer so it can be rendered while it is being generated.
+            # Local files go up compactly; URLs are fetched by the server.
+            self.future = self.client.submit(
+                "predict",
+                "generate_response_stream",
+                self.image_path or None,
+                on_partial=lambda data: self.partial.emit(data[0]),
                 system_prompt=self.system_prompt,
                 user_prompt=self.user_prompt,
                 chat_history=self.chat_history,
-                api_name="/generate_response"
+                session_id=self.session_id,
+                priority="interactive"  # a user is watching: ahead of batch sweeps on the server
             )
+            result = self.future.result()["data"]
             self.finished.emit(result[0], result[1])
+        except CancelledError:
+            self.error.emit("Request cancelled")
         except Exception as e:
             self.error.emit(str(e))
+    
+    def cancel(self):
+        """Abandon the request (the server stops generating too)"""
+        if self.future is not None:
+            self.future.cancel()
 
 class MagmaDesktopApp(QMainWindow):
     def __init__(self):
         super().__init__()
         
         self.api_url = "http://127.0.0.1:7860/"
-        self.client = Client(self.api_url)
+        self.client = shared_client(self.api_url)  # connects on first use
         self.image_path = None
+        self.source_image = None  # (source, ImageBuffer) of the image last loaded, reused for drawing
         self.chat_history = []
+        self.session_id = uuid.uuid4().hex  # keeps this conversation on one server replica
+        self.coordinates_shown = False  # box for the current answer already drawn
         
         self.init_ui()
     
@@ -205,7 +227,8 @@ class MagmaDesktopApp(QMainWindow):
         """Connect to the Gradio API"""
         try:
             self.api_url = self.api_input.text()
-            self.client = Client(self.api_url)
+            self.client = shared_client(self.api_url)
+            self.client.connect()
             self.status_message.setText(f"Connected to {self.api_url}")
             self.status_message.setStyleSheet("color: #00FF00")
         except Exception as e:
@@ -222,23 +245,34 @@ class MagmaDesktopApp(QMainWindow):
             self.image_url_input.setText(file_path)
             self.display_image(file_path)
     
-    def display_image(self, image_path):
-        """Display the selected image"""
+    def load_source_image(self, source):
+        """ImageBuffer of a file or URL, fetched once and reused by display and drawing"""
+        if self.source_image is not None and self.source_image[0] == source:
+            return self.source_image[1]
+        if source.startswith(("http://", "https://")):
+            response = requests.get(source)
+            buffer = ImageBuffer(response.content, ImageStats(source), "source")
+        else:
+            buffer = ImageBuffer.from_file(source, ImageStats(source))
+        self.source_image = (source, buffer)
+        return buffer
+    
+    def display_image(self, image):
+        """Display the selected image (file path or URL) or a drawn PIL image"""
         try:
-            if image_path.startswith(("http://", "https://")):
+            if not isinstance(image, str):
+                pixmap = to_qpixmap(image)
+            elif image.startswith(("http://", "https://")):
                 try:
-                    response = requests.get(image_path)
-                    image_data = BytesIO(response.content)
-                    pixmap = QPixmap()
-                    pixmap.loadFromData(image_data.getvalue())
+                    pixmap = self.load_source_image(image).qpixmap()
                 except Exception as e:
                     self.status_message.setText(f"Error loading image URL: {str(e)}")
                     return
             else:
-                if not os.path.exists(image_path):
-                    self.status_message.setText(f"File not found: {image_path}")
+                if not os.path.exists(image):
+                    self.status_message.setText(f"File not found: {image}")
                     return
-                pixmap = QPixmap(image_path)
+                pixmap = self.load_source_image(image).qpixmap()
             
             if pixmap.isNull():
                 self.status_message.setText("Failed to load image")
@@ -271,36 +305,26 @@ class MagmaDesktopApp(QMainWindow):
             image_src,
             self.system_prompt.text(),
             self.user_prompt.text(),
-            self.chat_history
+            self.chat_history,
+            self.session_id
         )
+        self.coordinates_shown = False
+        self.worker.partial.connect(self.handle_partial)
         self.worker.finished.connect(self.handle_response)
         self.worker.error.connect(self.handle_error)
         self.worker.start()
     
+    def handle_partial(self, chat_history):
+        """Render the answer generated so far"""
+        self.show_coordinates(chat_history)
+        self.render_conversation(chat_history)
+        self.status_message.setText("Generating...")
+    
     def handle_response(self, chat_history, bbox_image):
         """Handle the API response"""
         self.chat_history = chat_history
-        
-        # Get the last response to check for coordinates
-        if chat_history and len(chat_history) > 0:
-            last_exchange = chat_history[-1]
-            if len(last_exchange) > 1:
-                last_response = last_exchange[1]
-                
-                # Extract coordinates from response
-                coordinates = self.extract_coordinates(last_response)
-                if coordinates:
-                    # Draw our own bounding box or point marker
-                    self.draw_and_display_box(coordinates)
-        
-        # Update conversation display
-        self.conversation_area.clear()
-        for exchange in self.chat_history:
-            user_msg, assistant_msg = exchange
-            self.conversation_area.append(f"<b>You:</b> {user_msg}")
-            self.conversation_area.append(f"<b>Magma:</b> {assistant_msg}")
-            # Remove debug info from UI
-            self.conversation_area.append("\n")
+        self.show_coordinates(chat_history)
+        self.render_conversation(self.chat_history)
         
         # Re-enable the submit button
         self.submit_btn.setEnabled(True)
@@ -310,6 +334,29 @@ class MagmaDesktopApp(QMainWindow):
         # Clear the prompt for next query
         self.user_prompt.clear()
     
+    def show_coordinates(self, chat_history):
+        """Draw the box as soon as the last answer contains a complete coordinate"""
+        if self.coordinates_shown or not chat_history:
+            return
+        last_exchange = chat_history[-1]
+        if len(last_exchange) > 1 and last_exchange[1]:
+            # Extract coordinates from response
+            coordinates = extract_coordinates(last_exchange[1])
+            if coordinates:
+                # Draw our own bounding box or point marker
+                self.draw_and_display_box(coordinates)
+                self.coordinates_shown = True
+    
+    def render_conversation(self, chat_history):
+        """Update conversation display"""
+        self.conversation_area.clear()
+        for exchange in chat_history:
+            user_msg, assistant_msg = exchange
+            self.conversation_area.append(f"<b>You:</b> {user_msg}")
+            self.conversation_area.append(f"<b>Magma:</b> {assistant_msg}")
+            # Remove debug info from UI
+            self.conversation_area.append("\n")
+    
     def handle_error(self, error_msg):
         """Handle errors from the API"""
         self.status_message.setText(f"Error: {error_msg}")
@@ -319,11 +366,12 @@ class MagmaDesktopApp(QMainWindow):
     def clear_conversation(self):
         """Clear the conversation history"""
         try:
-            result = self.client.predict(
-                image=handle_file(self.image_path) if self.image_path else None,
-                api_name="/clear_conversation"
-            )
+            # Only resets the server's state: no need to send the image again
+            self.client.predict("clear_conversation", session_id=self.session_id)
+            # Free the old conversation on the server (fire and forget; it would expire anyway)
+            self.client.submit("end_session", self.session_id)
             self.chat_history = []
+            self.session_id = uuid.uuid4().hex
             self.conversation_area.clear()
             self.status_message.setText("Conversation cleared")
             self.status_message.setStyleSheet("color: green")
@@ -331,99 +379,30 @@ class MagmaDesktopApp(QMainWindow):
             self.status_message.setText(f"Error clearing conversation: {str(e)}")
             self.status_message.setStyleSheet("color: red")
 
-    def extract_coordinates(self, text):
-        """Extract coordinate pattern from text - handles both formats"""
-        # Try four-value bounding box pattern first
-        pattern_bbox = r"Coordinate: \(([0-9.]+), ([0-9.]+), ([0-9.]+), ([0-9.]+)\)"
-        match = re.search(pattern_bbox, text)
-        if match:
-            try:
-                x_min = float(match.group(1))
-                y_min = float(match.group(2))
-                x_max = float(match.group(3))
-                y_max = float(match.group(4))
-                return {'type': 'bbox', 'coords': (x_min, y_min, x_max, y_max)}
-            except ValueError:
-                return None
-        
-        # Try two-value center point pattern
-        pattern_point = r"Coordinate: \(([0-9.]+), ([0-9.]+)\)"
-        match = re.search(pattern_point, text)
-        if match:
-            try:
-                x = float(match.group(1))
-                y = float(match.group(2))
-                return {'type': 'point', 'coords': (x, y)}
-            except ValueError:
-                return None
-            
-        return None
-
     def draw_and_display_box(self, coordinates_data):
         """Draw a bounding box or point marker on the image"""
         if not coordinates_data:
             return
         
         try:
-            # Load the image
+            # Reuse the loaded image; draw on a private RGB copy
             if self.image_path:
-                img = Image.open(self.image_path)
+                source = self.load_source_image(self.image_path)
             elif self.image_url_input.text().startswith(("http://", "https://")):
-                response = requests.get(self.image_url_input.text())
-                img = Image.open(BytesIO(response.content))
+                source = self.load_source_image(self.image_url_input.text())
             else:
                 return
-            
-            # Make sure image is in RGB mode
-            if img.mode != "RGB":
-                img = img.convert("RGB")
-            
-            # Draw bounding box or point
-            draw = ImageDraw.Draw(img)
-            width, height = img.size
-            
+            img = draw_detections(source.pil(), [coordinates_data], style="marker")
             if coordinates_data['type'] == 'point':
-                # Draw a point marker (circle with cross)
                 x, y = coordinates_data['coords']
-                # Convert normalized coordinates to pixel coordinates
-                center_x = int(x * width)
-                center_y = int(y * height)
-                
-                # Draw a visible point marker
-                radius = max(10, min(width, height) // 30)  # Scale with image size
-                
-                # Draw cross
-                draw.line([(center_x - radius, center_y), (center_x + radius, center_y)], fill="red", width=3)
-                draw.line([(center_x, center_y - radius), (center_x, center_y + radius)], fill="red", width=3)
-                
-                # Draw circle
-                draw.ellipse((center_x - radius, center_y - radius, center_x + radius, center_y + radius), 
-                             outline="red", width=2)
-                
                 self.status_message.setText(f"Drew point marker at coordinates: ({x}, {y})")
             else:
-                # Draw rectangle for bounding box
-                x_min, y_min, x_max, y_max = coordinates_data['coords']
-                
-                # Convert normalized coordinates to pixel coordinates
-                x_min_px = int(x_min * width)
-                y_min_px = int(y_min * height)
-                x_max_px = int(x_max * width)
-                y_max_px = int(y_max * height)
-                
-                # Draw rectangle for bounding box
-                draw.rectangle(
-                    [(x_min_px, y_min_px), (x_max_px, y_max_px)],
-                    outline="red",
-                    width=3
-                )
-                
                 self.status_message.setText(f"Drew bounding box at coordinates: {coordinates_data['coords']}")
             
-            # Save to a temporary file and display
-            temp_path = "temp_bbox_image.png"
-            img.save(temp_path)
-            self.display_image(temp_path)
+            # Display straight from memory
+            self.display_image(img)
+            # Encode/decode counters of the source image, on hover
+            self.status_message.setToolTip(str(source.stats))
         except Exception as e:
             self.status_message.setText(f"Error drawing: {str(e)}")
 
@@ -1,38 +1,302 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
 import torch
-from PIL import Image, ImageDraw
+from PIL import Image
 from io import BytesIO
 import requests
 import gradio as gr
-import re
 import numpy as np
+import admission
+import metrics
+import tracing
 from transformers import AutoModelForCausalLM, AutoProcessor
+from batching import BatchScheduler, OneShotGenerator
+from continuous_batching import ContinuousBatcher
+from prefix_cache import PrefixCache
+from image_cache import ImageFeatureCache
+from fast_loader import load_model_streaming
+from quantization import apply_precision, compute_dtype, load_dtype, model_nbytes
+from streaming import submit_streaming
+from image_transport import FORMATS, MAX_UPLOAD_BYTES, ImageStore, processor_max_side
+from session_store import SessionStore
+from image_splitter import DEFAULT_OVERLAP, format_coordinates, ground_tiles, parse_grid
+from overlay import draw_detections
+from coordinate_parser import extract_coordinates
+from image_cache import find_vision_tower
+
+# How requests reach the model:
+#   "oneshot"    - one model.generate call per request (the original behaviour)
+#   "static"     - requests arriving within BATCH_WINDOW_MS share one generate call
+#   "continuous" - iteration-level batching, sequences join/leave between decoding steps
+SCHEDULER_MODE = os.environ.get("MAGMA_SCHEDULER", "static")
+MAX_BATCH_SIZE = int(os.environ.get("MAGMA_MAX_BATCH_SIZE", "8"))
+BATCH_WINDOW_MS = float(os.environ.get("MAGMA_BATCH_WINDOW_MS", "20"))
+# Memory budget for reusing the KV cache of the system prompt and earlier turns
+# (used by the oneshot and continuous schedulers). Set to 0 to disable.
+PREFIX_CACHE_MB = int(os.environ.get("MAGMA_PREFIX_CACHE_MB", "2048"))
+# Memory budget for processed images and their vision-encoder outputs, keyed by
+# image content, so repeat questions about one screenshot skip the vision tower
+IMAGE_CACHE_MB = int(os.environ.get("MAGMA_IMAGE_CACHE_MB", "512"))
+
+MODEL_ID = os.environ.get("MAGMA_MODEL_ID", "microsoft/Magma-8B")
+# Stream safetensors shards straight onto the device instead of building the
+# whole model in CPU RAM first (falls back to from_pretrained on failure)
+STREAMING_LOAD = os.environ.get("MAGMA_STREAMING_LOAD", "1") != "0"
+# Weight precision on CPU-only hosts: fp32, bf16, int8 or int4 (see quantization.py)
+CPU_PRECISION = os.environ.get("MAGMA_PRECISION", "fp32")
+# Memory budget for images uploaded through the compact transport (image_transport.py)
+IMAGE_STORE_MB = int(os.environ.get("MAGMA_IMAGE_STORE_MB", "256"))
+# Server-side chat sessions (session_store.py): idle seconds before a session
+# is dropped, and the memory budget for their turns and images
+SESSION_TTL = float(os.environ.get("MAGMA_SESSION_TTL", "1800"))
+SESSION_STORE_MB = int(os.environ.get("MAGMA_SESSION_STORE_MB", "512"))
+# Overlap between neighbouring tiles in tiled grounding (image_splitter.py)
+TILE_OVERLAP = float(os.environ.get("MAGMA_TILE_OVERLAP", str(DEFAULT_OVERLAP)))
+# Public gradio.live link; replicas behind serve_replicas.py run with 0
+SHARE = os.environ.get("MAGMA_SHARE", "1") != "0"
 
 # Global variables to store the model and processor
 global_model = None
 global_processor = None
+global_generator = None
+global_image_cache = None
+image_store = ImageStore(max_bytes=IMAGE_STORE_MB * 1024 ** 2)
+session_store = SessionStore(max_bytes=SESSION_STORE_MB * 1024 ** 2, ttl=SESSION_TTL)
+# Places at the model, handed out by priority class and deadline (see admission.py)
+admission_control = admission.AdmissionControl(MAX_BATCH_SIZE if SCHEDULER_MODE != "oneshot" else 1)
+model_lock = threading.Lock()
 last_image = None  # Store the last image for drawing bounding boxes
 
+# Progress of the (background) model load, reported by /health and /ready
+load_state = {
+    "status": "not_started",  # not_started -> loading -> ready | failed
+    "stage": None,
+    "progress": 0.0,
+    "error": None,
+    "started_at": None,
+    "load_seconds": None,
+}
+load_state_lock = threading.Lock()
+
+def set_load_state(**changes):
+    with load_state_lock:
+        load_state.update(changes)
+
+def model_load_state():
+    """Snapshot of the load progress, with the elapsed time while loading"""
+    with load_state_lock:
+        state = dict(load_state)
+    if state["status"] == "loading" and state["started_at"] is not None:
+        state["elapsed_seconds"] = round(time.time() - state["started_at"], 1)
+    return state
+
 def load_model():
-    """Load the model and processor once and reuse"""
+    """Load the model and processor once and reuse
+    
+    If a background load is in progress, callers wait for it instead of failing.
+    If it failed, the next caller retries the load.
+    """
     global global_model, global_processor
     
-    if global_model is None or global_processor is None:
-        print("Loading model and processor...")
-        global_processor = AutoProcessor.from_pretrained("microsoft/Magma-8B", trust_remote_code=True)
-        global_model = AutoModelForCausalLM.from_pretrained("microsoft/Magma-8B", trust_remote_code=True)
-        
-        # Use MPS (Apple Silicon) or CUDA depending on availability
-        device = "mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu"
-        global_model.to(device)
-        print(f"Model loaded on {device}")
+    if global_model is not None and global_processor is not None:
+        return global_model, global_processor
+    
+    # Concurrent first requests must not load the model twice
+    with model_lock:
+        if global_model is None or global_processor is None:
+            started = time.time()
+            set_load_state(status="loading", stage="processor", progress=0.0, error=None, started_at=started)
+            try:
+                print("Loading model and processor...")
+                processor = AutoProcessor.from_pretrained(MODEL_ID, trust_remote_code=True)
+                # Use MPS (Apple Silicon) or CUDA depending on availability
+                device = "mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu"
+                set_load_state(stage="weights", progress=0.1)
+                model = load_weights(device)
+            except Exception as e:
+                set_load_state(status="failed", stage=None, error=str(e))
+                raise
+            global_processor, global_model = processor, model
+            set_load_state(status="ready", stage=None, progress=1.0, load_seconds=round(time.time() - started, 1))
+            print(f"Model loaded on {device}")
     
     return global_model, global_processor
 
+def load_weights(device):
+    """Model weights on `device`, streamed shard by shard when possible"""
+    precision = CPU_PRECISION if device == "cpu" else "fp32"
+    model = load_checkpoint(device, load_dtype(precision))
+    if precision != "fp32":
+        set_load_state(stage=f"converting to {precision}", progress=0.95)
+        apply_precision(model, precision)
+        print(f"Weights converted to {precision}: {model_nbytes(model) / 1024 ** 3:.1f} GB")
+    return model
+
+def load_checkpoint(device, dtype):
+    if STREAMING_LOAD:
+        def on_shard(index, total, shard):
+            print(f"Loaded {shard['shard']} ({index + 1}/{total}) in {shard['seconds']:.1f}s")
+            set_load_state(stage=f"weights {index + 1}/{total}", progress=0.1 + 0.85 * (index + 1) / total)
+        
+        try:
+            model, report = load_model_streaming(MODEL_ID, device=device, dtype=dtype, on_shard=on_shard)
+            print(f"Weights streamed in {report['total_seconds']:.1f}s, peak RSS {report['peak_rss_mb']:.0f} MB")
+            return model
+        except Exception as e:
+            print(f"Streaming load failed ({e}), falling back to from_pretrained")
+    
+    model = AutoModelForCausalLM.from_pretrained(MODEL_ID, trust_remote_code=True, torch_dtype=dtype)
+    set_load_state(stage=f"moving to {device}", progress=0.8)
+    model.to(device)
+    return model
+
+def start_background_load():
+    """Load the model (and warm the scheduler and caches) without blocking startup"""
+    def _load():
+        try:
+            load_model()
+            get_generator()
+            get_image_cache()
+        except Exception as e:
+            print(f"Warning: Could not preload model: {e}")
+    
+    thread = threading.Thread(target=_load, name="model-loader", daemon=True)
+    thread.start()
+    return thread
+
+def add_http_routes(app):
+    """Plain HTTP endpoints next to the Gradio app, for load balancers and rolling restarts"""
+    from fastapi import Request, Response
+    from fastapi.responses import JSONResponse, PlainTextResponse
+    
+    def health():
+        # Liveness: the server is up, whatever state the model is in
+        return JSONResponse({"status": "ok", "model": model_load_state()})
+    
+    def ready():
+        # Readiness: only route traffic here once the model can serve it
+        state = model_load_state()
+        return JSONResponse(state, status_code=200 if state["status"] == "ready" else 503)
+    
+    def transport_info():
+        # Lets clients downscale to what the processor uses before uploading
+        max_side = processor_max_side(global_processor) if global_processor is not None else None
+        return JSONResponse({"formats": list(FORMATS), "max_side": max_side})
+    
+    def has_image(key: str):
+        return Response(status_code=200 if key in image_store else 404)
+    
+    async def upload_image(key: str, request: Request):
+        # Compact upload: lossless WebP or raw RGB bytes, decoded once into the store
+        data = await request.body()
+        if len(data) > MAX_UPLOAD_BYTES:
+            return JSONResponse({"error": "upload too large"}, status_code=413)
+        format = request.headers.get("X-Image-Format", "webp")
+        if format not in FORMATS:
+            return JSONResponse({"error": f"unsupported format {format}"}, status_code=400)
+        try:
+            width = int(request.headers.get("X-Image-Width", "0"))
+            height = int(request.headers.get("X-Image-Height", "0"))
+            image = image_store.put(key, data, format, width, height)
+        except Exception as e:
+            return JSONResponse({"error": f"could not store image: {e}"}, status_code=400)
+        return JSONResponse({"ref": f"sha256:{key}", "width": image.width, "height": image.height})
+    
+    def sessions():
+        return JSONResponse(session_store.stats())
+    
+    def prometheus_metrics():
+        # Scraped by Prometheus for autoscaling and dashboards (see metrics.py)
+        info = {"scheduler": SCHEDULER_MODE, "max_batch_size": MAX_BATCH_SIZE, "model": MODEL_ID}
+        return PlainTextResponse(metrics.exposition(scheduler_stats(), info),
+                                 media_type="text/plain; version=0.0.4")
+    
+    def get_session(session_id: str):
+        session = session_store.get(session_id)
+        if session is None:
+            return JSONResponse({"error": "unknown session"}, status_code=404)
+        return JSONResponse(session_store.summary(session))
+    
+    def end_session(session_id: str):
+        # Clients call this when the user clears the conversation
+        return JSONResponse({"ended": session_store.end(session_id)})
+    
+    app.add_api_route("/health", health, methods=["GET"])
+    app.add_api_route("/ready", ready, methods=["GET"])
+    app.add_api_route("/transport_info", transport_info, methods=["GET"])
+    app.add_api_route("/images/{key}", has_image, methods=["HEAD", "GET"])
+    app.add_api_route("/images/{key}", upload_image, methods=["POST"])
+    app.add_api_route("/metrics", prometheus_metrics, methods=["GET"])
+    app.add_api_route("/sessions", sessions, methods=["GET"])
+    app.add_api_route("/sessions/{session_id}", get_session, methods=["GET"])
+    app.add_api_route("/sessions/{session_id}", end_session, methods=["DELETE"])
+
+def get_generator():
+    """Start the configured request scheduler on first use"""
+    global global_generator
+    
+    model, processor = load_model()
+    with model_lock:
+        if global_generator is None:
+            prefix_cache = PrefixCache(max_bytes=PREFIX_CACHE_MB * 1024 ** 2) if PREFIX_CACHE_MB > 0 else None
+            if SCHEDULER_MODE == "continuous":
+                global_generator = ContinuousBatcher(
+                    model, processor, max_batch_size=MAX_BATCH_SIZE, prefix_cache=prefix_cache
+                )
+            elif SCHEDULER_MODE == "static" and MAX_BATCH_SIZE > 1:
+                global_generator = BatchScheduler(
+                    model, processor, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=BATCH_WINDOW_MS
+                )
+            else:
+                global_generator = OneShotGenerator(model, processor, prefix_cache=prefix_cache)
+            global_generator.start()
+            # Vision encoder time in request traces (no-op unless MAGMA_TRACE is set)
+            vision_tower = find_vision_tower(model)
+            if vision_tower is not None:
+                tracing.trace_module(vision_tower, "vision_tower")
+            # Sessions pin the KV state of their conversation (the static scheduler has no prefix cache)
+            session_store.prefix_cache = getattr(global_generator, "prefix_cache", None)
+    return global_generator
+
+def get_image_cache():
+    """Create the image feature cache on first use (None when disabled)"""
+    global global_image_cache
+    
+    if IMAGE_CACHE_MB <= 0:
+        return None
+    model, processor = load_model()
+    with model_lock:
+        if global_image_cache is None:
+            device = next(model.parameters()).device
+            global_image_cache = ImageFeatureCache(
+                max_bytes=IMAGE_CACHE_MB * 1024 ** 2, device=device, dtype=compute_dtype(model)
+            )
+            if not global_image_cache.attach(model):
+                print("No vision tower found - caching processed images only")
+    return global_image_cache
+
+def scheduler_stats():
+    """Throughput and queue-depth counters of the active scheduler"""
+    stats = {"mode": SCHEDULER_MODE, "max_batch_size": MAX_BATCH_SIZE, "model": model_load_state()}
+    if global_generator is not None:
+        stats.update(global_generator.stats())
+    if global_image_cache is not None:
+        stats["image_cache"] = global_image_cache.stats()
+    stats["image_store"] = image_store.stats()
+    stats["admission"] = admission_control.stats()
+    stats["sessions"] = session_store.stats()
+    return stats
+
 def process_image(image_input):
-    """Process the image input (either uploaded file or URL)"""
+    """Process the image input (uploaded file, URL or an image from the compact upload store)"""
     global last_image
     
-    if isinstance(image_input, str) and image_input.startswith(("http://", "https://")):
+    if isinstance(image_input, Image.Image):
+        # Already decoded by the compact upload route
+        image = image_input
+    elif isinstance(image_input, str) and image_input.startswith(("http://", "https://")):
         # It's a URL
         try:
             image = Image.open(BytesIO(requests.get(image_input, stream=True).content))
@@ -53,86 +317,19 @@ def process_image(image_input):
     
     return image, None
 
-def extract_coordinates(text):
-    """Extract coordinate pattern from text - handles both formats"""
-    # Try four-value bounding box pattern first
-    pattern_bbox = r"Coordinate: \(([0-9.]+), ([0-9.]+), ([0-9.]+), ([0-9.]+)\)"
-    match = re.search(pattern_bbox, text)
-    if match:
-        try:
-            x_min = float(match.group(1))
-            y_min = float(match.group(2))
-            x_max = float(match.group(3))
-            y_max = float(match.group(4))
-            return {'type': 'bbox', 'coords': (x_min, y_min, x_max, y_max)}
-        except ValueError:
-            return None
-    
-    # Try two-value center point pattern
-    pattern_point = r"Coordinate: \(([0-9.]+), ([0-9.]+)\)"
-    match = re.search(pattern_point, text)
-    if match:
-        try:
-            x = float(match.group(1))
-            y = float(match.group(2))
-            return {'type': 'point', 'coords': (x, y)}
-        except ValueError:
-            return None
-            
-    return None
-
 def draw_bounding_box(image, coordinates_data):
     """Draw a bounding box or point marker on an image"""
     if image is None or coordinates_data is None:
         return None
-        
-    # Make a copy to avoid modifying the original
-    img_copy = image.copy()
-    draw = ImageDraw.Draw(img_copy)
-    
-    width, height = img_copy.size
-    
-    if coordinates_data['type'] == 'point':
-        # Draw a point marker (circle with cross)
-        x, y = coordinates_data['coords']
-        
-        # Convert normalized coordinates to pixel coordinates
-        center_x = int(x * width)
-        center_y = int(y * height)
-        
-        # Draw a visible point marker
-        radius = max(10, min(width, height) // 30)  # Scale with image size
-        
-        # Draw cross
-        draw.line([(center_x - radius, center_y), (center_x + radius, center_y)], fill="red", width=3)
-        draw.line([(center_x, center_y - radius), (center_x, center_y + radius)], fill="red", width=3)
-        
-        # Draw circle
-        draw.ellipse((center_x - radius, center_y - radius, center_x + radius, center_y + radius), 
-                     outline="red", width=2)
-    else:
-        # Draw rectangle for bounding box
-        x_min, y_min, x_max, y_max = coordinates_data['coords']
-        
-        # Convert normalized coordinates to pixel coordinates
-        x_min_px = int(x_min * width)
-        y_min_px = int(y_min * height)
-        x_max_px = int(x_max * width)
-        y_max_px = int(y_max * height)
-        
-        # Draw rectangle for bounding box
-        draw.rectangle(
-            [(x_min_px, y_min_px), (x_max_px, y_max_px)],
-            outline="red",
-            width=3
-        )
-    
-    return img_copy
+    return draw_detections(image, [coordinates_data], style="marker")
 
-def generate_response(image_input, system_prompt, user_prompt, chat_history, 
-                      max_new_tokens=128, temperature=0.0, do_sample=False, num_beams=1):
-    """Generate a response from the model based on image and text inputs"""
-    global last_image
+def prepare_request(image_input, system_prompt, user_prompt, chat_history,
+                    max_new_tokens, temperature, do_sample, num_beams):
+    """Build the model inputs for one chat turn
+    
+    Returns (inputs, generation_args, current_image, None), or
+    (None, None, None, reply) when the turn can be answered without the model.
+    """
     
     # Load model if not already loaded
     model, processor = load_model()
@@ -143,9 +340,10 @@ def generate_response(image_input, system_prompt, user_prompt, chat_history,
     
     # Process the image if it's provided
     if image_input is not None:
-        current_image, error = process_image(image_input)
+        with tracing.span("process_image"):
+            current_image, error = process_image(image_input)
         if error:
-            return chat_history + [[None, error]], None
+            return None, None, None, (chat_history + [[None, error]], None)
     else:
         # No new image provided, check if we have previous messages with an image
         is_new_image = False
@@ -154,7 +352,7 @@ def generate_response(image_input, system_prompt, user_prompt, chat_history,
             pass
         else:
             # First message but no image
-            return chat_history + [[user_prompt, "Please provide an image to start the conversation."]], None
+            return None, None, None, (chat_history + [[user_prompt, "Please provide an image to start the conversation."]], None)
     
     # Prepare conversation format
     if not chat_history:
@@ -182,21 +380,24 @@ def generate_response(image_input, system_prompt, user_prompt, chat_history,
     prompt = processor.tokenizer.apply_chat_template(convs, tokenize=False, add_generation_prompt=True)
     
     # Only include image in the processing if it's a new image
-    if is_new_image and current_image is not None:
-        inputs = processor(images=current_image, texts=prompt, return_tensors="pt")
-    else:
-        inputs = processor(texts=prompt, return_tensors="pt")
+    with tracing.span("processor", image=is_new_image and current_image is not None):
+        if is_new_image and current_image is not None:
+            image_cache = get_image_cache()
+            if image_cache is not None:
+                # Reuses the processed tensors (and vision features) of a screenshot seen before
+                inputs = image_cache.process(processor, prompt, current_image)
+            else:
+                inputs = processor(images=current_image, texts=prompt, return_tensors="pt")
+        else:
+            inputs = processor(texts=prompt, return_tensors="pt")
     
     # Handle tensor shapes
     if 'pixel_values' in inputs and inputs['pixel_values'] is not None:
-        inputs['pixel_values'] = inputs['pixel_values'].unsqueeze(0)
+        # bf16 models need bf16 pixels (cached images already are)
+        inputs['pixel_values'] = inputs['pixel_values'].unsqueeze(0).to(compute_dtype(model))
     if 'image_sizes' in inputs and inputs['image_sizes'] is not None:
         inputs['image_sizes'] = inputs['image_sizes'].unsqueeze(0)
     
-    # Send to device
-    device = next(model.parameters()).device
-    inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in inputs.items()}
-    
     # Generate response
     generation_args = {
         "max_new_tokens": max_new_tokens,
@@ -205,24 +406,250 @@ def generate_response(image_input, system_prompt, user_prompt, chat_history,
         "use_cache": True,
         "num_beams": num_beams,
     }
+    return inputs, generation_args, current_image, None
+
+def coordinate_mode(stop_at_coordinate, constrain_coordinate):
+    """Per-request decoding mode for grounding answers (see coordinate_decoding.py)"""
+    if constrain_coordinate:
+        return "constrained"
+    return "stop" if stop_at_coordinate else None
+
+def resolve_image(image_input, image_ref):
+    """The request's image: a compact-upload reference wins over the Gradio image input"""
+    if not image_ref:
+        return image_input
+    try:
+        return image_store.get(image_ref)
+    except KeyError as e:
+        # The client re-uploads and retries on this message
+        raise gr.Error(e.args[0])
+
+def open_session(session_id, chat_history):
+    """The request's session and the full chat history (see session_store.py)"""
+    try:
+        return session_store.open(session_id, chat_history)
+    except KeyError as e:
+        # The client resends the full history on this message
+        raise gr.Error(e.args[0])
+
+def request_admission(request):
+    """(priority, deadline) of an API request (X-Priority, X-Deadline-Ms); None for in-process callers"""
+    if request is None:
+        return None
+    return admission.request_priority(request.headers), admission.request_deadline(request.headers)
+
+@contextmanager
+def admit(claim):
+    """Hold a place at the model while the request runs (see admission.py)
     
-    with torch.inference_mode():
-        generate_ids = model.generate(**inputs, **generation_args)
+    In-process callers (claim None, e.g. eval_grounding.py) go straight to the scheduler.
+    """
+    if claim is None:
+        yield
+        return
+    priority, deadline = claim
+    try:
+        with tracing.span("admission", priority=priority):
+            ticket = admission_control.acquire(priority, deadline)
+    except admission.Rejected as e:
+        # The client retries elsewhere when overloaded and gives up on an expired deadline
+        raise gr.Error(str(e))
+    try:
+        yield
+    finally:
+        admission_control.release(ticket)
+
+def session_image(session, current_image, image_ref):
+    """Remember a new image in the session; returns the image to draw boxes on"""
+    if session is None:
+        return current_image
+    if current_image is not None:
+        session_store.set_image(session, current_image, image_ref)
+        return current_image
+    # Follow-up turn without an image: the conversation's image, not another request's last_image
+    return session.image
+
+def finish_turn(session, chat_history, turn, inputs=None):
+    """Record the turn in the session; returns the chat history to send back
     
-    # Decode response
-    generate_ids = generate_ids[:, inputs["input_ids"].shape[-1]:]
-    response = processor.decode(generate_ids[0], skip_special_tokens=True).strip()
+    Session clients already hold the earlier turns, so they only get the new one.
+    """
+    if session is None:
+        return chat_history + [turn]
+    session_store.append(session, turn, inputs["input_ids"][0] if inputs is not None else None)
+    return [turn]
+
+def tiled_request(tile_grid, image_input):
+    """Whether to ground on tiles of the image instead of the whole (downscaled) image"""
+    return tile_grid not in (None, "", "off") and image_input is not None
+
+def tiled_response(image_input, system_prompt, user_prompt, chat_history, session, image_ref, tile_grid,
+                   max_new_tokens, temperature, do_sample, num_beams, stop_at_coordinate, constrain_coordinate):
+    """Ground the question on every tile of a high-resolution image (see image_splitter.py)
     
-    # Check for coordinates in the response
-    coordinates_data = extract_coordinates(response)
-    image_with_box = None
+    Single-shot: earlier turns are not part of the tiles' prompt. Returns
+    (chat history, image with box) like generate_response.
+    """
+    model, processor = load_model()
+    image, error = process_image(image_input)
+    if error:
+        return finish_turn(session, chat_history, [None, error]), None
+    session_image(session, image, image_ref)
+    generation_args = {
+        "max_new_tokens": max_new_tokens,
+        "temperature": temperature,
+        "do_sample": do_sample,
+        "use_cache": True,
+        "num_beams": num_beams,
+    }
+    result = ground_tiles(
+        model, processor, image, user_prompt, system_prompt, grid=parse_grid(tile_grid), overlap=TILE_OVERLAP,
+        generation_args=generation_args,
+        coordinate_mode=coordinate_mode(stop_at_coordinate, constrain_coordinate) or "stop",
+        image_cache=get_image_cache(), max_side=processor_max_side(processor)
+    )
+    best = result["best"]
+    if best is None:
+        cols, rows = result["grid"]
+        response = f"No coordinate found in any of the {cols}x{rows} tiles."
+        return finish_turn(session, chat_history, [user_prompt, response]), None
+    coords = best["coords"]
+    image_with_box = draw_bounding_box(image, {"type": "bbox" if len(coords) == 4 else "point", "coords": coords})
+    return finish_turn(session, chat_history, [user_prompt, format_coordinates(coords)]), image_with_box
+
+def request_trace(request):
+    """Trace context the client sent along (model_client.py's traceparent header, see tracing.py)"""
+    if request is None:
+        return ()
+    return tracing.from_traceparent(request.headers.get("traceparent"))
+
+def generate_response(image_input, system_prompt, user_prompt, chat_history, 
+                      max_new_tokens=128, temperature=0.0, do_sample=False, num_beams=1,
+                      stop_at_coordinate=False, constrain_coordinate=False, image_ref="", session_id="",
+                      tile_grid="off", request: gr.Request = None):
+    """Generate a response from the model based on image and text inputs
+    
+    stop_at_coordinate ends decoding once a complete Coordinate: (...) has been
+    generated; constrain_coordinate also restricts the answer to that format.
+    image_ref ("sha256:...") names an image uploaded to /images instead of image_input.
+    session_id ("<id>#<turns>") keeps the chat history on the server: chat_history
+    may then be empty and only the new turn is returned.
+    tile_grid ("3x2", "auto" or "off") grounds on overlapping tiles of the image.
+    request is filled in by Gradio (not an API input); it carries the trace context
+    and the X-Priority / X-Deadline-Ms headers for admission control.
+    """
+    claim = request_admission(request)
+    with metrics.track("generate_response"), \
+            tracing.span("generate_response", kind=tracing.SERVER, root=True, parents=request_trace(request),
+                         scheduler=SCHEDULER_MODE, session=bool(session_id), tile_grid=tile_grid), \
+            admit(claim):
+        with tracing.span("open_session"):
+            session, chat_history = open_session(session_id, chat_history)
+        with tracing.span("resolve_image", image_ref=bool(image_ref)):
+            image_input = resolve_image(image_input, image_ref)
+        if tiled_request(tile_grid, image_input):
+            with tracing.span("tiled_grounding"):
+                return tiled_response(image_input, system_prompt, user_prompt, chat_history, session, image_ref,
+                                      tile_grid, max_new_tokens, temperature, do_sample, num_beams,
+                                      stop_at_coordinate, constrain_coordinate)
+        with tracing.span("prepare_request"):
+            inputs, generation_args, current_image, reply = prepare_request(
+                image_input, system_prompt, user_prompt, chat_history, max_new_tokens, temperature, do_sample,
+                num_beams
+            )
+        if reply is not None:
+            return finish_turn(session, reply[0][:-1], reply[0][-1]), reply[1]
+        box_image = session_image(session, current_image, image_ref)
+        
+        # Hand the request to the scheduler, which may batch it with concurrent requests
+        with tracing.span("scheduler", mode=SCHEDULER_MODE):
+            response = get_generator().submit(
+                dict(inputs), generation_args, coordinate_mode=coordinate_mode(stop_at_coordinate, constrain_coordinate)
+            )
+        
+        # Check for coordinates in the response
+        with tracing.span("extract_coordinates"):
+            coordinates_data = extract_coordinates(response)
+        image_with_box = None
+        
+        if coordinates_data:
+            # Draw bounding box on this request's image (last_image may belong to a concurrent request)
+            with tracing.span("draw_box"):
+                image_with_box = draw_bounding_box(box_image if box_image is not None else last_image,
+                                                   coordinates_data)
+        
+        # Update chat history - this keeps the image sticky in the UI
+        with tracing.span("finish_turn"):
+            return finish_turn(session, chat_history, [user_prompt, response], inputs), image_with_box
+
+def generate_response_stream(image_input, system_prompt, user_prompt, chat_history,
+                             max_new_tokens=128, temperature=0.0, do_sample=False, num_beams=1,
+                             stop_at_coordinate=False, constrain_coordinate=False, image_ref="", session_id="",
+                             tile_grid="off", request: gr.Request = None):
+    """Like generate_response, but yields the partial answer after every decoding step
     
-    if coordinates_data:
-        # Draw bounding box on the image
-        image_with_box = draw_bounding_box(last_image, coordinates_data)
+    The box is drawn as soon as a complete Coordinate: (...) appears. Tiled
+    requests yield once, with the merged answer.
+    """
+    claim = request_admission(request)
+    trace = tracing.start("generate_response_stream", kind=tracing.SERVER, root=True,
+                          parents=request_trace(request), scheduler=SCHEDULER_MODE, session=bool(session_id),
+                          tile_grid=tile_grid)
+    # Gradio runs every step of a generator in a fresh context, so the span is re-attached per step
+    with metrics.track("generate_response_stream"):
+        yield from tracing.iterate(trace, stream_response(
+            image_input, system_prompt, user_prompt, chat_history, max_new_tokens, temperature, do_sample,
+            num_beams, stop_at_coordinate, constrain_coordinate, image_ref, session_id, tile_grid, claim
+        ))
+
+def stream_response(image_input, system_prompt, user_prompt, chat_history, max_new_tokens, temperature, do_sample,
+                    num_beams, stop_at_coordinate, constrain_coordinate, image_ref, session_id, tile_grid, claim):
+    """generate_response_stream's steps (spans in here must not be open across a yield)"""
+    with admit(claim):
+        with tracing.span("open_session"):
+            session, chat_history = open_session(session_id, chat_history)
+        with tracing.span("resolve_image", image_ref=bool(image_ref)):
+            image_input = resolve_image(image_input, image_ref)
+        if tiled_request(tile_grid, image_input):
+            with tracing.span("tiled_grounding"):
+                reply = tiled_response(image_input, system_prompt, user_prompt, chat_history, session, image_ref,
+                                       tile_grid, max_new_tokens, temperature, do_sample, num_beams, stop_at_coordinate,
+                                       constrain_coordinate)
+            yield reply
+            return
+        with tracing.span("prepare_request"):
+            inputs, generation_args, current_image, reply = prepare_request(
+                image_input, system_prompt, user_prompt, chat_history, max_new_tokens, temperature, do_sample, num_beams
+            )
+        if reply is not None:
+            yield finish_turn(session, reply[0][:-1], reply[0][-1]), reply[1]
+            return
+        box_image = session_image(session, current_image, image_ref)
+        # Partial answers go out as the new turn only to session clients
+        history = [] if session is not None else chat_history
     
-    # Update chat history - this keeps the image sticky in the UI
-    return chat_history + [[user_prompt, response]], image_with_box
+        _, processor = load_model()
+        stream = submit_streaming(
+            get_generator(), processor.tokenizer, dict(inputs), generation_args,
+            coordinate_mode=coordinate_mode(stop_at_coordinate, constrain_coordinate)
+        )
+        image_with_box = None
+        text = ""
+        try:
+            for text in stream:
+                if image_with_box is None:
+                    coordinates_data = extract_coordinates(text)
+                    if coordinates_data:
+                        with tracing.span("draw_box"):
+                            image_with_box = draw_bounding_box(
+                                box_image if box_image is not None else last_image, coordinates_data
+                            )
+                yield history + [[user_prompt, text]], image_with_box
+            with tracing.span("finish_turn"):
+                finish_turn(session, chat_history, [user_prompt, text], inputs)
+        finally:
+            # The client went away (or we are done): stop decoding this sequence
+            stream.cancel()
 
 def clear_conversation(image):
     """Clear the conversation history but keep the current image"""
@@ -265,8 +692,21 @@ with gr.Blocks() as demo:
                     minimum=1, maximum=5, value=1, step=1,
                     label="Number of Beams"
                 )
+                stop_at_coordinate = gr.Checkbox(label="Stop at first complete Coordinate", value=False)
+                constrain_coordinate = gr.Checkbox(label="Answer with a Coordinate only (constrained decoding)", value=False)
+                tile_grid = gr.Dropdown(
+                    choices=["off", "auto", "2x2", "3x2", "3x3", "4x3"], value="off",
+                    label="Tiled grounding for high-resolution screenshots (columns x rows)"
+                )
+            
+            # Compact transport: reference to an image uploaded to /images (API clients only)
+            image_ref = gr.Textbox(value="", visible=False)
+            # Server-side chat session "<id>#<turns>" (API clients only, see session_store.py)
+            session_id = gr.Textbox(value="", visible=False)
             
             submit_btn = gr.Button("Generate Response")
+            # Keeps the non-streaming /generate_response API for existing clients
+            generate_btn = gr.Button("Generate Response (blocking)", visible=False)
             clear_btn = gr.Button("Clear Conversation")
         
         with gr.Column(scale=1):
@@ -274,6 +714,10 @@ with gr.Blocks() as demo:
             chatbot = gr.Chatbot(label="Conversation", height=400)
             # Display image with bounding box
             bbox_image = gr.Image(label="Image with Bounding Box", type="pil", visible=True)
+            
+            with gr.Accordion("Scheduler Stats", open=False):
+                stats_json = gr.JSON(label="Throughput and queue depth")
+                stats_btn = gr.Button("Refresh Stats")
     
     # Event handlers
     def use_url_as_image(url):
@@ -288,13 +732,27 @@ with gr.Blocks() as demo:
     
     image_url.change(use_url_as_image, image_url, image_input)
     
+    # The UI streams the answer token by token
     submit_btn.click(
+        generate_response_stream,
+        inputs=[
+            image_input, system_prompt, user_prompt, chatbot,
+            max_tokens, temperature, do_sample, num_beams, stop_at_coordinate, constrain_coordinate, image_ref, session_id,
+            tile_grid
+        ],
+        outputs=[chatbot, bbox_image],
+        api_name="generate_response_stream"
+    )
+    
+    generate_btn.click(
         generate_response,
         inputs=[
             image_input, system_prompt, user_prompt, chatbot,
-            max_tokens, temperature, do_sample, num_beams
+            max_tokens, temperature, do_sample, num_beams, stop_at_coordinate, constrain_coordinate, image_ref, session_id,
+            tile_grid
         ],
-        outputs=[chatbot, bbox_image]
+        outputs=[chatbot, bbox_image],
+        api_name="generate_response"
     )
     
     clear_btn.click(
@@ -302,14 +760,20 @@ with gr.Blocks() as demo:
         inputs=[image_input],
         outputs=[chatbot, image_input, bbox_image]
     )
+    
+    stats_btn.click(scheduler_stats, inputs=None, outputs=stats_json, api_name="scheduler_stats")
 
 # Launch the demo
 if __name__ == "__main__":
-    # Load model on startup (optional, can also load on first request)
-    try:
-        load_model()
-    except Exception as e:
-        print(f"Warning: Could not preload model: {e}")
+    # Load the model in the background so the server binds immediately;
+    # requests that arrive before it is ready wait for the load to finish
+    start_background_load()
+    
+    # Let every request the admission control can hold through Gradio's (FIFO)
+    # queue; admission_control decides who gets to the model, and in what order
+    demo.queue(default_concurrency_limit=admission_control.capacity())
     
     # Launch Gradio app
-    demo.launch(share=True) 
\ No newline at end of file
+    demo.launch(share=SHARE, prevent_thread_lock=True, max_threads=max(40, admission_control.capacity() + 8))
+    add_http_routes(demo.app)
+    demo.block_thread() 
\ No newline at end of file
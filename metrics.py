@@ -0,0 +1,404 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Prometheus metrics of the model server, served as text at /metrics next to
+# the Gradio app (magma_gradio.add_http_routes), for autoscaling replicas and
+# for catching regressions after a config change. Two sources:
+#   - events counted as they happen, in the metrics defined below: requests
+#     and their latency, batch sizes, admission and queue wait and time to
+#     first token
+#   - the counters the components already keep (scheduler_stats(): the
+#     scheduler, admission control, prefix/image caches, image store,
+#     sessions, model load), plus device memory, read when /metrics is scraped
+# No prometheus_client needed: the text format is written here.
+# serve_replicas.py serves the workers' pages merged, with a worker label,
+# plus its own routing counters, so one scrape covers every replica.
+#   curl http://127.0.0.1:7860/metrics
+# Tokens/s and request rate are rate(magma_scheduler_generated_tokens_total[1m])
+# and rate(magma_requests_total[1m]) on the Prometheus side.
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+FIRST_TOKEN_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+START_TIME = time.time()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """One metric family; samples are kept per label values"""
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.labels)
+
+    def samples(self):
+        """[(suffix, label pairs, value)]"""
+        with self.lock:
+            return [("", key, value) for key, value in self.values.items()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), sum
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        with self.lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        samples = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", key + (("le", _format_value(bound)),), cumulative))
+            samples.append(("_sum", key, total))
+            samples.append(("_count", key, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+
+def render(metrics):
+    """Prometheus text exposition (format 0.0.4) of metric families"""
+    lines = []
+    for metric in metrics:
+        samples = metric.samples()
+        if not samples:
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, labels, value in samples:
+            lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUESTS = registry.counter("magma_requests_total", "Finished API requests", ("api", "status"))
+REQUEST_SECONDS = registry.histogram("magma_request_seconds", "API request latency", ("api",))
+IN_FLIGHT = registry.gauge("magma_requests_in_flight", "API requests being served", ("api",))
+BATCH_SIZE = registry.histogram("magma_batch_size", "Sequences per generate call or decoding step",
+                                ("scheduler",), BATCH_SIZE_BUCKETS)
+QUEUE_SECONDS = registry.histogram("magma_queue_seconds", "Time a request waited for the scheduler",
+                                   ("scheduler",), FIRST_TOKEN_BUCKETS)
+TIME_TO_FIRST_TOKEN = registry.histogram("magma_time_to_first_token_seconds",
+                                         "From submission to the scheduler to the first generated token",
+                                         ("scheduler",), FIRST_TOKEN_BUCKETS)
+ADMISSION_SECONDS = registry.histogram("magma_admission_wait_seconds", "Time a request waited for a model slot",
+                                       ("priority",), FIRST_TOKEN_BUCKETS)
+
+
+@contextmanager
+def track(api):
+    """Count one API request and its latency
+
+    Can stay open across yields, so a streaming generator is tracked as a
+    whole; a client that goes away counts as "cancelled".
+    """
+    started = time.monotonic()
+    IN_FLIGHT.inc(api=api)
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    except GeneratorExit:
+        status = "cancelled"
+        raise
+    finally:
+        IN_FLIGHT.dec(api=api)
+        REQUESTS.inc(api=api, status=status)
+        REQUEST_SECONDS.observe(time.monotonic() - started, api=api)
+
+
+# Scrape-time metrics from scheduler_stats()
+
+SCHEDULER_COUNTERS = {
+    "requests": "Requests the scheduler finished",
+    "generated_tokens": "Tokens generated",
+    "errors": "Requests that failed in the scheduler",
+    "busy_seconds": "Seconds the scheduler spent generating",
+    "decode_steps": "Decoding steps of the continuous batcher",
+    "beam_search_requests": "Beam search requests run outside the continuous batch",
+    "coordinate_stops": "Answers ended early once their coordinate was complete",
+    "coordinate_tokens_saved": "Tokens not generated thanks to coordinate stops",
+}
+SCHEDULER_GAUGES = {
+    "queue_depth": "Requests waiting for the scheduler",
+    "active_sequences": "Sequences in the running continuous batch",
+    "mean_batch_size": "Mean batch size since start",
+    "tokens_per_second": "Generated tokens per busy second since start",
+}
+# stats key -> (cache label, hits key, misses key, bytes key or None, megabytes key or None)
+CACHES = [
+    ("prefix_cache", "prefix", "hits", "misses", "bytes", None),
+    ("image_cache", "image", "hits", "misses", "bytes", None),
+    ("image_cache", "vision", "vision_hits", "vision_misses", None, None),
+    ("image_store", "image_store", "hits", "misses", None, "mb"),
+]
+ADMISSION_GAUGES = {
+    "waiting": "Requests waiting for a model slot",
+    "running": "Requests holding a model slot",
+}
+ADMISSION_COUNTERS = {
+    "admitted": "Requests let through to the model",
+    "shed": "Requests turned away because their class's queue was full",
+    "expired": "Requests dropped before prefill because their deadline passed",
+}
+SESSION_COUNTERS = ("created", "turns", "resyncs", "unknown", "expired", "evictions", "ended")
+
+
+def _family(kind, name, help, labels=()):
+    return {"counter": Counter, "gauge": Gauge}[kind](name, help, labels)
+
+
+def stats_metrics(stats):
+    """Metric families of a scheduler_stats() snapshot"""
+    families = []
+    mode = stats.get("mode", "")
+    for key, help in SCHEDULER_COUNTERS.items():
+        if key in stats:
+            family = _family("counter", f"magma_scheduler_{key}_total", help, ("scheduler",))
+            family.inc(stats[key], scheduler=mode)
+            families.append(family)
+    for key, help in SCHEDULER_GAUGES.items():
+        if key in stats:
+            family = _family("gauge", f"magma_scheduler_{key}", help, ("scheduler",))
+            family.set(stats[key], scheduler=mode)
+            families.append(family)
+
+    hits = _family("counter", "magma_cache_hits_total", "Cache lookups that hit", ("cache",))
+    misses = _family("counter", "magma_cache_misses_total", "Cache lookups that missed", ("cache",))
+    ratio = _family("gauge", "magma_cache_hit_ratio", "Share of cache lookups that hit since start", ("cache",))
+    evictions = _family("counter", "magma_cache_evictions_total", "Entries evicted for space", ("cache",))
+    size = _family("gauge", "magma_cache_bytes", "Memory held by the cache", ("cache",))
+    for stats_key, cache, hits_key, misses_key, bytes_key, mb_key in CACHES:
+        cache_stats = stats.get(stats_key)
+        if not cache_stats or hits_key not in cache_stats:
+            continue
+        lookups = cache_stats[hits_key] + cache_stats[misses_key]
+        hits.inc(cache_stats[hits_key], cache=cache)
+        misses.inc(cache_stats[misses_key], cache=cache)
+        ratio.set(cache_stats[hits_key] / lookups if lookups else 0.0, cache=cache)
+        if hits_key == "hits" and "evictions" in cache_stats:
+            evictions.inc(cache_stats["evictions"], cache=cache)
+        if bytes_key is not None and bytes_key in cache_stats:
+            size.set(cache_stats[bytes_key], cache=cache)
+        elif mb_key is not None and mb_key in cache_stats:
+            size.set(int(cache_stats[mb_key] * 1024 ** 2), cache=cache)
+    families += [hits, misses, ratio, evictions, size]
+
+    sessions = stats.get("sessions")
+    if sessions:
+        family = _family("gauge", "magma_sessions", "Chat sessions held on the server")
+        family.set(sessions.get("sessions", 0))
+        families.append(family)
+        for key in SESSION_COUNTERS:
+            if key in sessions:
+                family = _family("counter", f"magma_session_{key}_total", f"Session events: {key}")
+                family.inc(sessions[key])
+                families.append(family)
+
+    admission = stats.get("admission")
+    if admission:
+        slots = _family("gauge", "magma_admission_slots", "Requests let through to the model at once")
+        slots.set(admission["slots"])
+        families.append(slots)
+        for key, help in ADMISSION_GAUGES.items():
+            family = _family("gauge", f"magma_admission_{key}", help, ("priority",))
+            for priority, counts in admission.items():
+                if isinstance(counts, dict):
+                    family.set(counts[key], priority=priority)
+            families.append(family)
+        for key, help in ADMISSION_COUNTERS.items():
+            family = _family("counter", f"magma_admission_{key}_total", help, ("priority",))
+            for priority, counts in admission.items():
+                if isinstance(counts, dict):
+                    family.inc(counts[key], priority=priority)
+            families.append(family)
+
+    model = stats.get("model")
+    if model:
+        ready = _family("gauge", "magma_model_ready", "1 once the model can serve requests")
+        ready.set(model.get("status") == "ready")
+        progress = _family("gauge", "magma_model_load_progress", "Progress of the model load, 0 to 1")
+        progress.set(model.get("progress") or 0.0)
+        families += [ready, progress]
+        if model.get("load_seconds") is not None:
+            load = _family("gauge", "magma_model_load_seconds", "Seconds the last model load took")
+            load.set(model["load_seconds"])
+            families.append(load)
+    return families
+
+
+def memory_metrics():
+    """Process and accelerator memory"""
+    # Imported here: the router (serve_replicas.py) uses this module without torch
+    from fast_loader import current_rss_mb, peak_rss_mb
+
+    families = []
+    rss = current_rss_mb()
+    if rss is not None:
+        family = _family("gauge", "process_resident_memory_bytes", "Resident memory of the server process")
+        family.set(int(rss * 1024 ** 2))
+        families.append(family)
+    peak = _family("gauge", "magma_peak_resident_memory_bytes", "Peak resident memory of the server process")
+    peak.set(int(peak_rss_mb() * 1024 ** 2))
+    families.append(peak)
+
+    import torch
+    device = _family("gauge", "magma_device_memory_bytes", "Accelerator memory", ("device", "kind"))
+    if torch.cuda.is_available():
+        for index in range(torch.cuda.device_count()):
+            name = f"cuda:{index}"
+            device.set(torch.cuda.memory_allocated(index), device=name, kind="allocated")
+            device.set(torch.cuda.memory_reserved(index), device=name, kind="reserved")
+            device.set(torch.cuda.max_memory_allocated(index), device=name, kind="peak_allocated")
+    elif getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available():
+        device.set(torch.mps.current_allocated_memory(), device="mps", kind="allocated")
+        device.set(torch.mps.driver_allocated_memory(), device="mps", kind="driver")
+    families.append(device)
+    return families
+
+
+def exposition(stats=None, info=None):
+    """The /metrics page: event metrics, plus a scheduler_stats() snapshot and memory
+
+    info labels a constant magma_info sample (scheduler mode, batch size,
+    model...), so a config change shows up next to the numbers it moved.
+    """
+    families = list(registry.metrics)
+    if info:
+        family = _family("gauge", "magma_info", "Server configuration", tuple(sorted(info)))
+        family.set(1, **{key: str(value) for key, value in info.items()})
+        families.append(family)
+    start = _family("gauge", "process_start_time_seconds", "Unix time the server process started")
+    start.set(START_TIME)
+    families.append(start)
+    if stats:
+        families += stats_metrics(stats)
+    families += memory_metrics()
+    return render(families)
+
+
+# Several servers' pages as one (serve_replicas.py)
+
+def merge_pages(pages):
+    """One exposition of [(labels, page text)], every sample getting its page's labels
+
+    Samples stay grouped by metric family, as the text format requires.
+    """
+    families = {}  # name -> [comment lines, sample lines]
+    for labels, text in pages:
+        extra = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+        family = None
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            if line.startswith("#"):
+                parts = line.split(None, 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    family = families.setdefault(parts[2], [[], []])
+                    if line not in family[0]:
+                        family[0].append(line)
+                continue
+            if family is None:
+                family = families.setdefault(line.split("{")[0].split()[0], [[], []])
+            if extra:
+                name, brace, rest = line.partition("{")
+                if brace:
+                    line = f"{name}{{{extra},{rest}" if not rest.startswith("}") else f"{name}{{{extra}{rest}"
+                else:
+                    name, _, value = line.partition(" ")
+                    line = f"{name}{{{extra}}} {value}"
+            family[1].append(line)
+    lines = []
+    for comments, samples in families.values():
+        lines += comments + samples
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,757 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import httpx
+
+import tracing
+from admission import DEADLINE_EXCEEDED, OVERLOADED
+from image_transport import REF_PREFIX, TRANSPORT, UNKNOWN_IMAGE, UPLOAD_FORMAT, UPLOAD_MAX_SIDE, downscale, encode, image_hash
+from session_store import UNKNOWN_SESSION
+
+# Shared asyncio client for magma_gradio.py (and stub_server.py). Every caller
+# in a process goes through one pooled httpx.AsyncClient, so requests reuse
+# keep-alive connections and any number of them can be in flight at once.
+# Requests speak gradio's queue protocol directly (/queue/join, /queue/data,
+# /cancel) so that a cancelled or expired request also stops the work on the
+# server. On top of that:
+#   - deadlines: one time.monotonic() instant bounds uploads, retries and the
+#     answer, and the time left is sent along as X-Deadline-Ms
+#   - retries with exponential backoff and jitter for connection errors,
+#     overload (429/5xx) and images the server has evicted (re-uploaded)
+#   - hedging: with a second endpoint, a request still unanswered after
+#     hedge_after seconds is also sent there; the first answer wins and the
+#     other copy is cancelled
+#   - server-side sessions: with a session_id, a server that holds the
+#     conversation (session_store.py) gets only the new message, and the
+#     full history again if it has lost it
+#   - priorities: requests say whether a user is waiting for them
+#     ("interactive") or they are part of a sweep ("batch") in X-Priority, and
+#     the server's admission control (admission.py) serves them in that order;
+#     a request the server sheds for overload is retried like a 503
+#   - tracing: with MAGMA_TRACE set, every request and attempt is a span and
+#     the server's spans join the trace through a traceparent header (tracing.py)
+# Blocking callers (the GUIs' QThreads, pipeline.py's threads) use
+# shared_client(), which runs the client on a background event loop.
+#   python model_client.py --requests 200 --concurrency 16     # benchmark against stub_server.py
+#   python model_client.py --server http://127.0.0.1:7860/ --requests 20
+
+TIMEOUT = float(os.environ.get("MAGMA_CLIENT_TIMEOUT", "120"))
+RETRIES = int(os.environ.get("MAGMA_CLIENT_RETRIES", "2"))
+BACKOFF = float(os.environ.get("MAGMA_CLIENT_BACKOFF", "0.25"))
+# Seconds without an answer before the request is also sent to the next endpoint (0 = no hedging)
+HEDGE_AFTER = float(os.environ.get("MAGMA_CLIENT_HEDGE_AFTER", "0"))
+MAX_CONNECTIONS = int(os.environ.get("MAGMA_CLIENT_CONNECTIONS", "32"))
+# Priority class of requests that do not name one ("interactive" or "batch"; empty = the server's default)
+PRIORITY = os.environ.get("MAGMA_CLIENT_PRIORITY", "")
+# Extra endpoints (comma separated) used for retries and hedging after the main one
+FALLBACK_URLS = [url for url in os.environ.get("MAGMA_FALLBACK_URLS", "").split(",") if url.strip()]
+
+# Recent images whose encoded uploads are kept for further requests
+PREPARED_IMAGES = 16
+
+FILE_DATA = {"_type": "gradio.FileData"}
+_pil_lock = threading.Lock()
+
+
+class ModelError(Exception):
+    """A failed request; retryable ones may succeed on another attempt or endpoint"""
+
+    def __init__(self, message, retryable=False, endpoint=None, reupload=False):
+        super().__init__(message)
+        self.retryable = retryable
+        self.endpoint = endpoint
+        self.reupload = reupload  # the server lost the image or session: retry at once, sending it again
+
+
+class DeadlineExceeded(ModelError):
+    pass
+
+
+class Endpoint:
+    """One model server: its API layout, the images it holds and its request counters"""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.api = None  # api_name -> (fn_index, [(parameter, default), ...])
+        self.transport = None  # /transport_info, {} without compact uploads
+        self.known = set()  # image hashes this server is known to hold
+        self.sessions = set()  # session ids whose turns this server holds
+        self.lock = asyncio.Lock()
+        self.in_flight = 0
+        self.failures = 0  # consecutive failed attempts
+        self.counters = {"attempts": 0, "ok": 0, "errors": 0, "cancelled": 0, "uploads": 0, "bytes_sent": 0}
+
+    def stats(self):
+        return dict(self.counters, url=self.url, in_flight=self.in_flight, failures=self.failures,
+                    sessions=len(self.sessions))
+
+
+class PreparedImage:
+    """An image downscaled and encoded once per request, uploadable to any endpoint"""
+
+    def __init__(self, source):
+        self.source = source
+        self.url = source if isinstance(source, str) and source.startswith(("http://", "https://")) else None
+        self.compact = {}  # (max_side, format) -> (key, width, height, bytes)
+        self.png = None
+        self.lock = threading.Lock()  # hedged copies encode once between them
+
+    def pil(self):
+        from PIL import Image
+        if isinstance(self.source, str):
+            return Image.open(self.source)
+        if hasattr(self.source, "pil"):
+            return self.source.pil()
+        # Concurrent requests may share one lazily loaded PIL image
+        with _pil_lock:
+            self.source.load()
+        return self.source
+
+    def _encoded(self, max_side, format):
+        if (max_side, format) not in self.compact:
+            image = downscale(self.pil(), max_side)
+            self.compact[max_side, format] = (image_hash(image), image.width, image.height, encode(image, format))
+        return self.compact[max_side, format]
+
+    def compact_upload(self, max_side, format):
+        """(key, width, height, bytes) to upload: downscaled to max_side, or full size if that is smaller
+
+        Lossless WebP thrives on the flat regions of a page, which resampling
+        blurs, so a screenshot often takes fewer bytes at full size than
+        downscaled (photos go the other way). Both are encoded, once, and the
+        smaller one is sent; raw uploads are always smaller downscaled.
+        """
+        with self.lock:
+            upload = self._encoded(max_side, format)
+            if format == "webp" and max_side is not None and max(self.pil().size) > max_side:
+                full = self._encoded(None, format)
+                if len(full[3]) < len(upload[3]):
+                    upload = full
+            return upload
+
+    def png_bytes(self):
+        with self.lock:
+            return self._png_bytes()
+
+    def _png_bytes(self):
+        if self.png is None:
+            if isinstance(self.source, str):
+                with open(self.source, "rb") as f:
+                    self.png = f.read()
+            elif hasattr(self.source, "data"):
+                self.png = bytes(self.source.data)  # ImageBuffer: the PNG as captured
+            else:
+                out = io.BytesIO()
+                self.source.save(out, format="PNG")
+                self.png = out.getvalue()
+        return self.png
+
+
+class ModelClient:
+    """Pooled, concurrent client for one model server plus optional fallbacks
+
+    urls[0] is the main endpoint; the others take retries and hedged copies,
+    and take over from an endpoint that keeps failing. Use it from a single
+    event loop (shared_client() provides one for threaded callers).
+    """
+
+    def __init__(self, urls, timeout=None, retries=None, backoff=None, hedge_after=None, max_connections=None,
+                 upload_format=None, priority=None):
+        urls = [urls] if isinstance(urls, str) else list(urls)
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.timeout = timeout or TIMEOUT
+        self.retries = RETRIES if retries is None else retries
+        self.backoff = BACKOFF if backoff is None else backoff
+        self.hedge_after = HEDGE_AFTER if hedge_after is None else hedge_after
+        self.max_connections = max_connections or MAX_CONNECTIONS
+        self.upload_format = upload_format or UPLOAD_FORMAT
+        self.priority = PRIORITY if priority is None else priority
+        self.http = None
+        self.background = set()  # fire-and-forget /cancel calls
+        self.prepared = OrderedDict()  # recent images -> PreparedImage
+        self.counters = {
+            "requests": 0,
+            "ok": 0,
+            "failed": 0,
+            "attempts": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "reuploads": 0,
+            "resyncs": 0,
+            "cancelled": 0,
+            "deadline_exceeded": 0,
+            "overloaded": 0,
+        }
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _http(self):
+        if self.http is None:
+            limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+            self.http = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(self.timeout, connect=10.0))
+        return self.http
+
+    async def close(self):
+        if self.background:
+            await asyncio.wait(self.background, timeout=2)
+        if self.http is not None:
+            await self.http.aclose()
+            self.http = None
+
+    def _prepare(self, image):
+        """PreparedImage of image, shared by requests about the same image (encoded once)"""
+        if isinstance(image, str):
+            key = (image, os.path.getmtime(image) if os.path.exists(image) else None)
+        else:
+            key = id(image)
+        entry = self.prepared.get(key)
+        if entry is None or entry.source is not image and not isinstance(image, str):
+            entry = PreparedImage(image)
+            self.prepared[key] = entry
+            while len(self.prepared) > PREPARED_IMAGES:
+                self.prepared.popitem(last=False)
+        self.prepared.move_to_end(key)
+        return entry
+
+    async def connect(self):
+        """Fetch the main endpoint's API layout now; raises ModelError if it is unreachable"""
+        try:
+            await self._describe(self.endpoints[0])
+        except httpx.HTTPError as e:
+            raise ModelError(f"{self.endpoints[0].url}: {type(e).__name__} {e}", retryable=True) from e
+
+    def _order(self):
+        # Endpoints that have been failing go last; otherwise the main one first
+        return sorted(self.endpoints, key=lambda e: e.failures)
+
+    async def _describe(self, endpoint):
+        """Fetch the endpoint's API layout and transport info once"""
+        async with endpoint.lock:
+            if endpoint.api is not None:
+                return
+            http = self._http()
+            config = await self._get_json(endpoint, "/config")
+            info = await self._get_json(endpoint, "/info")
+            api = {}
+            for index, dependency in enumerate(config.get("dependencies", [])):
+                name = dependency.get("api_name")
+                parameters = info.get("named_endpoints", {}).get(f"/{name}", {}).get("parameters")
+                if name and parameters is not None:
+                    api[name] = (index, [(p["parameter_name"], p.get("parameter_default")) for p in parameters])
+            try:
+                response = await http.get(f"{endpoint.url}/transport_info")
+                endpoint.transport = response.json() if response.status_code == 200 else {}
+            except httpx.HTTPError:
+                endpoint.transport = {}
+            endpoint.api = api
+
+    async def _get_json(self, endpoint, path):
+        response = await self._http().get(endpoint.url + path)
+        if response.status_code != 200:
+            raise ModelError(f"{endpoint.url}{path}: HTTP {response.status_code}",
+                             retryable=response.status_code >= 500 or response.status_code == 429, endpoint=endpoint)
+        return response.json()
+
+    async def _image_args(self, endpoint, image, headers, full_resolution=False):
+        """image_input/image_ref arguments for an image on this endpoint (uploading it if needed)
+
+        full_resolution skips the downscale to the processor's size (tiled requests need the detail).
+        """
+        if image.url:
+            # Remote images are fetched by the server
+            return {"image_input": {"path": image.url, "url": image.url, "meta": FILE_DATA}}
+        http = self._http()
+        loop = asyncio.get_running_loop()
+        if TRANSPORT == "compact" and endpoint.transport:
+            max_side = None if full_resolution else UPLOAD_MAX_SIDE or endpoint.transport.get("max_side")
+            key, width, height, data = await loop.run_in_executor(
+                None, image.compact_upload, max_side, self.upload_format)
+            if key not in endpoint.known:
+                url = f"{endpoint.url}/images/{key}"
+                if (await http.head(url, headers=headers)).status_code != 200:
+                    response = await http.post(url, content=data, headers={
+                        **headers,
+                        "Content-Type": "application/octet-stream",
+                        "X-Image-Format": self.upload_format,
+                        "X-Image-Width": str(width),
+                        "X-Image-Height": str(height),
+                    })
+                    if response.status_code != 200:
+                        raise ModelError(f"image upload failed: HTTP {response.status_code}",
+                                         retryable=response.status_code >= 500, endpoint=endpoint)
+                    endpoint.counters["uploads"] += 1
+                    endpoint.counters["bytes_sent"] += len(data)
+                endpoint.known.add(key)
+            return {"image_input": None, "image_ref": REF_PREFIX + key}
+        # Plain gradio upload of the PNG
+        data = await loop.run_in_executor(None, image.png_bytes)
+        response = await http.post(f"{endpoint.url}/upload", headers=headers, files=[("files", ("image.png", data, "image/png"))])
+        if response.status_code != 200:
+            raise ModelError(f"image upload failed: HTTP {response.status_code}",
+                             retryable=response.status_code >= 500, endpoint=endpoint)
+        endpoint.counters["uploads"] += 1
+        endpoint.counters["bytes_sent"] += len(data)
+        path = response.json()[0]
+        return {"image_input": {"path": path, "orig_name": "image.png", "meta": FILE_DATA}}
+
+    async def _attempt(self, endpoint, api_name, image, params, deadline, on_partial, session_id=None, priority=None):
+        """One try on one endpoint; returns the output data"""
+        http = self._http()
+        endpoint.in_flight += 1
+        endpoint.counters["attempts"] += 1
+        self.counters["attempts"] += 1
+        fn_index = session_hash = event_id = None
+        completed = evicted = False
+        try:
+            with tracing.span("describe"):
+                await self._describe(endpoint)
+            if api_name not in endpoint.api:
+                raise ModelError(f"{endpoint.url} has no /{api_name} endpoint", endpoint=endpoint)
+            fn_index, parameters = endpoint.api[api_name]
+            args = dict(params)
+            history = None
+            if session_id and "chat_history" in args and any(name == "session_id" for name, _ in parameters):
+                # Server-side session: once the server holds the earlier turns, send only the new message
+                history = list(args["chat_history"] or [])
+                args["session_id"] = f"{session_id}#{len(history)}"
+                if session_id in endpoint.sessions:
+                    args["chat_history"] = []
+
+            def full(data):
+                # The server answers a session request with the new turn only
+                if history is None or not data or not isinstance(data[0], list):
+                    return data
+                return [history + data[0]] + list(data[1:])
+            # X-Session-Id keeps a conversation on one replica behind serve_replicas.py
+            headers = {"X-Session-Id": session_id} if session_id else {}
+            # The server's spans of this attempt become its children
+            traceparent = tracing.traceparent()
+            if traceparent:
+                headers["traceparent"] = traceparent
+            if image is not None:
+                tiled = args.get("tile_grid") not in (None, "", "off")
+                with tracing.span("upload_image"):
+                    args.update(await self._image_args(endpoint, image, headers, full_resolution=tiled))
+            session_hash = uuid.uuid4().hex
+            headers["X-Deadline-Ms"] = str(max(0, int((deadline - time.monotonic()) * 1000)))
+            if priority:
+                headers["X-Priority"] = priority
+            with tracing.span("queue_join"):
+                response = await http.post(f"{endpoint.url}/queue/join", headers=headers, json={
+                    "data": [args.get(name, default) for name, default in parameters],
+                    "fn_index": fn_index,
+                    "session_hash": session_hash,
+                    "event_data": None,
+                    "trigger_id": None,
+                    # Whole outputs in every process_generating message, not gradio's diffs against the last one
+                    "simple_format": True,
+                })
+            if response.status_code != 200:
+                raise ModelError(f"{endpoint.url}: HTTP {response.status_code} {response.text[:200]}",
+                                 retryable=response.status_code >= 500 or response.status_code == 429,
+                                 endpoint=endpoint)
+            event_id = response.json().get("event_id")
+            # Until process_starts the request waits in the server's gradio queue
+            joined = time.monotonic()
+
+            async with http.stream("GET", f"{endpoint.url}/queue/data", params={"session_hash": session_hash},
+                                   headers=headers, timeout=httpx.Timeout(None, connect=10.0)) as stream:
+                async for line in stream.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    message = json.loads(line[5:])
+                    kind = message.get("msg")
+                    if kind == "process_starts":
+                        tracing.record("server_queue", joined, time.monotonic())
+                    elif kind == "process_generating" and on_partial is not None:
+                        data = (message.get("output") or {}).get("data")
+                        if data:
+                            on_partial(full(data))
+                    elif kind == "process_completed":
+                        completed = True
+                        output = message.get("output") or {}
+                        if not message.get("success"):
+                            error = str(output.get("error") or "request failed").strip("'\"")
+                            if UNKNOWN_IMAGE in error and image is not None:
+                                # Evicted since we uploaded it: forget it and send it again
+                                endpoint.known.clear()
+                                evicted = True
+                                self.counters["reuploads"] += 1
+                                raise ModelError(error, retryable=True, endpoint=endpoint, reupload=True)
+                            if UNKNOWN_SESSION in error and history is not None:
+                                # Expired or evicted on the server (or another replica): resend the history
+                                endpoint.sessions.discard(session_id)
+                                evicted = True
+                                self.counters["resyncs"] += 1
+                                raise ModelError(error, retryable=True, endpoint=endpoint, reupload=True)
+                            if OVERLOADED in error:
+                                # Shed by the server's admission control: back off or go elsewhere
+                                self.counters["overloaded"] += 1
+                                raise ModelError(error, retryable=True, endpoint=endpoint)
+                            if DEADLINE_EXCEEDED in error:
+                                raise DeadlineExceeded(error, endpoint=endpoint)
+                            raise ModelError(error, endpoint=endpoint)
+                        endpoint.counters["ok"] += 1
+                        endpoint.failures = 0
+                        if history is not None:
+                            endpoint.sessions.add(session_id)
+                        return full(output.get("data"))
+            raise ModelError(f"{endpoint.url}: stream closed before the answer", retryable=True, endpoint=endpoint)
+        except asyncio.CancelledError:
+            endpoint.counters["cancelled"] += 1
+            raise
+        except httpx.HTTPError as e:
+            endpoint.counters["errors"] += 1
+            endpoint.failures += 1
+            raise ModelError(f"{endpoint.url}: {type(e).__name__} {e}", retryable=True, endpoint=endpoint) from e
+        except ModelError as e:
+            endpoint.counters["errors"] += 1
+            if e.retryable and not evicted:
+                endpoint.failures += 1
+            raise
+        finally:
+            endpoint.in_flight -= 1
+            if event_id and not completed:
+                # Abandoned (cancelled, deadline, hedge lost): stop the work on the server too
+                task = asyncio.ensure_future(self._cancel(endpoint, fn_index, session_hash, event_id))
+                self.background.add(task)
+                task.add_done_callback(self.background.discard)
+
+    async def _traced_attempt(self, endpoint, *args):
+        with tracing.span("attempt", kind=tracing.CLIENT, endpoint=endpoint.url):
+            return await self._attempt(endpoint, *args)
+
+    async def _cancel(self, endpoint, fn_index, session_hash, event_id):
+        try:
+            await self._http().post(f"{endpoint.url}/cancel", timeout=5, json={
+                "session_hash": session_hash, "fn_index": fn_index, "event_id": event_id})
+        except Exception:
+            pass
+
+    async def _hedged(self, endpoints, api_name, image, params, deadline, on_partial, session_id=None, priority=None):
+        """Run one attempt, hedged to the next endpoint if it is slow; returns (data, endpoint, hedged)"""
+        owner = []
+
+        def partial_from(endpoint):
+            # Only one copy's partial answers reach the caller
+            def forward(data):
+                if not owner:
+                    owner.append(endpoint)
+                if owner[0] is endpoint:
+                    on_partial(data)
+            return forward if on_partial is not None else None
+
+        def start(endpoint):
+            nonlocal started
+            task = asyncio.ensure_future(
+                self._traced_attempt(endpoint, api_name, image, params, deadline, partial_from(endpoint), session_id,
+                                     priority))
+            tasks[task] = endpoint
+            started += 1
+
+        tasks = {}
+        started = 0
+        start(endpoints[0])
+        spare = list(endpoints[1:]) if self.hedge_after > 0 else []
+        error = None
+        try:
+            while tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded("deadline exceeded")
+                wait = min(remaining, self.hedge_after) if spare and len(tasks) == 1 else remaining
+                done, _ = await asyncio.wait(list(tasks), timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if spare and len(tasks) == 1 and time.monotonic() < deadline:
+                        self.counters["hedges"] += 1
+                        start(spare.pop(0))
+                    continue
+                for task in done:
+                    endpoint = tasks.pop(task)
+                    try:
+                        data = task.result()
+                    except ModelError as e:
+                        # Keep waiting for the other copy; a failed main attempt hedges at once
+                        error = error if error is not None and not error.retryable else e
+                        if spare and not tasks and e.retryable:
+                            self.counters["hedges"] += 1
+                            start(spare.pop(0))
+                        continue
+                    hedged = started > 1
+                    if hedged and endpoint is not endpoints[0]:
+                        self.counters["hedge_wins"] += 1
+                    return data, endpoint, hedged
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def predict(self, api_name, image=None, deadline=None, timeout=None, on_partial=None, session_id=None,
+                      priority=None, **params):
+        """Call a server API with retries, hedging and a deadline
+
+        image is a PIL image, ImageBuffer, file path or http(s) URL (passed as
+        image_input); params are the API's other parameters by name, defaults
+        filled in from the server. deadline is a time.monotonic() instant
+        (default now + timeout). on_partial(data) gets streamed outputs.
+        session_id names the conversation, for routers that keep it on one replica;
+        servers with a session_id parameter keep its chat_history themselves.
+        priority ("interactive" or "batch", default the client's) orders the
+        request in the server's admission control.
+        Returns {"data", "endpoint", "attempts", "hedged", "seconds"}.
+        """
+        priority = priority or self.priority
+        with tracing.span("model_client." + api_name, kind=tracing.CLIENT, root=True, priority=priority) as span:
+            started = time.monotonic()
+            if deadline is None:
+                deadline = started + (timeout or self.timeout)
+            self.counters["requests"] += 1
+            prepared = self._prepare(image) if image is not None else None
+            attempt = 0
+            try:
+                while True:
+                    try:
+                        # A failed attempt moves its endpoint back, so retries go elsewhere first
+                        data, endpoint, hedged = await self._hedged(
+                            self._order(), api_name, prepared, params, deadline, on_partial, session_id, priority)
+                    except DeadlineExceeded:
+                        raise
+                    except ModelError as e:
+                        attempt += 1
+                        # Back off from failing servers; an evicted image just needs uploading again
+                        delay = 0 if e.reupload else self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                        if not e.retryable or attempt > self.retries or time.monotonic() + delay >= deadline:
+                            raise
+                        self.counters["retries"] += 1
+                        # The retry and its cause go into the request's trace, not stdout
+                        with tracing.span("retry_backoff", attempt=attempt, delay=round(delay, 3), error=str(e)):
+                            await asyncio.sleep(delay)
+                        continue
+                    self.counters["ok"] += 1
+                    span.set(endpoint=endpoint.url, attempts=attempt + 1, hedged=hedged)
+                    return {
+                        "data": data,
+                        "endpoint": endpoint.url,
+                        "attempts": attempt + 1,
+                        "hedged": hedged,
+                        "seconds": round(time.monotonic() - started, 3),
+                    }
+            except asyncio.CancelledError:
+                self.counters["cancelled"] += 1
+                raise
+            except DeadlineExceeded:
+                self.counters["deadline_exceeded"] += 1
+                raise
+            except ModelError:
+                self.counters["failed"] += 1
+                raise
+
+    async def generate(self, image, user_prompt, system_prompt="", chat_history=None, stream=True,
+                       on_partial=None, deadline=None, timeout=None, **params):
+        """Ask about an image; returns predict()'s result plus "text" and "chat_history"
+
+        With stream=True on_partial(text) gets the answer generated so far.
+        """
+        def forward(data):
+            if data and data[0]:
+                on_partial(data[0][-1][1] or "")
+        result = await self.predict(
+            "generate_response_stream" if stream else "generate_response", image,
+            deadline=deadline, timeout=timeout, on_partial=forward if on_partial is not None else None,
+            system_prompt=system_prompt, user_prompt=user_prompt, chat_history=chat_history or [], **params)
+        data = result["data"] or [[], None]
+        result["chat_history"] = data[0] or []
+        result["text"] = result["chat_history"][-1][1] if result["chat_history"] else ""
+        return result
+
+    async def end_session(self, session_id):
+        """Drop a conversation from the servers holding it (e.g. when the user clears it)"""
+        for endpoint in self.endpoints:
+            if session_id not in endpoint.sessions:
+                continue
+            endpoint.sessions.discard(session_id)
+            try:
+                await self._http().delete(f"{endpoint.url}/sessions/{session_id}", timeout=5,
+                                          headers={"X-Session-Id": session_id})
+            except httpx.HTTPError:
+                pass  # it expires on the server anyway
+
+    def stats(self):
+        return dict(self.counters, endpoints=[e.stats() for e in self.endpoints])
+
+
+# Background event loop for callers that are threads
+_loop = None
+_loop_lock = threading.Lock()
+_clients = {}
+
+
+def background_loop():
+    """The process-wide event loop that shared clients run on (started on first use)"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="model-client", daemon=True).start()
+        return _loop
+
+
+class SharedClient:
+    """Thread-safe front of a ModelClient running on the background loop
+
+    submit() returns a concurrent.futures.Future; cancelling it cancels the
+    request, on the server too. Callbacks run on the loop's thread.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.loop = background_loop()
+
+    def submit(self, method, *args, **kwargs):
+        # The caller's span (if any) stays the parent of the request's spans on the loop
+        coroutine = tracing.carry(getattr(self.client, method)(*args, **kwargs))
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def connect(self):
+        return self.submit("connect").result()
+
+    def generate(self, *args, **kwargs):
+        return self.submit("generate", *args, **kwargs).result()
+
+    def predict(self, *args, **kwargs):
+        return self.submit("predict", *args, **kwargs).result()
+
+    def stats(self):
+        return asyncio.run_coroutine_threadsafe(self._stats(), self.loop).result()
+
+    async def _stats(self):
+        return self.client.stats()
+
+
+def shared_client(url, fallbacks=None, **options):
+    """The SharedClient for url (plus MAGMA_FALLBACK_URLS), created once per process"""
+    urls = tuple(u.rstrip("/") for u in [url] + list(FALLBACK_URLS if fallbacks is None else fallbacks))
+    key = (urls, tuple(sorted(options.items())))
+    with _loop_lock:
+        client = _clients.get(key)
+    if client is None:
+        client = SharedClient(ModelClient(list(urls), **options))
+        with _loop_lock:
+            client = _clients.setdefault(key, client)
+    return client
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+async def run_load(make_client, requests, concurrency, image=None, fresh=False, **generate):
+    """Send `requests` generate calls, `concurrency` at a time; returns a result summary"""
+    client = None if fresh else make_client()
+    latencies = []
+    failures = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal failures
+        async with semaphore:
+            started = time.monotonic()
+            # fresh: a new client per request, like a new gradio_client.Client (no pooling)
+            own = make_client() if fresh else client
+            try:
+                await own.generate(image, "Where is the Continue button?", **generate)
+                latencies.append(time.monotonic() - started)
+            except ModelError:
+                failures += 1
+            finally:
+                if fresh:
+                    await own.close()
+
+    started = time.monotonic()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.monotonic() - started
+    stats = client.stats() if client is not None else {}
+    if client is not None:
+        await client.close()
+    return {
+        "ok": len(latencies),
+        "failed": failures,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        "retries": stats.get("retries", 0),
+        "hedges": stats.get("hedges", 0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the model client against stub servers or a real one")
+    parser.add_argument("--server", help="model server URL (default: start stub servers)")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--image", help="image file sent with every request (default: a synthetic screenshot)")
+    args = parser.parse_args()
+
+    from PIL import Image, ImageDraw
+    if args.image:
+        image = Image.open(args.image).convert("RGB")
+    else:
+        image = Image.new("RGB", (1000, 700), "#f4f4f4")
+        ImageDraw.Draw(image).rounded_rectangle([400, 500, 600, 560], 10, fill=(30, 120, 220))
+
+    servers = []
+    if args.server:
+        main_url = fallback_url = flaky_url = slow_url = args.server
+    else:
+        from stub_server import start_stub_server
+
+        def stub(**options):
+            server, url = start_stub_server(concurrency=args.concurrency, **options)
+            servers.append(server)
+            return url
+
+        # Same latency everywhere; one stub fails 20% of requests, one has a slow tail
+        main_url = stub()
+        fallback_url = stub()
+        flaky_url = stub(fail_rate=0.2)
+        slow_url = stub(slow_rate=0.05, slow_factor=10)
+
+    scenarios = [
+        ("sequential, client per request", lambda: ModelClient(main_url), 1, {"fresh": True}),
+        ("sequential, pooled", lambda: ModelClient(main_url), 1, {}),
+        (f"{args.concurrency} in flight, pooled", lambda: ModelClient(main_url), args.concurrency, {}),
+        ("20% failures, no retries", lambda: ModelClient(flaky_url, retries=0), args.concurrency, {}),
+        ("20% failures, 2 retries", lambda: ModelClient(flaky_url, retries=2, backoff=0.05), args.concurrency, {}),
+        ("slow tail, no hedging", lambda: ModelClient(slow_url, hedge_after=0), args.concurrency, {}),
+        ("slow tail, hedged", lambda: ModelClient([slow_url, fallback_url], hedge_after=0.6), args.concurrency, {}),
+    ]
+    print(f"{'scenario':>32} {'ok':>5} {'failed':>6} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'retries':>7} {'hedges':>6}")
+    for name, make_client, concurrency, options in scenarios:
+        requests = args.requests if concurrency > 1 else max(10, args.requests // 10)
+        r = asyncio.run(run_load(make_client, requests, concurrency, image, **options))
+        print(f"{name:>32} {r['ok']:>5} {r['failed']:>6} {r['rps']:>7} {r['p50_ms']:>8} {r['p95_ms']:>8} "
+              f"{r['p99_ms']:>8} {r['retries']:>7} {r['hedges']:>6}")
+    for server in servers:
+        server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
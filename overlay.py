@@ -0,0 +1,333 @@
+import threading
+import time
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+
+# Markers for grounding answers, drawn the same way by magma_gradio.py, the
+# desktop app and the web automation app. Detections come in as NumPy arrays
+# of normalized points (N, 2) and boxes (N, 4) and are scaled to pixels in one
+# vectorized step, truncating like int(x * width).
+#
+# Point markers (a ring and a cross) are what costs: ImageDraw spends some
+# 10-30 us on each. Many of them go through a reused RGBA layer instead: the
+# marker is rendered once per size into a sprite, its pixels are written at
+# every center with one NumPy scatter per color, and the layer goes onto a
+# copy of the image in a single alpha-blended paste. That paste is a
+# full-frame pass (about 8 ms at 1080p), so the layer is only used once the
+# points' sprites would cover the frame a few times over; the one marker
+# the apps draw today is drawn with ImageDraw straight onto the copy. Boxes
+# are a single rectangle call each and are always drawn that way, after the
+# points, as are points reaching over the image edge. Either way the "marker"
+# style comes out pixel-identical to the code the apps used before
+# (draw_one_by_one, checked by main()).
+#
+#   python overlay.py                    # parity check, then 1 to 10k markers: one by one vs overlay
+#   python overlay.py --size 3840x2160
+
+
+def rgba(color, alpha=255):
+    if isinstance(color, tuple):
+        return color if len(color) == 4 else color + (alpha,)
+    return ImageColor.getrgb(color)[:3] + (alpha,)
+
+
+def to_pixels(coords, size):
+    """Normalized (N, 2) points or (N, 4) boxes -> integer pixel coordinates, in one step"""
+    # float64, so the products round exactly like the Python floats of int(x * width)
+    coords = np.asarray(coords, dtype=np.float64)
+    width, height = size
+    scale = np.array([width, height] * (coords.shape[-1] // 2), dtype=np.float64)
+    # Truncation, like int(x * width)
+    return (coords * scale).astype(np.int64)
+
+
+def split_detections(detections):
+    """(points (N, 2), boxes (M, 4)) arrays from coordinate dicts ({"type", "coords"}) or tuples"""
+    points, boxes = [], []
+    for detection in detections:
+        if detection is None:
+            continue
+        coords = detection["coords"] if isinstance(detection, dict) else detection
+        (boxes if len(coords) == 4 else points).append(coords)
+    return (np.asarray(points, dtype=np.float64).reshape(-1, 2),
+            np.asarray(boxes, dtype=np.float64).reshape(-1, 4))
+
+
+# Styles: the parts of a point marker (draw, x, y, radius) and of a box
+# (image, draw, x0, y0, x1, y1), drawn with ImageDraw, and the point radius
+# for an image size
+
+RED = rgba("red")[:3]
+CYAN = rgba("#00E5FF")[:3]
+ORANGE = rgba("#FF5722")[:3]
+YELLOW = rgba("#FFEB3B")[:3]
+
+
+def _marker_point(draw, x, y, r):
+    draw.line([(x - r, y), (x + r, y)], fill=RED, width=3)
+    draw.line([(x, y - r), (x, y + r)], fill=RED, width=3)
+    draw.ellipse((x - r, y - r, x + r, y + r), outline=RED, width=2)
+
+
+def _marker_box(image, draw, x0, y0, x1, y1):
+    draw.rectangle((x0, y0, x1, y1), outline=RED, width=3)
+
+
+def _highlight_point(draw, x, y, r):
+    for i, color in enumerate([CYAN, ORANGE, YELLOW]):
+        ring = r - i * 3
+        if ring > 0:
+            draw.ellipse((x - ring, y - ring, x + ring, y + ring), outline=color, width=3)
+    draw.line((x - 2 * r, y, x - r, y), fill=ORANGE, width=2)
+    draw.line((x, y - 2 * r, x, y + 2 * r), fill=ORANGE, width=2)
+
+
+def _highlight_box(image, draw, x0, y0, x1, y1):
+    # Semi-transparent orange inside, a cyan border and yellow corner brackets
+    if x1 > x0 and y1 > y0:
+        fill = Image.new("RGBA", (x1 - x0, y1 - y0), ORANGE + (80,))
+        image.paste(fill, (x0, y0), fill)
+    draw.rectangle((x0, y0, x1, y1), outline=CYAN, width=4)
+    length = min(30, (x1 - x0) // 4, (y1 - y0) // 4)
+    for x, dx in ((x0, 1), (x1, -1)):
+        for y, dy in ((y0, 1), (y1, -1)):
+            draw.line((x, y, x + length * dx, y), fill=YELLOW, width=3)
+            draw.line((x, y, x, y + length * dy), fill=YELLOW, width=3)
+
+
+def _reticle_point(draw, x, y, r):
+    draw.ellipse((x - r, y - r, x + r, y + r), outline=CYAN, width=2)
+    inner = r // 2
+    draw.ellipse((x - inner, y - inner, x + inner, y + inner), outline=CYAN, width=1)
+    length = r * 1.5
+    for start, end in ((-length, -r), (r, length)):
+        draw.line((x + start, y, x + end, y), fill=CYAN, width=2)
+        draw.line((x, y + start, x, y + end), fill=CYAN, width=2)
+    corner = r // 2
+    for sx in (-1, 1):
+        for sy in (-1, 1):
+            cx, cy = x + sx * r, y + sy * r
+            draw.line((cx, cy, cx - sx * corner, cy), fill=CYAN, width=2)
+            draw.line((cx, cy, cx, cy - sy * corner), fill=CYAN, width=2)
+
+
+STYLES = {
+    # magma_gradio.py and the desktop app: red cross in a circle, red box outline
+    "marker": {"point": _marker_point, "box": _marker_box, "radius": lambda side: max(10, side // 30)},
+    # web automation app, detected element: rings and crosshair, filled box with brackets
+    "highlight": {"point": _highlight_point, "box": _highlight_box, "radius": lambda side: max(15, side // 25)},
+    # web automation app, element picked by hand: targeting reticle
+    "reticle": {"point": _reticle_point, "box": _highlight_box, "radius": lambda side: max(20, side // 20)},
+}
+
+# Points go through the layer once their sprites' squares add up to this many
+# image areas; below that the full-frame paste costs more than it saves (the
+# break-even is a few hundred points at 600x600, about 2000 at 1080p and 4K)
+LAYER_MIN_COVERAGE = 4.0
+
+_sprites = {}
+_sprites_lock = threading.Lock()
+
+
+def point_sprite(style, radius):
+    """([(packed color, dy, dx)], reach) of one point marker: its pixels relative to the center
+
+    Rendered once per style and radius with the style's own drawing, so the
+    pixels are exactly the ones ImageDraw sets for a marker away from the
+    edges; reach is how far they extend from the center.
+    """
+    key = (style, radius)
+    with _sprites_lock:
+        sprite = _sprites.get(key)
+    if sprite is None:
+        half = 2 * radius + 4  # room for crosshairs reaching past the rings
+        canvas = Image.new("RGBA", (2 * half + 1, 2 * half + 1), (0, 0, 0, 0))
+        STYLES[style]["point"](ImageDraw.Draw(canvas), half, half, radius)
+        pixels = np.asarray(canvas).view(np.uint32)[..., 0]
+        dy, dx = np.nonzero(pixels)
+        reach = int(max(np.abs(dy - half).max(), np.abs(dx - half).max()))
+        parts = []
+        for color in np.unique(pixels[dy, dx]):
+            mask = pixels[dy, dx] == color
+            parts.append((color, (dy[mask] - half).astype(np.int64), (dx[mask] - half).astype(np.int64)))
+        sprite = (parts, reach)
+        with _sprites_lock:
+            _sprites[key] = sprite
+    return sprite
+
+
+def draw_labels(image, points, boxes, radius):
+    """Coordinate text next to every marker, outlined for contrast (one ImageDraw call per label)"""
+    draw = ImageDraw.Draw(image)
+    width, height = image.size
+    labels = []
+    for (x, y), (px, py) in zip(points, to_pixels(points, (width, height))):
+        labels.append(((int(px) + radius, int(py) - radius), f"({x:.3f}, {y:.3f})"))
+    for coords, (x0, y0, x1, y1) in zip(boxes, to_pixels(boxes, (width, height))):
+        text = "(" + ", ".join(f"{value:.2f}" for value in coords) + ")"
+        labels.append(((int(x0) + 5, int(y0) - 25 if y0 > 25 else int(y1) + 5), text))
+    for (x, y), text in labels:
+        for dx, dy in ((-1, -1), (-1, 1), (1, -1), (1, 1)):
+            draw.text((x + dx, y + dy), text, fill="#000000")
+        draw.text((x, y), text, fill="#FFFFFF")
+
+
+class Overlay:
+    """Draws any number of point and box markers onto a copy of an image
+
+    Points first, then boxes, as draw_one_by_one does. Enough points are
+    painted into an RGBA layer (kept between calls for images of the same
+    size, and shared with a PIL view of it) that is pasted onto the copy once
+    and cleared again. Not thread-safe; draw_detections() keeps one per thread.
+    """
+
+    def __init__(self, style="marker", layer_min_coverage=LAYER_MIN_COVERAGE):
+        self.style = style
+        self.layer_min_coverage = layer_min_coverage
+        self.layer = None  # (height, width) uint32 RGBA pixels, all zero between calls
+        self.layer_image = None  # PIL view of the same memory; never drawn on (that would detach it)
+
+    def _layer(self, size):
+        width, height = size
+        if self.layer is None or self.layer_image.size != size:
+            pixels = np.zeros((height, width, 4), dtype=np.uint8)
+            self.layer = pixels.view(np.uint32)[..., 0]
+            self.layer_image = Image.frombuffer("RGBA", size, pixels, "raw", "RGBA", 0, 1)
+        return self.layer
+
+    def _paint_points(self, result, centers, radius):
+        """Point markers inside the image through the layer; returns the centers left to draw"""
+        width, height = result.size
+        parts, reach = point_sprite(self.style, radius)
+        if len(centers) * (2 * reach + 1) ** 2 < self.layer_min_coverage * width * height:
+            return centers
+        inside = ((centers >= reach) & (centers < [width - reach, height - reach])).all(1)
+        starts = centers[inside, 1] * width + centers[inside, 0]
+        pixels = self._layer(result.size).reshape(-1)
+        try:
+            for color, dy, dx in parts:
+                pixels[(starts[:, None] + (dy * width + dx)[None, :]).reshape(-1)] = color
+            result.paste(self.layer_image, (0, 0), self.layer_image)
+        finally:
+            pixels.fill(0)
+        return centers[~inside]
+
+    def render(self, image, points=None, boxes=None, labels=False):
+        """RGB copy of image with a marker per normalized point (N, 2) and box (N, 4)"""
+        points = np.zeros((0, 2)) if points is None else np.asarray(points, np.float64).reshape(-1, 2)
+        boxes = np.zeros((0, 4)) if boxes is None else np.asarray(boxes, np.float64).reshape(-1, 4)
+        result = image.convert("RGB") if image.mode != "RGB" else image.copy()
+        width, height = result.size
+        radius = STYLES[self.style]["radius"](min(width, height))
+
+        centers = to_pixels(points, result.size)
+        if len(centers):
+            centers = self._paint_points(result, centers, radius)
+        draw = ImageDraw.Draw(result)
+        draw_point = STYLES[self.style]["point"]
+        for x, y in centers.tolist():
+            draw_point(draw, x, y, radius)
+        draw_box = STYLES[self.style]["box"]
+        for x0, y0, x1, y1 in to_pixels(boxes, result.size).tolist():
+            draw_box(result, draw, x0, y0, x1, y1)
+        if labels:
+            draw_labels(result, points, boxes, radius)
+        return result
+
+
+_local = threading.local()
+
+
+def draw_detections(image, detections, style="marker", labels=False):
+    """RGB copy of image (PIL) with markers for coordinate dicts/tuples; None without an image"""
+    if image is None:
+        return None
+    overlays = getattr(_local, "overlays", None)
+    if overlays is None:
+        overlays = _local.overlays = {}
+    overlay = overlays.get(style)
+    if overlay is None:
+        overlay = overlays[style] = Overlay(style)
+    points, boxes = split_detections(detections)
+    return overlay.render(image, points, boxes, labels)
+
+
+def draw_one_by_one(image, points, boxes):
+    """The previous approach, for the benchmark: one ImageDraw call per marker part"""
+    image = image.convert("RGB") if image.mode != "RGB" else image.copy()
+    draw = ImageDraw.Draw(image)
+    width, height = image.size
+    radius = max(10, min(width, height) // 30)
+    for x, y in points:
+        cx, cy = int(x * width), int(y * height)
+        draw.line([(cx - radius, cy), (cx + radius, cy)], fill="red", width=3)
+        draw.line([(cx, cy - radius), (cx, cy + radius)], fill="red", width=3)
+        draw.ellipse((cx - radius, cy - radius, cx + radius, cy + radius), outline="red", width=2)
+    for x0, y0, x1, y1 in boxes:
+        draw.rectangle([(int(x0 * width), int(y0 * height)), (int(x1 * width), int(y1 * height))],
+                       outline="red", width=3)
+    return image
+
+
+def check_parity(rng):
+    """Raise if the "marker" style differs by a pixel from draw_one_by_one, drawn or painted"""
+    for size in ((600, 600), (1920, 1080), (801, 333)):
+        image = Image.new("RGB", size, "#f4f4f4")
+        points = np.concatenate([
+            [(0.29, 0.57), (0.0, 0.0), (0.999, 0.999), (0.5, 0.001)],  # truncation and image edges
+            rng.random((500, 2)),
+        ])
+        corners = rng.random((500, 2)) * 0.9
+        boxes = np.concatenate([
+            [(0.1, 0.1, 0.1, 0.1), (0.2, 0.2, 0.201, 0.5), (0.3, 0.3, 0.6, 0.302), (0.95, 0.95, 1.0, 1.0)],  # narrower than the outline
+            np.concatenate([corners, corners + rng.random((500, 2)) * 0.1], 1),
+        ])
+        expected = draw_one_by_one(image, points.tolist(), boxes.tolist())
+        for path, layer_min_coverage in (("drawn", float("inf")), ("layer", 0)):
+            actual = Overlay("marker", layer_min_coverage).render(image, points, boxes)
+            if expected.tobytes() != actual.tobytes():
+                differing = np.argwhere(np.any(np.asarray(expected) != np.asarray(actual), axis=2))
+                raise AssertionError(f"{size[0]}x{size[1]} {path}: {len(differing)} pixels differ, "
+                                     f"first at (x, y) = {tuple(differing[0][::-1])}")
+    print("parity with draw_one_by_one: ok")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark marker rendering")
+    parser.add_argument("--size", default="1920x1080", help="image size WIDTHxHEIGHT")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.split("x"))
+    image = Image.new("RGB", (width, height), "#f4f4f4")
+    rng = np.random.default_rng(0)
+    overlay = Overlay("marker")
+    check_parity(rng)
+
+    def timed(function):
+        function()  # warm up (sprite, layer)
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            function()
+        return (time.perf_counter() - started) / args.repeat * 1000
+
+    print(f"{width}x{height}, markers split evenly between points and boxes")
+    print(f"{'markers':>8} {'one by one ms':>14} {'overlay ms':>11} {'speedup':>8}")
+    for count in (1, 100, 1_000, 5_000, 10_000):
+        points = rng.random((max(1, count // 2), 2))
+        corners = rng.random((count // 2, 2)) * 0.9
+        boxes = np.concatenate([corners, corners + rng.random((count // 2, 2)) * 0.1], 1)
+        if count == 1:
+            boxes = boxes[:0]
+        # Python floats, as the one-by-one code got them from the parser
+        point_list, box_list = points.tolist(), boxes.tolist()
+        slow = timed(lambda: draw_one_by_one(image, point_list, box_list))
+        fast = timed(lambda: overlay.render(image, points, boxes))
+        print(f"{count:>8} {slow:14.2f} {fast:11.2f} {slow / fast:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import copy
+import time
+
+# Event-driven "is the page ready?" check for the Selenium paths, replacing
+# fixed sleeps. A small script is injected into the page that tracks network
+# activity (fetch/XHR in flight plus resource timing), DOM mutations and
+# running animations; the page is polled until every enabled signal settles.
+# Each signal has its own timeout, so one chatty signal (e.g. an ad that keeps
+# mutating the DOM) costs at most its timeout instead of blocking the capture.
+
+DEFAULT_READINESS = {
+    "poll_ms": 50,
+    "timeout": 10.0,  # overall cap in seconds
+    # Document loaded, no fetch/XHR in flight and no network activity for idle_ms
+    "network_idle": {"enabled": True, "idle_ms": 300, "timeout": 5.0},
+    # Fewer than max_mutations DOM mutations within the last window_ms
+    "dom_quiet": {"enabled": True, "window_ms": 300, "max_mutations": 2, "timeout": 4.0},
+    # No finite CSS/Web animations or transitions running (spinners that loop forever are ignored)
+    "animations": {"enabled": True, "timeout": 2.0},
+    # Bounding boxes of the first max_elements elements unchanged for stable_polls polls
+    "layout_stable": {"enabled": True, "stable_polls": 3, "max_elements": 1500, "timeout": 4.0},
+}
+
+SIGNALS = ("network_idle", "dom_quiet", "animations", "layout_stable")
+
+# Per-page overrides, matched as substrings of the URL (later entries win), e.g.
+#   PAGE_READINESS["localhost:8000"] = {"network_idle": {"idle_ms": 100}}
+#   PAGE_READINESS["news.example.com"] = {"dom_quiet": {"enabled": False}}
+PAGE_READINESS = {}
+
+# Installs the trackers once per document and returns the current state
+POLL_SCRIPT = """
+var windowMs = arguments[0], maxElements = arguments[1];
+if (!window.__magmaReadiness) {
+    var state = {inflight: 0, lastNetwork: 0, mutations: [], installedAt: performance.now()};
+    var resources = performance.getEntriesByType ? performance.getEntriesByType('resource') : [];
+    for (var i = 0; i < resources.length; i++) {
+        state.lastNetwork = Math.max(state.lastNetwork, resources[i].responseEnd);
+    }
+    var touch = function () { state.lastNetwork = performance.now(); };
+    if (window.fetch) {
+        var originalFetch = window.fetch;
+        window.fetch = function () {
+            state.inflight++; touch();
+            return originalFetch.apply(this, arguments).finally(function () { state.inflight--; touch(); });
+        };
+    }
+    var originalSend = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.send = function () {
+        state.inflight++; touch();
+        this.addEventListener('loadend', function () { state.inflight--; touch(); });
+        return originalSend.apply(this, arguments);
+    };
+    if (window.PerformanceObserver) {
+        try { new PerformanceObserver(touch).observe({type: 'resource'}); } catch (e) {}
+    }
+    new MutationObserver(function (records) {
+        state.mutations.push([performance.now(), records.length]);
+    }).observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+    window.__magmaReadiness = state;
+}
+var s = window.__magmaReadiness, now = performance.now();
+s.mutations = s.mutations.filter(function (m) { return now - m[0] <= windowMs; });
+var mutations = 0;
+for (var j = 0; j < s.mutations.length; j++) { mutations += s.mutations[j][1]; }
+var animations = 0;
+if (document.getAnimations) {
+    document.getAnimations().forEach(function (a) {
+        var timing = a.effect && a.effect.getComputedTiming ? a.effect.getComputedTiming() : null;
+        if (a.playState === 'running' && timing && isFinite(timing.iterations)) { animations++; }
+    });
+}
+var hash = 0, elements = document.body ? document.body.getElementsByTagName('*') : [];
+var count = Math.min(elements.length, maxElements);
+for (var k = 0; k < count; k++) {
+    var r = elements[k].getBoundingClientRect();
+    hash = (hash * 31 + Math.round(r.left)) | 0;
+    hash = (hash * 31 + Math.round(r.top)) | 0;
+    hash = (hash * 31 + Math.round(r.width)) | 0;
+    hash = (hash * 31 + Math.round(r.height)) | 0;
+}
+hash = (hash * 31 + elements.length) | 0;
+return {
+    readyState: document.readyState,
+    inflight: s.inflight,
+    msSinceNetwork: now - s.lastNetwork,
+    msObserved: now - s.installedAt,
+    mutations: mutations,
+    animations: animations,
+    layoutHash: hash
+};
+"""
+
+
+def _merge(base, overrides):
+    merged = copy.deepcopy(base)
+    for key, value in (overrides or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key].update(value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def readiness_config(url=None, overrides=None):
+    """DEFAULT_READINESS with the matching PAGE_READINESS entries and `overrides` applied"""
+    config = DEFAULT_READINESS
+    for pattern, page_config in PAGE_READINESS.items():
+        if url and pattern in url:
+            config = _merge(config, page_config)
+    return _merge(config, overrides)
+
+
+def wait_until_ready(driver, url=None, config=None):
+    """Poll the page until every enabled readiness signal settles or times out
+
+    Returns a report: {"ready", "seconds", "ended_by", "signals": {name:
+    {"status": "ok" | "timeout" | "disabled", "seconds"}}}. ended_by names the
+    signal whose settling (or timeout) ended the wait.
+    """
+    config = readiness_config(url, config)
+    started = time.monotonic()
+    signals = {
+        name: {"status": "waiting" if config[name]["enabled"] else "disabled", "seconds": None}
+        for name in SIGNALS
+    }
+    ended_by = None
+    last_hash, stable_polls = None, 0
+    window_ms = config["dom_quiet"]["window_ms"]
+    max_elements = config["layout_stable"]["max_elements"]
+
+    while True:
+        elapsed = time.monotonic() - started
+        try:
+            state = driver.execute_script(POLL_SCRIPT, window_ms, max_elements)
+        except Exception:
+            # Navigation in progress: the next document gets fresh trackers
+            state = None
+            last_hash, stable_polls = None, 0
+
+        if state is not None:
+            stable_polls = stable_polls + 1 if state["layoutHash"] == last_hash else 0
+            last_hash = state["layoutHash"]
+            settled = {
+                "network_idle": state["readyState"] == "complete" and state["inflight"] <= 0
+                and state["msSinceNetwork"] >= config["network_idle"]["idle_ms"],
+                "dom_quiet": state["msObserved"] >= window_ms
+                and state["mutations"] <= config["dom_quiet"]["max_mutations"],
+                "animations": state["animations"] == 0,
+                "layout_stable": stable_polls >= config["layout_stable"]["stable_polls"],
+            }
+        else:
+            settled = {}
+
+        for name, signal in signals.items():
+            if signal["status"] != "waiting":
+                continue
+            if settled.get(name):
+                signal.update(status="ok", seconds=round(elapsed, 3))
+                ended_by = name
+            elif elapsed >= config[name]["timeout"]:
+                signal.update(status="timeout", seconds=round(elapsed, 3))
+                ended_by = f"{name} (timeout)"
+
+        waiting = [name for name, signal in signals.items() if signal["status"] == "waiting"]
+        if not waiting:
+            break
+        if elapsed >= config["timeout"]:
+            for name in waiting:
+                signals[name].update(status="timeout", seconds=round(elapsed, 3))
+            ended_by = "overall timeout"
+            break
+        time.sleep(config["poll_ms"] / 1000.0)
+
+    return {
+        "ready": all(signal["status"] != "timeout" for signal in signals.values()),
+        "seconds": round(time.monotonic() - started, 3),
+        "ended_by": ended_by,
+        "signals": signals,
+    }
+
+
+def format_report(report):
+    """One-line summary, e.g. 'ready in 0.42s (ended by layout_stable)'"""
+    state = "ready" if report["ready"] else "gave up"
+    timeouts = [name for name, signal in report["signals"].items() if signal["status"] == "timeout"]
+    text = f"{state} in {report['seconds']:.2f}s (ended by {report['ended_by']})"
+    if timeouts:
+        text += f", timed out: {', '.join(timeouts)}"
+    return text
@@ -0,0 +1,335 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from browser_pool import BrowserPool, chrome_factory
+from coordinate_parser import extract_coordinates
+from image_buffer import TOTALS, ImageStats
+from web_capture import capture_page, click_at
+
+# Headless capture -> analyze -> act pipeline (the GUI's three buttons) for
+# servers and sweeps. Each stage runs its own workers and the stages are
+# joined by bounded queues: when the model is the bottleneck the queue in
+# front of it stays full and captures pause instead of piling up, so the model
+# stays busy while browsers work in parallel.
+#   python pipeline.py tasks.jsonl --server http://localhost:7860
+#   python pipeline.py --serve . --repeat 20 --stand-in 0.3     # no model needed
+# tasks.jsonl has one URL or {"url": ..., "instruction": ...} per line.
+
+SYSTEM_PROMPT = "You are agent that can see, talk and act."
+DEFAULT_INSTRUCTION = "Find the main call-to-action button in this image and give me its coordinates."
+STAGES = ("capture", "analyze", "act")
+
+
+class Task:
+    """One URL going through the pipeline, with its results and per-stage timings"""
+
+    def __init__(self, index, url, instruction=DEFAULT_INSTRUCTION):
+        self.index = index
+        self.url = url
+        self.instruction = instruction
+        self.session_id = None  # pinned browser session showing the captured page
+        self.screenshot = None  # ImageBuffer of the captured page
+        self.screenshot_path = None  # only set when archiving
+        self.stats = ImageStats(f"task {index}")
+        self.answer = None
+        self.coordinates = None
+        self.action = None
+        self.status = "pending"
+        self.error = None
+        self.enqueued = time.monotonic()
+        self.timings = {}
+
+    def record(self):
+        record = {
+            "index": self.index,
+            "url": self.url,
+            "status": self.status,
+            "screenshot": self.screenshot_path,
+            "answer": self.answer,
+            "coordinates": self.coordinates,
+            "timings": self.timings,
+            "images": self.stats.as_dict(),
+        }
+        if self.action is not None:
+            record["action"] = {k: v for k, v in self.action.items()
+                                if k not in ("readiness", "screenshot", "highlight")}
+        if self.error is not None:
+            record["error"] = self.error
+        return record
+
+
+class GradioModel:
+    """Analyze stage backed by the Gradio server (blocking calls run in the pipeline's threads)
+
+    Requests go through the process-wide model_client, so the model workers
+    share its connections, retries and MAGMA_FALLBACK_URLS hedging. They
+    are sent as batch priority (see admission.py).
+    """
+
+    def __init__(self, url, system_prompt=SYSTEM_PROMPT, stop_at_coordinate=True, timeout=None):
+        from model_client import shared_client
+        self.client = shared_client(url)
+        self.system_prompt = system_prompt
+        self.stop_at_coordinate = stop_at_coordinate
+        self.timeout = timeout
+
+    def __call__(self, screenshot, instruction):
+        result = self.client.generate(
+            screenshot, instruction,
+            system_prompt=self.system_prompt,
+            stream=False,
+            timeout=self.timeout,
+            stop_at_coordinate=self.stop_at_coordinate,
+            priority="batch",  # interactive users on the same server go first
+        )
+        return result["text"]
+
+
+class StandInModel:
+    """Analyze stage for tests: answers a fixed coordinate after `latency` seconds"""
+
+    def __init__(self, latency=0.3, answer="Coordinate: (0.5, 0.5)"):
+        self.latency = latency
+        self.answer = answer
+
+    def __call__(self, screenshot, instruction):
+        time.sleep(self.latency)
+        return self.answer
+
+
+class Pipeline:
+    """Runs tasks through capture -> analyze -> act with bounded queues between stages
+
+    workers maps stage name to its concurrency; model_workers is usually 1
+    (one GPU). Browsers come from `pool`; a captured session stays pinned on
+    its page until the act stage clicks on it.
+    """
+
+    def __init__(self, pool, model, output_dir, capture_workers=4, model_workers=1, action_workers=2,
+                 queue_size=4, timeout=30, act=True, archive=False):
+        self.pool = pool
+        self.model = model
+        self.output_dir = output_dir
+        self.workers = {"capture": capture_workers, "analyze": model_workers, "act": action_workers}
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.act = act
+        self.archive = archive  # also write screenshots to output_dir
+        self.busy = {stage: 0.0 for stage in STAGES}
+        self.executor = ThreadPoolExecutor(max_workers=sum(self.workers.values()), thread_name_prefix="pipeline")
+
+    async def _in_thread(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    # Stage bodies (blocking, run in the executor)
+
+    def _capture(self, task):
+        session = self.pool.acquire(timeout=self.timeout)
+        try:
+            capture = capture_page(session.driver, task.url, timeout=self.timeout, stats=task.stats)
+        except Exception:
+            self.pool.release(session, discard=True)
+            raise
+        task.screenshot = capture["screenshot"]
+        if self.archive:
+            task.screenshot_path = task.screenshot.save(
+                os.path.join(self.output_dir, f"{task.index:05d}_capture.png"))
+        task.session_id = self.pool.pin(session, task.url)
+
+    def _analyze(self, task):
+        task.answer = self.model(task.screenshot, task.instruction)
+        task.coordinates = extract_coordinates(task.answer)
+
+    def _act(self, task):
+        session = self.pool.acquire(timeout=self.timeout, session_id=task.session_id)
+        task.session_id = None
+        try:
+            if session.pinned_url != task.url:
+                # The pinned session was lost: reload the page before clicking
+                capture_page(session.driver, task.url, timeout=self.timeout, stats=task.stats)
+            path = os.path.join(self.output_dir, f"{task.index:05d}_result.png") if self.archive else None
+            coords = task.coordinates
+            task.action = click_at(session.driver, coords["coords"], coords["type"], path, stats=task.stats)
+            task.action["result_path"] = path
+        except Exception:
+            self.pool.release(session, discard=True)
+            raise
+        self.pool.release(session)
+
+    async def _worker(self, stage, body, inbox, outbox, finish):
+        while True:
+            task = await inbox.get()
+            started = time.monotonic()
+            timing = {"queued": round(started - task.enqueued, 3)}
+            try:
+                await self._in_thread(body, task)
+            except Exception as e:
+                task.status = "error"
+                task.error = f"{stage}: {str(e).splitlines()[0] if str(e) else repr(e)}"
+            finished = time.monotonic()
+            timing["service"] = round(finished - started, 3)
+            task.timings[stage] = timing
+            self.busy[stage] += finished - started
+            task.enqueued = finished
+            # Failed tasks and answers without a coordinate skip the remaining stages
+            if outbox is None or task.status == "error" or (stage == "analyze" and task.coordinates is None):
+                await finish(task)
+            else:
+                # Blocks while the next stage is backed up
+                await outbox.put(task)
+
+    async def run(self, tasks, on_result=None):
+        """Process all tasks; returns (tasks, summary)"""
+        started = time.monotonic()
+        stages = STAGES if self.act else STAGES[:2]
+        bodies = {"capture": self._capture, "analyze": self._analyze, "act": self._act}
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in stages]
+        results = []
+        all_done = asyncio.Event()
+
+        async def finish(task):
+            if task.session_id is not None:
+                # Captured but never acted on: give the browser back
+                await self._in_thread(self.pool.unpin, task.session_id)
+                task.session_id = None
+            if task.status != "error":
+                task.status = "no_coordinates" if task.answer is not None and task.coordinates is None else "ok"
+            results.append(task)
+            if on_result is not None:
+                on_result(task)
+            if len(results) == len(tasks):
+                all_done.set()
+
+        workers = []
+        for i, stage in enumerate(stages):
+            outbox = queues[i + 1] if i + 1 < len(stages) else None
+            for _ in range(self.workers[stage]):
+                workers.append(asyncio.create_task(self._worker(stage, bodies[stage], queues[i], outbox, finish)))
+        for task in tasks:
+            task.enqueued = time.monotonic()
+            await queues[0].put(task)
+        if tasks:
+            await all_done.wait()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self.executor.shutdown(wait=False)
+
+        results.sort(key=lambda task: task.index)
+        return results, self.summary(results, stages, time.monotonic() - started)
+
+    def summary(self, tasks, stages, elapsed):
+        summary = {
+            "tasks": len(tasks),
+            "seconds": round(elapsed, 2),
+            "tasks_per_minute": round(len(tasks) / elapsed * 60, 1) if elapsed else None,
+            "stages": {},
+        }
+        for status in ("ok", "no_coordinates", "error"):
+            summary[status] = sum(1 for task in tasks if task.status == status)
+        for stage in stages:
+            service = sorted(task.timings[stage]["service"] for task in tasks if stage in task.timings)
+            queued = [task.timings[stage]["queued"] for task in tasks if stage in task.timings]
+            summary["stages"][stage] = {
+                "workers": self.workers[stage],
+                "count": len(service),
+                "mean_service": round(sum(service) / len(service), 3) if service else None,
+                "p95_service": service[min(len(service) - 1, int(round(0.95 * (len(service) - 1))))] if service else None,
+                "mean_queued": round(sum(queued) / len(queued), 3) if queued else None,
+                # Share of the run the stage's workers were busy; ~1.0 for the model means saturated
+                "utilization": round(self.busy[stage] / (self.workers[stage] * elapsed), 3) if elapsed else None,
+            }
+        return summary
+
+
+def read_tasks(path):
+    """Tasks from a file (or stdin for '-'): one URL or JSON object per line"""
+    f = sys.stdin if path == "-" else open(path)
+    try:
+        tasks = []
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                item = json.loads(line)
+                tasks.append(Task(len(tasks), item["url"], item.get("instruction", DEFAULT_INSTRUCTION)))
+            else:
+                tasks.append(Task(len(tasks), line))
+        return tasks
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless capture -> analyze -> act pipeline")
+    parser.add_argument("tasks", nargs="?", help="file with one URL or JSON task per line, or - for stdin")
+    parser.add_argument("--server", default="http://localhost:7860", help="Gradio server running magma_gradio.py")
+    parser.add_argument("--stand-in", type=float, metavar="SECONDS",
+                        help="use a stand-in model that answers after SECONDS instead of the server")
+    parser.add_argument("--output", default=None, help="directory for results.jsonl (and archived screenshots)")
+    parser.add_argument("--archive", action="store_true", help="write the screenshots to the output directory")
+    parser.add_argument("--capture-workers", type=int, default=4)
+    parser.add_argument("--model-workers", type=int, default=1)
+    parser.add_argument("--action-workers", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=4, help="tasks waiting between two stages")
+    parser.add_argument("--browsers", type=int, default=None,
+                        help="browser pool size (default: enough for every stage and queue)")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds allowed per browser step")
+    parser.add_argument("--no-act", action="store_true", help="stop after the analyze stage")
+    parser.add_argument("--serve", metavar="DIR", help="serve DIR with local_server and run its index.html")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    httpd = None
+    if args.serve:
+        from local_server import start_background_server
+        httpd, base_url = start_background_server(directory=args.serve)
+    if args.tasks:
+        tasks = read_tasks(args.tasks)
+    elif httpd is not None:
+        tasks = [Task(0, f"{base_url}/index.html")]
+    else:
+        parser.error("give a task file (or -) or --serve DIR")
+    tasks = [Task(i, task.url, task.instruction) for i, task in enumerate(tasks * args.repeat)]
+
+    output_dir = args.output or tempfile.mkdtemp(prefix="magma_pipeline_")
+    os.makedirs(output_dir, exist_ok=True)
+    model = StandInModel(args.stand_in) if args.stand_in is not None else GradioModel(args.server)
+    # Sessions are held from capture until the click: capture + queued + analyzing + queued + clicking
+    browsers = args.browsers or (args.capture_workers + args.model_workers + args.action_workers
+                                 + 2 * args.queue_size)
+    pool = BrowserPool(size=browsers, max_uses=10 ** 9, factory=chrome_factory(True)).start(warm=args.capture_workers)
+    pipeline = Pipeline(pool, model, output_dir, args.capture_workers, args.model_workers, args.action_workers,
+                        args.queue_size, args.timeout, act=not args.no_act, archive=args.archive)
+
+    with open(os.path.join(output_dir, "results.jsonl"), "w") as results_file:
+        def on_result(task):
+            results_file.write(json.dumps(task.record()) + "\n")
+            results_file.flush()
+            print(f"[{task.index}] {task.status:>14} {task.url} {task.answer or task.error or ''}")
+
+        _, summary = asyncio.run(pipeline.run(tasks, on_result))
+    pool.close()
+    if httpd is not None:
+        httpd.shutdown()
+
+    print(f"{summary['ok']}/{summary['tasks']} ok, {summary['no_coordinates']} without coordinates, "
+          f"{summary['error']} failed in {summary['seconds']}s ({summary['tasks_per_minute']} tasks/min)")
+    print(f"{'stage':>8} {'workers':>7} {'mean':>7} {'p95':>7} {'queued':>7} {'busy':>6}")
+    for stage, stats in summary["stages"].items():
+        print(f"{stage:>8} {stats['workers']:>7} {stats['mean_service'] or 0:7.3f} {stats['p95_service'] or 0:7.3f} "
+              f"{stats['mean_queued'] or 0:7.3f} {stats['utilization'] or 0:6.0%}")
+    print(f"Images {TOTALS}")
+    print(f"Results: {os.path.join(output_dir, 'results.jsonl')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import argparse
+import gc
+import json
+import os
+import time
+
+import torch
+from PIL import Image, ImageDraw
+
+from coordinate_parser import parse_coordinates
+from fast_loader import load_model_streaming, peak_rss_mb
+from quantization import PRECISIONS, apply_precision, compute_dtype, load_dtype, model_nbytes
+
+# Accuracy check for the reduced-precision CPU modes: run the same grounding
+# prompts over a fixed image set in fp32 and in each reduced mode, and compare
+# the extracted "Coordinate: (...)" answers.
+#   python precision_check.py screenshots/ --precisions bf16 int8 int4
+#   python precision_check.py screenshots/ --output report.json       # keep outputs
+#   python precision_check.py screenshots/ --baseline report.json     # reuse fp32 outputs
+#   python precision_check.py --tiny                                  # stand-in model, synthetic images
+# The tiny model's answers are held to a "Coordinate: (0.ddd, 0.ddd)" template
+# (it never writes one by itself), with the digits left to its logits, so the
+# coordinate comparison runs there too.
+# A prompts.json in the image directory ({"file.png": "instruction"}) overrides
+# the default instruction per image.
+
+SYSTEM_PROMPT = "You are agent that can see, talk and act."
+DEFAULT_INSTRUCTION = "Find the main call-to-action button in this image and give me its coordinates."
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+# Answer the tiny model is held to; each "#" is a digit of its choosing
+TINY_ANSWER = "Coordinate: (0.###, 0.###)"
+
+
+def load_image_set(image_dir):
+    """[(name, RGB image, instruction)] in file-name order"""
+    prompts = {}
+    prompts_path = os.path.join(image_dir, "prompts.json")
+    if os.path.exists(prompts_path):
+        with open(prompts_path) as f:
+            prompts = json.load(f)
+    items = []
+    for name in sorted(os.listdir(image_dir)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            image = Image.open(os.path.join(image_dir, name)).convert("RGB")
+            items.append((name, image, prompts.get(name, DEFAULT_INSTRUCTION)))
+    if not items:
+        raise FileNotFoundError(f"No images found in {image_dir}")
+    return items
+
+
+def synthetic_image_set(count=8, size=(320, 240)):
+    """Plain pages with one coloured 'button' each, for --tiny runs"""
+    items = []
+    for i in range(count):
+        image = Image.new("RGB", size, "white")
+        draw = ImageDraw.Draw(image)
+        x, y = 20 + 31 * i % 200, 30 + 17 * i % 150
+        draw.rectangle([x, y, x + 80, y + 30], fill=(40 + 20 * i, 120, 220 - 15 * i))
+        items.append((f"synthetic_{i}.png", image, DEFAULT_INSTRUCTION))
+    return items
+
+
+def template_tokens(tokenizer, prompt_length, template=TINY_ANSWER):
+    """prefix_allowed_tokens_fn that keeps a character-level model's answer to template"""
+    digits = [tokenizer.char_to_id[c] for c in "0123456789"]
+
+    def allowed(batch_id, input_ids):
+        position = input_ids.shape[-1] - prompt_length
+        if position >= len(template):
+            return [tokenizer.eos_token_id]
+        return digits if template[position] == "#" else [tokenizer.char_to_id[template[position]]]
+    return allowed
+
+
+def run_outputs(model, processor, items, max_new_tokens, template=None):
+    """Greedy answer for every image (held to template if given), plus decode throughput"""
+    device = next(model.parameters()).device
+    dtype = compute_dtype(model)
+    outputs = {}
+    new_tokens = 0
+    started = time.monotonic()
+    for name, image, instruction in items:
+        convs = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"<image_start><image><image_end>\n{instruction}"},
+        ]
+        prompt = processor.tokenizer.apply_chat_template(convs, tokenize=False, add_generation_prompt=True)
+        inputs = processor(images=image, texts=prompt, return_tensors="pt")
+        inputs["pixel_values"] = inputs["pixel_values"].unsqueeze(0).to(dtype)
+        inputs["image_sizes"] = inputs["image_sizes"].unsqueeze(0)
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        constrain = {}
+        if template:
+            constrain["prefix_allowed_tokens_fn"] = template_tokens(
+                processor.tokenizer, inputs["input_ids"].shape[-1], template)
+        with torch.inference_mode():
+            generate_ids = model.generate(
+                **inputs, max_new_tokens=max_new_tokens, do_sample=False, num_beams=1, use_cache=True, **constrain
+            )
+        generate_ids = generate_ids[:, inputs["input_ids"].shape[-1]:]
+        new_tokens += generate_ids.shape[-1]
+        outputs[name] = processor.decode(generate_ids[0], skip_special_tokens=True).strip()
+    seconds = time.monotonic() - started
+    return outputs, {"seconds": round(seconds, 2), "tokens_per_second": round(new_tokens / seconds, 2)}
+
+
+def compare(baseline, candidate, tolerance):
+    """Per-image verdicts and summary of candidate answers against the fp32 ones"""
+    verdicts = {}
+    errors = []
+    for name, reference in baseline.items():
+        text = candidate.get(name, "")
+        expected, actual = parse_coordinates(reference), parse_coordinates(text)
+        if expected is None and actual is None:
+            verdict = "no_coordinates"
+        elif expected is None:
+            verdict = "spurious"
+        elif actual is None:
+            verdict = "missing"
+        elif len(expected) != len(actual):
+            verdict = "format_mismatch"
+        else:
+            error = max(abs(a - b) for a, b in zip(expected, actual))
+            errors.append(error)
+            verdict = "match" if error <= tolerance else "off"
+        verdicts[name] = {"verdict": verdict, "exact_text": text == reference, "output": text}
+
+    with_coordinates = sum(1 for text in baseline.values() if parse_coordinates(text) is not None)
+    matches = sum(1 for v in verdicts.values() if v["verdict"] == "match")
+    summary = {
+        "images": len(baseline),
+        "exact_text": sum(1 for v in verdicts.values() if v["exact_text"]),
+        "baseline_with_coordinates": with_coordinates,
+        "coordinate_matches": matches,
+        "coordinate_agreement": round(matches / with_coordinates, 3) if with_coordinates else None,
+        "mean_abs_error": round(sum(errors) / len(errors), 4) if errors else None,
+        "max_abs_error": round(max(errors), 4) if errors else None,
+    }
+    for verdict in ("missing", "spurious", "format_mismatch", "off"):
+        summary[verdict] = sum(1 for v in verdicts.values() if v["verdict"] == verdict)
+    return summary, verdicts
+
+
+def load_for_precision(args, precision):
+    """(model, processor, load report) for one precision mode on CPU"""
+    started = time.monotonic()
+    if args.tiny:
+        from tiny_magma import load_tiny_magma
+        model, processor = load_tiny_magma(hidden_size=512, num_layers=8)
+        model.to(load_dtype(precision))
+        skip_modules = ("lm_head",)
+    else:
+        from transformers import AutoProcessor
+        processor = AutoProcessor.from_pretrained(args.model, trust_remote_code=True)
+        model, _ = load_model_streaming(args.model, device="cpu", dtype=load_dtype(precision))
+        skip_modules = tuple(args.skip_modules)
+    apply_precision(model, precision, skip_modules=skip_modules)
+    return model, processor, {
+        "load_seconds": round(time.monotonic() - started, 1),
+        "weights_mb": round(model_nbytes(model) / 1024 ** 2, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare Coordinate outputs of reduced-precision modes against fp32")
+    parser.add_argument("image_dir", nargs="?", help="directory of screenshots (optional prompts.json)")
+    parser.add_argument("--model", default="microsoft/Magma-8B")
+    parser.add_argument("--precisions", nargs="+", default=["bf16", "int8", "int4"], choices=PRECISIONS[1:])
+    parser.add_argument("--tolerance", type=float, default=0.02, help="max abs difference in normalised coordinates")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--skip-modules", nargs="*", default=["lm_head", "vision_tower"],
+                        help="module names left in float for int8/int4")
+    parser.add_argument("--baseline", help="report.json of an earlier run to take the fp32 outputs from")
+    parser.add_argument("--output", help="write the full report (all outputs and verdicts) here")
+    parser.add_argument("--tiny", action="store_true", help="use the tiny stand-in model")
+    args = parser.parse_args()
+
+    if args.image_dir:
+        items = load_image_set(args.image_dir)
+    elif args.tiny:
+        items = synthetic_image_set()
+    else:
+        parser.error("image_dir is required unless --tiny is given")
+
+    template = TINY_ANSWER if args.tiny else None
+    report = {"model": "tiny" if args.tiny else args.model, "tolerance": args.tolerance, "precisions": {}}
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["precisions"]["fp32"] = json.load(f)["precisions"]["fp32"]
+        baseline = report["precisions"]["fp32"]["outputs"]
+    else:
+        model, processor, load_report = load_for_precision(args, "fp32")
+        baseline, timing = run_outputs(model, processor, items, args.max_new_tokens, template)
+        report["precisions"]["fp32"] = dict(load_report, **timing, outputs=baseline)
+        del model
+        gc.collect()
+
+    for precision in args.precisions:
+        model, processor, load_report = load_for_precision(args, precision)
+        outputs, timing = run_outputs(model, processor, items, args.max_new_tokens, template)
+        summary, verdicts = compare(baseline, outputs, args.tolerance)
+        report["precisions"][precision] = dict(load_report, **timing, **summary, verdicts=verdicts, outputs=outputs)
+        del model
+        gc.collect()
+
+    print(f"{'mode':>5} {'weights':>10} {'tok/s':>7} {'text':>6} {'coords':>8} {'mean err':>9}")
+    for precision, result in report["precisions"].items():
+        images = len(baseline)
+        agreement = result.get("coordinate_agreement")
+        print(f"{precision:>5} {result.get('weights_mb', 0):8.0f}MB {result.get('tokens_per_second', 0):7.1f} "
+              f"{result.get('exact_text', images):>3}/{images:<2} "
+              f"{'n/a' if agreement is None else f'{agreement:.0%}':>8} "
+              f"{'n/a' if result.get('mean_abs_error') is None else result['mean_abs_error']:>9}")
+    print(f"Peak RSS {peak_rss_mb():.0f} MB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # older transformers only knows the tuple cache format
+    DynamicCache = None
+
+
+def to_legacy_cache(past_key_values):
+    """Normalise a model's cache into a tuple of (key, value) tensors per layer"""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return tuple((layer[0], layer[1]) for layer in past_key_values)
+
+
+def from_legacy_cache(legacy):
+    """Wrap a tuple cache in the Cache class newer models expect"""
+    if DynamicCache is not None:
+        return DynamicCache.from_legacy_cache(legacy)
+    return legacy
+
+
+def cache_nbytes(legacy):
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in legacy)
+
+
+def get_image_token_id(processor):
+    """Token id of the <image> placeholder, or None for text-only tokenizers"""
+    tokenizer = processor.tokenizer
+    token_id = getattr(tokenizer, "image_token_id", None)
+    if token_id is None and hasattr(tokenizer, "convert_tokens_to_ids"):
+        token_id = tokenizer.convert_tokens_to_ids("<image>")
+        if token_id == getattr(tokenizer, "unk_token_id", None):
+            token_id = None
+    return token_id
+
+
+def cacheable_length(token_ids, image_token_id):
+    """Number of leading tokens whose KV entries line up one-to-one with the token ids
+
+    The model expands the <image> placeholder into many positions, so only the
+    part of the prompt before the first image is safe to cache by token prefix.
+    """
+    if image_token_id is not None:
+        positions = (token_ids == image_token_id).nonzero()
+        if len(positions):
+            return int(positions[0])
+    return len(token_ids)
+
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    mismatch = (a[:n] != b[:n]).nonzero()
+    return int(mismatch[0]) if len(mismatch) else n
+
+
+class PrefixCache:
+    """LRU cache of past_key_values keyed by token prefix, bounded by a byte budget
+
+    Entries hold the KV cache of a tokenised conversation prefix (system prompt
+    plus earlier turns). A new request reuses the longest cached prefix it
+    shares with any entry, so only the new tokens need a prefill pass.
+    """
+
+    def __init__(self, max_bytes=2 * 1024 ** 3, min_prefix_tokens=8):
+        self.max_bytes = max_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.pinned = {}  # key -> pin count (entries held for live sessions)
+        self.lock = threading.Lock()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "reused_tokens": 0,
+            "prefilled_tokens": 0,
+            "evictions": 0,
+        }
+
+    def match(self, token_ids):
+        """Return (prefix length, cache) for the longest cached prefix of token_ids
+
+        At least one token is always left uncached so the model still produces
+        logits for the last prompt position. Returns (0, None) on a miss.
+        """
+        token_ids = token_ids.detach().cpu()
+        best_key, best_length = None, 0
+        with self.lock:
+            for key, entry in self.entries.items():
+                length = common_prefix_length(entry["tokens"], token_ids)
+                if length > best_length:
+                    best_key, best_length = key, length
+            best_length = min(best_length, len(token_ids) - 1)
+
+            if best_key is None or best_length < self.min_prefix_tokens:
+                self.counters["misses"] += 1
+                self.counters["prefilled_tokens"] += len(token_ids)
+                return 0, None
+
+            self.entries.move_to_end(best_key)
+            legacy = self.entries[best_key]["cache"]
+            self.counters["hits"] += 1
+            self.counters["reused_tokens"] += best_length
+            self.counters["prefilled_tokens"] += len(token_ids) - best_length
+
+        # Slicing gives views; the model appends to the cache by concatenation,
+        # so the stored tensors are never modified
+        return best_length, tuple((k[:, :, :best_length], v[:, :, :best_length]) for k, v in legacy)
+
+    def record_miss(self, num_tokens):
+        """Count a request that could not use the cache at all"""
+        with self.lock:
+            self.counters["misses"] += 1
+            self.counters["prefilled_tokens"] += num_tokens
+
+    def store(self, token_ids, past_key_values):
+        """Cache the KV entries for token_ids (the cache may cover more positions)"""
+        token_ids = token_ids.detach().cpu()
+        length = len(token_ids)
+        if length < self.min_prefix_tokens:
+            return
+        legacy = to_legacy_cache(past_key_values)
+        if legacy[0][0].shape[0] != 1 or legacy[0][0].shape[2] < length:
+            return
+        # Copy only the needed positions so the rest of the generate cache can be freed
+        legacy = tuple((k[:, :, :length].clone(), v[:, :, :length].clone()) for k, v in legacy)
+        nbytes = cache_nbytes(legacy)
+        if nbytes > self.max_bytes:
+            return
+        key = hashlib.sha1(token_ids.numpy().tobytes()).hexdigest()
+
+        with self.lock:
+            if key in self.entries:
+                # Same tokens, same KV; a pinned entry must not be counted twice
+                self.entries.move_to_end(key)
+                return
+            # An entry that is a prefix of the new one is fully covered by it
+            # (pinned ones stay: their sessions release them by key)
+            for other_key in list(self.entries):
+                other = self.entries[other_key]
+                if other_key not in self.pinned and len(other["tokens"]) <= length and common_prefix_length(other["tokens"], token_ids) == len(other["tokens"]):
+                    self._remove(other_key)
+            self.entries[key] = {"tokens": token_ids, "cache": legacy, "nbytes": nbytes}
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes and self.entries:
+                # Least recently used first, sparing pinned entries while others remain
+                victim = next((k for k in self.entries if k not in self.pinned), next(iter(self.entries)))
+                self._remove(victim)
+                self.counters["evictions"] += 1
+
+    def pin(self, token_ids):
+        """Keep the entry sharing the longest prefix with token_ids from LRU eviction
+
+        Returns (key, bytes) of the pinned entry, or (None, 0) if nothing matches.
+        Release it with unpin(key).
+        """
+        token_ids = token_ids.detach().cpu()
+        best_key, best_length = None, 0
+        with self.lock:
+            for key, entry in self.entries.items():
+                length = common_prefix_length(entry["tokens"], token_ids)
+                if length > best_length:
+                    best_key, best_length = key, length
+            if best_key is None or best_length < self.min_prefix_tokens:
+                return None, 0
+            self.pinned[best_key] = self.pinned.get(best_key, 0) + 1
+            return best_key, self.entries[best_key]["nbytes"]
+
+    def unpin(self, key):
+        with self.lock:
+            count = self.pinned.get(key, 0) - 1
+            if count > 0:
+                self.pinned[key] = count
+            else:
+                self.pinned.pop(key, None)
+
+    def is_pinned(self, key):
+        with self.lock:
+            return key in self.pinned
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry["nbytes"]
+        # Only evicted while pinned when nothing else is left; its pins go with it
+        self.pinned.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.pinned.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self.entries)
+            stats["pinned"] = len(self.pinned)
+            stats["bytes"] = self.total_bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+def check_pinned_eviction():
+    """LRU eviction spares pinned entries while unpinned ones remain (no model: one-layer toy KV)"""
+    import torch
+
+    def tokens(first, length=10):
+        return torch.arange(first, first + length)
+
+    def kv(length=10):
+        return ((torch.zeros(1, 1, length, 4), torch.zeros(1, 1, length, 4)),)
+
+    failures = []
+    entry_bytes = cache_nbytes(kv())
+    cache = PrefixCache(max_bytes=2 * entry_bytes, min_prefix_tokens=4)
+    cache.store(tokens(0), kv())
+    pinned, nbytes = cache.pin(tokens(0, 12))
+    if pinned is None or nbytes != entry_bytes:
+        failures.append(f"pin() of a longer prompt returned {(pinned, nbytes)}")
+        return failures
+    if cache.pin(tokens(100)) != (None, 0):
+        failures.append("pin() matched a prompt that shares no cached prefix")
+
+    # The pinned entry is the least recently used one, but the others go first
+    cache.store(tokens(20), kv())
+    cache.store(tokens(40), kv())
+    cache.store(tokens(60), kv())
+    if pinned not in cache.entries or not cache.is_pinned(pinned):
+        failures.append("a pinned entry was evicted while unpinned ones remained")
+    if len(cache.entries) != 2 or cache.total_bytes > cache.max_bytes:
+        failures.append(f"{len(cache.entries)} entries, {cache.total_bytes} bytes over a {cache.max_bytes} budget")
+    if cache.match(tokens(60))[0] != 9:
+        failures.append("the newest entry was evicted instead of an older unpinned one")
+
+    # A longer prompt covers shorter cached prefixes, but not pinned ones
+    cache.store(tokens(0, 10), kv())
+    cache.store(torch.cat([tokens(0), tokens(500, 6)]), kv(16))
+    if pinned not in cache.entries:
+        failures.append("a pinned entry was dropped as the prefix of a longer one")
+
+    # Pins are counted; the entry is evictable again after the last unpin
+    cache = PrefixCache(max_bytes=2 * entry_bytes, min_prefix_tokens=4)
+    cache.store(tokens(0), kv())
+    key, _ = cache.pin(tokens(0))
+    cache.pin(tokens(0))
+    cache.unpin(key)
+    cache.store(tokens(20), kv())
+    cache.store(tokens(40), kv())
+    if key not in cache.entries:
+        failures.append("an entry still pinned once was evicted")
+    cache.unpin(key)
+    cache.store(tokens(60), kv())
+    if key in cache.entries or cache.is_pinned(key):
+        failures.append("an unpinned entry outlived newer ones")
+
+    # Pinned entries filling the budget: the new entry is the one to go
+    cache = PrefixCache(max_bytes=entry_bytes, min_prefix_tokens=4)
+    cache.store(tokens(0), kv())
+    key, _ = cache.pin(tokens(0))
+    cache.store(tokens(20), kv())
+    if list(cache.entries) != [key] or cache.total_bytes > cache.max_bytes:
+        failures.append("a cache full of pinned entries went over budget or lost a pinned entry")
+    # Storing a pinned prompt again only refreshes it
+    cache.store(tokens(0), kv())
+    if cache.total_bytes != entry_bytes or not cache.is_pinned(key):
+        failures.append(f"re-storing a pinned entry left {cache.total_bytes} bytes counted for {entry_bytes}")
+    if cache.stats()["evictions"] != 1:
+        failures.append(f"evictions {cache.stats()['evictions']}, expected 1")
+    return failures
+
+
+if __name__ == "__main__":
+    # Checks, then time-to-first-token as the conversation grows, with and without the prefix cache
+    #   python prefix_cache.py           # checks and benchmark (tiny stand-in model)
+    #   python prefix_cache.py --check   # checks only
+    import sys
+    import time
+    from batching import OneShotGenerator
+    from tiny_magma import load_tiny_magma
+
+    failures = check_pinned_eviction()
+    for failure in failures:
+        print(f"check_pinned_eviction: {failure}")
+    print(f"check_pinned_eviction: {'ok' if not failures else f'{len(failures)} failures'}")
+    if failures or "--check" in sys.argv:
+        sys.exit(1 if failures else 0)
+
+    model, processor = load_tiny_magma(hidden_size=256, num_layers=4)
+    generation_args = {"max_new_tokens": 1, "do_sample": False, "num_beams": 1, "use_cache": True}
+    for label, prefix_cache in [("no cache", None), ("prefix cache", PrefixCache())]:
+        generator = OneShotGenerator(model, processor, prefix_cache=prefix_cache)
+        convs = [{"role": "system", "content": "You are agent that can see, talk and act."}]
+        timings = []
+        for turn in range(12):
+            convs.append({"role": "user", "content": f"Turn {turn}: where is the submit button? " * 4})
+            prompt = processor.tokenizer.apply_chat_template(convs, tokenize=False, add_generation_prompt=True)
+            inputs = processor(texts=prompt, return_tensors="pt")
+            start = time.monotonic()
+            response = generator.submit(dict(inputs), generation_args)
+            timings.append(time.monotonic() - start)
+            convs.append({"role": "assistant", "content": response})
+        print(f"{label:>12}: " + " ".join(f"{t * 1000:5.1f}" for t in timings) + " ms")
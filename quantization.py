@@ -0,0 +1,199 @@
+import time
+
+import torch
+import torch.nn.functional as F
+
+# Reduced-precision modes for running Magma on CPU-only hosts
+#   "fp32" - unchanged (~32 GB of weights for the 8B model)
+#   "bf16" - every weight and activation in bfloat16 (~16 GB)
+#   "int8" - dynamic int8 Linear layers (int8 weights, activations quantized
+#            per batch), everything else fp32 (~9 GB)
+#   "int4" - weight-only int4 Linear layers with per-group scales, everything
+#            else bf16 (~5 GB); the fused CPU kernel is only fast with bf16 inputs
+# Quantized modes leave the vision tower and lm_head alone by default; they are
+# a small part of the weights and the coordinate outputs are sensitive to them.
+PRECISIONS = ("fp32", "bf16", "int8", "int4")
+DEFAULT_SKIP_MODULES = ("lm_head", "vision_tower")
+
+
+def load_dtype(precision):
+    """dtype to load the checkpoint in before apply_precision()
+
+    Quantized modes start from bf16 so the full fp32 model never has to fit in RAM.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {PRECISIONS}")
+    return torch.float32 if precision == "fp32" else torch.bfloat16
+
+
+# Fused int4 matmul kernel in recent PyTorch CPU builds; without it the
+# weights are dequantized on every call (correct, but much slower)
+HAS_INT4_KERNEL = hasattr(torch.ops.aten, "_weight_int4pack_mm_for_cpu")
+
+
+class Int4Linear(torch.nn.Module):
+    """Linear layer with symmetric int4 weights, two per byte, one scale per group of inputs"""
+
+    def __init__(self, in_features, out_features, group_size=128, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+        num_groups = -(-in_features // group_size)
+        # The fused kernel wants N divisible by 16 and K by the group size
+        self.fused = HAS_INT4_KERNEL and out_features % 16 == 0 and in_features % group_size == 0
+        self.register_buffer("packed", torch.zeros(out_features, num_groups * group_size // 2, dtype=torch.uint8))
+        self.register_buffer("scales", torch.ones(out_features, num_groups))
+        if bias:
+            self.register_buffer("bias", torch.zeros(out_features))
+        else:
+            self.bias = None
+        self._scales_and_zeros = {}
+
+    @classmethod
+    def from_linear(cls, linear, group_size=128):
+        weight = linear.weight.detach().float()
+        module = cls(linear.in_features, linear.out_features, group_size, bias=linear.bias is not None)
+        padding = module.packed.shape[1] * 2 - linear.in_features
+        groups = F.pad(weight, (0, padding)).view(linear.out_features, -1, group_size)
+        scales = (groups.abs().amax(dim=-1) / 7).clamp(min=1e-8)
+        q = (torch.round(groups / scales.unsqueeze(-1)).clamp(-8, 7) + 8).to(torch.uint8)
+        q = q.view(linear.out_features, -1)
+        if module.fused:
+            module.packed.copy_(torch.ops.aten._convert_weight_to_int4pack_for_cpu(q.to(torch.int32), 2))
+        else:
+            module.packed.copy_(q[:, 0::2] | (q[:, 1::2] << 4))
+        module.scales.copy_(scales)
+        if linear.bias is not None:
+            module.bias.copy_(linear.bias.detach().float())
+        return module
+
+    def dequantize(self, dtype=torch.float32):
+        if self.fused:
+            # Multiplying the identity by the packed weight unpacks it in the kernel's own layout
+            eye = torch.eye(self.in_features, dtype=dtype, device=self.packed.device)
+            return self._fused_mm(eye).t()
+        q = torch.stack([self.packed & 0x0F, self.packed >> 4], dim=-1).view(self.out_features, -1, self.group_size)
+        weight = (q.to(dtype) - 8) * self.scales.to(dtype).unsqueeze(-1)
+        return weight.view(self.out_features, -1)[:, :self.in_features]
+
+    def _fused_mm(self, x):
+        scales_and_zeros = self._scales_and_zeros.get(x.dtype)
+        if scales_and_zeros is None:
+            scales = self.scales.t().to(x.dtype)
+            scales_and_zeros = torch.stack([scales, torch.zeros_like(scales)], dim=-1).contiguous()
+            self._scales_and_zeros[x.dtype] = scales_and_zeros
+        return torch.ops.aten._weight_int4pack_mm_for_cpu(x, self.packed, self.group_size, scales_and_zeros)
+
+    def forward(self, x):
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        if self.fused and x.device.type == "cpu":
+            out = self._fused_mm(x.reshape(-1, self.in_features)).view(*x.shape[:-1], self.out_features)
+            return out + bias if bias is not None else out
+        return F.linear(x, self.dequantize(x.dtype), bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, group_size={self.group_size}"
+
+
+def _int8_linear(linear):
+    """Dynamic int8 replacement for a Linear layer, with per-output-channel weight scales"""
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+    from torch.ao.quantization import per_channel_dynamic_qconfig
+
+    float_linear = torch.nn.Linear(linear.in_features, linear.out_features, bias=linear.bias is not None)
+    float_linear.weight.data = linear.weight.detach().float()
+    if linear.bias is not None:
+        float_linear.bias.data = linear.bias.detach().float()
+    float_linear.qconfig = per_channel_dynamic_qconfig
+    return DynamicQuantizedLinear.from_float(float_linear)
+
+
+def _is_skipped(name, skip_modules):
+    return any(part in skip_modules for part in name.split("."))
+
+
+def apply_precision(model, precision, skip_modules=DEFAULT_SKIP_MODULES, group_size=128):
+    """Convert a loaded model to one of PRECISIONS in place and return it
+
+    Linear layers are replaced one at a time, so converting never needs more
+    than one extra fp32 weight matrix on top of the loaded model.
+    """
+    load_dtype(precision)  # validates the name
+    if precision == "fp32":
+        return model.float()
+    if precision == "bf16":
+        return model.to(torch.bfloat16)
+
+    if precision == "int8" and "fbgemm" not in torch.backends.quantized.supported_engines \
+            and "x86" not in torch.backends.quantized.supported_engines:
+        torch.backends.quantized.engine = "qnnpack"
+
+    started = time.monotonic()
+    targets = [
+        (name, module) for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and not _is_skipped(name, skip_modules)
+    ]
+    count = len(targets)
+    while targets:
+        # Drop each float layer as soon as it is replaced
+        name, linear = targets.pop(0)
+        if precision == "int8":
+            replacement = _int8_linear(linear)
+        else:
+            replacement = Int4Linear.from_linear(linear, group_size=group_size)
+        parent_name, _, attr = name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name else model
+        setattr(parent, attr, replacement)
+        del linear
+
+    if precision == "int8":
+        # Dynamic int8 layers take fp32 activations, so the remaining weights follow
+        model.float()
+    print(f"Converted {count} Linear layers to {precision} in {time.monotonic() - started:.1f}s")
+    return model
+
+
+def compute_dtype(model):
+    """dtype that floating-point inputs (e.g. pixel_values) should be given in"""
+    for param in model.parameters():
+        if param.is_floating_point():
+            return param.dtype
+    return torch.float32
+
+
+def model_nbytes(model):
+    """Bytes held by the model's weights, including packed/quantized ones"""
+    def nbytes(value):
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (list, tuple)):
+            return sum(nbytes(v) for v in value)
+        return 0
+
+    return sum(nbytes(value) for value in model.state_dict(keep_vars=True).values())
+
+
+if __name__ == "__main__":
+    # Weight memory and decode speed of each mode on the tiny stand-in model
+    from tiny_magma import load_tiny_magma
+
+    _, processor = load_tiny_magma()
+    prompt = processor.tokenizer.apply_chat_template(
+        [{"role": "user", "content": "Where is the search box?"}], tokenize=False, add_generation_prompt=True
+    )
+    inputs = processor(texts=prompt, return_tensors="pt")
+    generation_args = {"max_new_tokens": 64, "min_new_tokens": 64, "do_sample": False, "num_beams": 1}
+    baseline = None
+    for precision in PRECISIONS:
+        model, _ = load_tiny_magma(hidden_size=512, num_layers=8)
+        apply_precision(model.to(load_dtype(precision)), precision, skip_modules=("lm_head",))
+        with torch.inference_mode():
+            start = time.monotonic()
+            output = model.generate(**inputs, **generation_args)
+            seconds = time.monotonic() - start
+        tokens = output[0, inputs["input_ids"].shape[1]:]
+        baseline = tokens if baseline is None else baseline
+        agreement = (tokens == baseline).float().mean().item()
+        print(f"{precision:>5}: {model_nbytes(model) / 1024 ** 2:7.1f} MB, "
+              f"{len(tokens) / seconds:6.1f} tok/s, {agreement:.0%} tokens match fp32")
@@ -0,0 +1,449 @@
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import httpx
+
+import metrics
+
+# Multi-replica serving: N magma_gradio.py worker processes behind one local
+# router. Each worker gets its own GPU (CUDA_VISIBLE_DEVICES) or, without
+# GPUs, an equal share of the CPU threads. The router speaks plain HTTP, so
+# clients (model_client.py, the desktop apps, the browser UI) just point at
+# it instead of at a single server.
+#   - dispatch: new requests go to the healthy worker with the fewest
+#     requests in flight
+#   - stickiness: a request follows its conversation (X-Session-Id), its image
+#     (compact image_ref or a gradio /upload path) or its gradio session to
+#     the worker that already holds it, so chat_history, prefix and image
+#     caches stay warm; a sticky worker that is much busier than the rest
+#     spills the session to another one
+#   - health: workers are polled on /ready and taken out of rotation after
+#     failed checks or proxy errors; crashed worker processes are restarted
+#   - metrics: /metrics merges the workers' Prometheus pages (worker label)
+#     with the router's own counters, one scrape target for autoscaling
+#   python serve_replicas.py --workers 2                  # real model workers
+#   python serve_replicas.py --workers 3 --stub --latency 0.3    # stub_server.py workers
+
+ROUTER_PORT = int(os.environ.get("MAGMA_ROUTER_PORT", "7860"))
+HEALTH_INTERVAL = float(os.environ.get("MAGMA_HEALTH_INTERVAL", "1.0"))
+# Failed /ready checks in a row before a worker leaves the rotation
+UNHEALTHY_AFTER = int(os.environ.get("MAGMA_UNHEALTHY_AFTER", "2"))
+# Sticky routes unused for this long are forgotten
+STICKY_TTL = float(os.environ.get("MAGMA_STICKY_TTL", "1800"))
+STICKY_MAX = 100_000
+# A sticky worker with this many more requests in flight than the least busy one gives the session up
+SPILL_THRESHOLD = int(os.environ.get("MAGMA_STICKY_SPILL", "8"))
+
+# Routes that must be followed whatever the load: the gradio session a
+# request's answer streams from, and files uploaded to one worker's disk
+PINNED_KEYS = ("gradio:", "file:")
+# Hop-by-hop headers are not forwarded
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "upgrade", "host", "proxy-connection", "te"}
+
+
+class Worker:
+    """One model server process and the router's view of it"""
+
+    def __init__(self, index, port, command, env):
+        self.index = index
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.command = command
+        self.env = env
+        self.process = None
+        self.healthy = False
+        self.failed_checks = 0
+        self.in_flight = 0
+        self.restarts = 0
+        self.stopped = False
+        self.counters = {"requests": 0, "errors": 0}
+
+    def start(self):
+        self.process = subprocess.Popen(self.command, env=self.env)
+        self.healthy = False
+
+    def alive(self):
+        return self.process is None or self.process.poll() is None
+
+    def stop(self):
+        self.stopped = True
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+    def stats(self):
+        return dict(self.counters, url=self.url, healthy=self.healthy, in_flight=self.in_flight,
+                    restarts=self.restarts, pid=self.process.pid if self.process else None)
+
+
+def worker_env(index, workers, devices=None):
+    """Environment of worker `index`: its GPU, or its share of the CPU threads"""
+    env = dict(os.environ)
+    env["MAGMA_SHARE"] = "0"
+    if devices is None:
+        try:
+            import torch
+            devices = list(range(torch.cuda.device_count()))
+        except ImportError:
+            devices = []
+    if devices:
+        env["CUDA_VISIBLE_DEVICES"] = str(devices[index % len(devices)])
+    else:
+        threads = str(max(1, (os.cpu_count() or 1) // workers))
+        env["CUDA_VISIBLE_DEVICES"] = ""
+        env["OMP_NUM_THREADS"] = threads
+        env["MKL_NUM_THREADS"] = threads
+    return env
+
+
+def start_workers(count, base_port, stub=False, devices=None, extra_args=()):
+    """Launch `count` worker processes on consecutive ports from base_port"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    workers = []
+    for index in range(count):
+        port = base_port + index
+        if stub:
+            command = [sys.executable, os.path.join(here, "stub_server.py"), "--port", str(port), *extra_args]
+            env = dict(os.environ)
+        else:
+            command = [sys.executable, os.path.join(here, "magma_gradio.py"), *extra_args]
+            env = worker_env(index, count, devices)
+            env["GRADIO_SERVER_NAME"] = "127.0.0.1"
+            env["GRADIO_SERVER_PORT"] = str(port)
+        worker = Worker(index, port, command, env)
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+class StickyTable:
+    """Routing key -> worker, least recently used first out, with a TTL"""
+
+    def __init__(self, ttl=STICKY_TTL, max_entries=STICKY_MAX):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (worker, last used)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        worker, used = entry
+        if time.monotonic() - used > self.ttl:
+            del self.entries[key]
+            return None
+        return worker
+
+    def set(self, key, worker):
+        self.entries[key] = (worker, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def drop_worker(self, worker):
+        for key in [k for k, (w, _) in self.entries.items() if w is worker]:
+            del self.entries[key]
+
+
+class Router:
+    """Reverse proxy in front of the workers (runs on one event loop)"""
+
+    def __init__(self, workers, spill_threshold=SPILL_THRESHOLD):
+        self.workers = workers
+        self.spill_threshold = spill_threshold
+        self.sticky = StickyTable()
+        self.http = None
+        self.counters = {"requests": 0, "sticky_hits": 0, "spills": 0, "no_worker": 0, "proxy_errors": 0}
+
+    def _http(self):
+        if self.http is None:
+            limits = httpx.Limits(max_connections=1000, max_keepalive_connections=100)
+            self.http = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(None, connect=5.0))
+        return self.http
+
+    def healthy(self):
+        return [w for w in self.workers if w.healthy]
+
+    def least_busy(self):
+        workers = self.healthy()
+        return min(workers, key=lambda w: (w.in_flight, w.counters["requests"])) if workers else None
+
+    def pick(self, keys):
+        """Worker for a request with these routing keys (most specific first)"""
+        least = self.least_busy()
+        if least is None:
+            return None
+        for key in keys:
+            worker = self.sticky.get(key)
+            if worker is not None and worker.healthy and key.startswith(PINNED_KEYS):
+                self.counters["sticky_hits"] += 1
+                for other in keys:
+                    self.sticky.set(other, worker)
+                return worker
+        for key in keys:
+            worker = self.sticky.get(key)
+            if worker is None or not worker.healthy:
+                continue
+            if worker.in_flight - least.in_flight >= self.spill_threshold:
+                self.counters["spills"] += 1
+                break
+            self.counters["sticky_hits"] += 1
+            for other in keys:
+                self.sticky.set(other, worker)
+            return worker
+        for key in keys:
+            self.sticky.set(key, least)
+        return least
+
+    def mark_failed(self, worker):
+        if worker.healthy:
+            print(f"Worker {worker.index} ({worker.url}) out of rotation")
+        worker.healthy = False
+        self.sticky.drop_worker(worker)
+
+    async def check(self, worker):
+        try:
+            response = await self._http().get(f"{worker.url}/ready", timeout=5)
+            ok = response.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        if ok:
+            if not worker.healthy:
+                print(f"Worker {worker.index} ({worker.url}) ready")
+            worker.healthy = True
+            worker.failed_checks = 0
+        else:
+            worker.failed_checks += 1
+            if worker.failed_checks >= UNHEALTHY_AFTER and worker.healthy:
+                self.mark_failed(worker)
+
+    async def supervise(self, interval=HEALTH_INTERVAL, restart=True):
+        """Health-check the workers forever; restart processes that exited"""
+        while True:
+            for worker in self.workers:
+                if restart and not worker.alive() and not worker.stopped:
+                    print(f"Worker {worker.index} exited with {worker.process.returncode}, restarting")
+                    self.mark_failed(worker)
+                    worker.restarts += 1
+                    worker.start()
+            await asyncio.gather(*(self.check(w) for w in self.workers))
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        return dict(self.counters, sticky_routes=len(self.sticky.entries), workers=[w.stats() for w in self.workers])
+
+    async def metrics_page(self):
+        """Prometheus text of the router and every worker that answers /metrics"""
+        async def scrape(worker):
+            try:
+                response = await self._http().get(f"{worker.url}/metrics", timeout=5)
+            except httpx.HTTPError:
+                return None
+            return response.text if response.status_code == 200 else None
+
+        pages = await asyncio.gather(*(scrape(w) for w in self.workers))
+        routing = metrics.Counter("magma_router_events_total", "Routing decisions and failures", ("event",))
+        for event, count in self.counters.items():
+            routing.inc(count, event=event)
+        families = [routing]
+        for name, kind, help, value in (
+                ("magma_router_worker_healthy", "gauge", "1 while the worker is in rotation", "healthy"),
+                ("magma_router_worker_in_flight", "gauge", "Requests proxied to the worker and not finished",
+                 "in_flight"),
+                ("magma_router_worker_requests_total", "counter", "Requests proxied to the worker", "requests"),
+                ("magma_router_worker_errors_total", "counter", "Proxy errors talking to the worker", "errors"),
+                ("magma_router_worker_restarts_total", "counter", "Times the worker process was restarted",
+                 "restarts")):
+            family = (metrics.Gauge if kind == "gauge" else metrics.Counter)(name, help, ("worker",))
+            for worker in self.workers:
+                family.inc(worker.stats()[value], worker=worker.index)
+            families.append(family)
+        return metrics.merge_pages([({}, metrics.render(families))] +
+                                   [({"worker": w.index}, page) for w, page in zip(self.workers, pages) if page])
+
+
+def routing_keys(request, path, body_json):
+    """Sticky keys of a request, most specific first"""
+    keys = []
+    session_id = request.headers.get("X-Session-Id")
+    if session_id:
+        keys.append(f"session:{session_id}")
+    if path.startswith("images/"):
+        keys.append(f"image:{path[len('images/'):]}")
+    if body_json is not None:
+        for value in body_json.get("data") or []:
+            if isinstance(value, str) and value.startswith("sha256:"):
+                keys.append(f"image:{value[len('sha256:'):]}")
+            elif isinstance(value, dict) and value.get("path"):
+                keys.append(f"file:{value['path']}")
+        if body_json.get("session_hash"):
+            keys.append(f"gradio:{body_json['session_hash']}")
+    session_hash = request.query_params.get("session_hash")
+    if session_hash:
+        keys.append(f"gradio:{session_hash}")
+    return keys
+
+
+def create_app(router, interval=HEALTH_INTERVAL):
+    """FastAPI app that forwards every request to a worker and health-checks them"""
+    import json
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+    from starlette.background import BackgroundTask
+
+    @asynccontextmanager
+    async def lifespan(app):
+        supervisor = asyncio.ensure_future(router.supervise(interval))
+        yield
+        supervisor.cancel()
+
+    app = FastAPI(lifespan=lifespan)
+
+    @app.get("/router/stats")
+    def router_stats():
+        return router.stats()
+
+    @app.get("/metrics")
+    async def prometheus_metrics():
+        return PlainTextResponse(await router.metrics_page(), media_type="text/plain; version=0.0.4")
+
+    @app.get("/health")
+    def health():
+        return {"status": "ok", "healthy_workers": len(router.healthy()), "workers": len(router.workers)}
+
+    @app.get("/ready")
+    def ready():
+        # Ready while any worker can take traffic
+        healthy = len(router.healthy())
+        return JSONResponse({"status": "ready" if healthy else "unavailable", "healthy_workers": healthy},
+                            status_code=200 if healthy else 503)
+
+    @app.api_route("/{path:path}", methods=["GET", "HEAD", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"])
+    async def proxy(path: str, request: Request):
+        body = await request.body()
+        body_json = None
+        if path.startswith("queue/join") or path in ("cancel", "reset"):
+            try:
+                body_json = json.loads(body)
+            except ValueError:
+                pass
+        keys = routing_keys(request, path, body_json)
+        worker = router.pick(keys)
+        router.counters["requests"] += 1
+        if worker is None:
+            router.counters["no_worker"] += 1
+            return JSONResponse({"detail": "no model worker available"}, status_code=503)
+
+        headers = [(k, v) for k, v in request.headers.raw if k.decode().lower() not in HOP_HEADERS]
+        url = httpx.URL(f"{worker.url}/{path}", query=request.url.query.encode())
+        http = router._http()
+        worker.in_flight += 1
+        worker.counters["requests"] += 1
+        try:
+            response = await http.send(http.build_request(request.method, url, headers=headers, content=body),
+                                       stream=True)
+        except httpx.HTTPError as e:
+            worker.in_flight -= 1
+            worker.counters["errors"] += 1
+            router.counters["proxy_errors"] += 1
+            router.mark_failed(worker)
+            return JSONResponse({"detail": f"worker {worker.index} failed: {type(e).__name__}"}, status_code=502)
+
+        done = []
+
+        async def finish():
+            if not done:
+                done.append(True)
+                worker.in_flight -= 1
+                await response.aclose()
+
+        if path == "upload" and response.status_code == 200:
+            # Later requests name these files by path: keep them on this worker
+            await response.aread()
+            await finish()
+            for uploaded in response.json():
+                router.sticky.set(f"file:{uploaded}", worker)
+            return StreamingResponse(iter([response.content]), status_code=200,
+                                     headers={"content-type": response.headers.get("content-type", "")})
+        async def body_chunks():
+            try:
+                async for chunk in response.aiter_raw():
+                    yield chunk
+            except httpx.HTTPError:
+                # The worker died mid-answer: end the stream, the client retries elsewhere
+                router.counters["proxy_errors"] += 1
+                router.mark_failed(worker)
+
+        response_headers = {k: v for k, v in response.headers.items() if k.lower() not in HOP_HEADERS}
+        return StreamingResponse(body_chunks(), status_code=response.status_code, headers=response_headers,
+                                 background=BackgroundTask(finish))
+
+    return app
+
+
+def serve(workers, port=ROUTER_PORT, host="127.0.0.1"):
+    """Run the router until interrupted, then stop the workers"""
+    import uvicorn
+
+    app = create_app(Router(workers))
+
+    def shutdown(*_):
+        for worker in workers:
+            worker.stop()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    print(f"Router at http://{host}:{port}/ for {len(workers)} workers: {', '.join(w.url for w in workers)}")
+    try:
+        uvicorn.run(app, host=host, port=port, log_level="warning")
+    finally:
+        for worker in workers:
+            worker.stop()
+
+
+def start_router(workers, port=None, interval=HEALTH_INTERVAL):
+    """Run a router in a daemon thread (tests, benchmarks); returns (server, router, base_url)"""
+    import uvicorn
+    from local_server import find_free_port
+
+    router = Router(workers)
+    app = create_app(router, interval)
+    port = port or find_free_port(7890)
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="router", daemon=True).start()
+    while not server.started:
+        time.sleep(0.02)
+    return server, router, f"http://127.0.0.1:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve N model workers behind a load-balancing router; "
+                    "unknown options are passed on to the workers")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--port", type=int, default=ROUTER_PORT, help="router port")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--base-port", type=int, default=None, help="first worker port (default: router port + 1)")
+    parser.add_argument("--devices", default=None, help="comma separated GPU ids (default: all visible)")
+    parser.add_argument("--stub", action="store_true", help="run stub_server.py workers instead of the model")
+    args, extra = parser.parse_known_args()
+
+    devices = [int(d) for d in args.devices.split(",")] if args.devices else None
+    workers = start_workers(args.workers, args.base_port or args.port + 1, stub=args.stub, devices=devices,
+                            extra_args=extra)
+    serve(workers, args.port, args.host)
+
+
+if __name__ == "__main__":
+    main()
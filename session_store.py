@@ -0,0 +1,287 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Server-side conversation state for magma_gradio.py. Clients used to send the
+# whole chat history with every turn, which the server parsed again each time;
+# with a session the server keeps the turns, the conversation's image and a
+# pin on the prefix-cache entry holding its KV state, so a request carries
+# only the new user message. Sessions expire after ttl seconds without use and
+# the least recently used go first when the store is over its memory budget.
+#
+# Requests name their session as "<id>#<turns>": the number of turns the
+# client has seen lets the server notice when it has lost (or never had) the
+# turns, in which case it answers UNKNOWN_SESSION and the client resends the
+# full history once.
+#
+#   python session_store.py     # deterministic checks of the resync protocol
+
+# Part of the error a request gets when the server does not hold its turns
+UNKNOWN_SESSION = "Unknown session"
+
+
+def parse_session_id(value):
+    """(id, expected turns) of a "<id>#<turns>" session parameter; (None, 0) without one"""
+    if not value:
+        return None, 0
+    session_id, _, turns = value.partition("#")
+    try:
+        return session_id, int(turns or 0)
+    except ValueError:
+        return session_id, 0
+
+
+def turn_nbytes(turn):
+    return sum(len(message or "") for message in turn)
+
+
+class Session:
+    def __init__(self, session_id):
+        self.id = session_id
+        self.turns = []
+        self.image = None  # PIL image of the conversation, for drawing boxes
+        self.image_ref = None  # compact-upload reference of that image, if any
+        self.prefix_key = None  # pinned prefix-cache entry with the conversation's KV state
+        self.prefix_bytes = 0
+        self.text_bytes = 0
+        self.created = self.last_used = time.monotonic()
+
+    @property
+    def nbytes(self):
+        image_bytes = self.image.width * self.image.height * 3 if self.image is not None else 0
+        return self.text_bytes + image_bytes
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "turns": len(self.turns),
+            "image_ref": self.image_ref,
+            "kv_pinned": self.prefix_key is not None,
+            "kv_bytes": self.prefix_bytes,
+            "bytes": self.nbytes,
+            "age_seconds": round(time.monotonic() - self.created, 1),
+            "idle_seconds": round(time.monotonic() - self.last_used, 1),
+        }
+
+
+class SessionStore:
+    """Sessions by id with a TTL and an LRU memory budget
+
+    prefix_cache (a PrefixCache) is optional; when set, every session pins the
+    cache entry of its latest prompt so the KV state outlives LRU eviction for
+    as long as the session does.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 ** 2, ttl=1800, prefix_cache=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.prefix_cache = prefix_cache
+        self.sessions = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.counters = {
+            "created": 0,
+            "turns": 0,
+            "resyncs": 0,
+            "unknown": 0,
+            "expired": 0,
+            "evictions": 0,
+            "ended": 0,
+        }
+
+    def open(self, value, chat_history):
+        """Session and full history for a request's session parameter and chat_history
+
+        A request that carries history (re)starts its session from it; one with
+        an expected turn count > 0 needs the server to hold exactly that many
+        turns, or KeyError(UNKNOWN_SESSION) tells the client to resend them.
+        Returns (None, chat_history) without a session parameter.
+        """
+        session_id, expected = parse_session_id(value)
+        if not session_id:
+            return None, chat_history
+        with self.lock:
+            self._expire()
+            session = self.sessions.get(session_id)
+            if chat_history or expected == 0:
+                if session is None:
+                    session = Session(session_id)
+                    self.sessions[session_id] = session
+                    self.counters["created"] += 1
+                elif chat_history:
+                    self.counters["resyncs"] += 1
+                self._set_turns(session, [list(turn) for turn in chat_history or []])
+            elif session is None or len(session.turns) != expected:
+                self.counters["unknown"] += 1
+                raise KeyError(f"{UNKNOWN_SESSION}: {session_id}")
+            session.last_used = time.monotonic()
+            self.sessions.move_to_end(session_id)
+            self._evict()
+            return session, [list(turn) for turn in session.turns]
+
+    def set_image(self, session, image, image_ref=None):
+        with self.lock:
+            self.bytes -= session.nbytes
+            session.image = image
+            session.image_ref = image_ref or None
+            self.bytes += session.nbytes
+            self._evict()
+
+    def append(self, session, turn, prompt_ids=None):
+        """Record a finished turn; prompt_ids (the turn's input ids) re-pin its KV state"""
+        with self.lock:
+            if self.sessions.get(session.id) is not session:
+                return  # expired or ended while the answer was generated
+            self._set_turns(session, session.turns + [list(turn)])
+            session.last_used = time.monotonic()
+            self.sessions.move_to_end(session.id)
+            self.counters["turns"] += 1
+        if self.prefix_cache is not None and prompt_ids is not None:
+            key, nbytes = self.prefix_cache.pin(prompt_ids)
+            with self.lock:
+                old_key = session.prefix_key
+                if self.sessions.get(session.id) is session:
+                    session.prefix_key, session.prefix_bytes = key, nbytes
+                else:
+                    old_key = key
+            if old_key is not None:
+                self.prefix_cache.unpin(old_key)
+
+    def end(self, session_id):
+        """Drop a session (the client cleared the conversation); False if there was none"""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return False
+            self._remove(session)
+            self.counters["ended"] += 1
+            return True
+
+    def get(self, session_id):
+        with self.lock:
+            self._expire()
+            return self.sessions.get(session_id)
+
+    def _set_turns(self, session, turns):
+        self.bytes -= session.text_bytes
+        session.turns = turns
+        session.text_bytes = sum(turn_nbytes(turn) for turn in turns)
+        self.bytes += session.text_bytes
+
+    def _remove(self, session):
+        del self.sessions[session.id]
+        self.bytes -= session.nbytes
+        if session.prefix_key is not None and self.prefix_cache is not None:
+            self.prefix_cache.unpin(session.prefix_key)
+        session.prefix_key = None
+
+    def _expire(self):
+        now = time.monotonic()
+        # Least recently used first, so stop at the first live session
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if now - session.last_used < self.ttl:
+                break
+            self._remove(session)
+            self.counters["expired"] += 1
+
+    def summary(self, session):
+        """session.summary(), with kv_pinned checked against the prefix cache"""
+        return dict(session.summary(), kv_pinned=self._kv_pinned(session))
+
+    def _kv_pinned(self, session):
+        # The cache may have had to evict the entry anyway (everything in it pinned)
+        return session.prefix_key is not None and self.prefix_cache is not None and \
+            self.prefix_cache.is_pinned(session.prefix_key)
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and len(self.sessions) > 1:
+            self._remove(next(iter(self.sessions.values())))
+            self.counters["evictions"] += 1
+
+    def stats(self):
+        with self.lock:
+            self._expire()
+            stats = dict(self.counters)
+            stats["sessions"] = len(self.sessions)
+            stats["kv_pinned"] = sum(1 for s in self.sessions.values() if self._kv_pinned(s))
+            stats["mb"] = round(self.bytes / 1024 ** 2, 2)
+        return stats
+
+
+def _expect_unknown(store, value, failures):
+    try:
+        store.open(value, None)
+    except KeyError as e:
+        if UNKNOWN_SESSION not in str(e):
+            failures.append(f"{value}: KeyError {e} does not name {UNKNOWN_SESSION!r}")
+    else:
+        failures.append(f"{value}: opened without the turns the client expects")
+
+
+def check_resync():
+    """The "<id>#<turns>" protocol: UNKNOWN_SESSION whenever the turn counts differ, full history resyncs"""
+    failures = []
+    for value, expected in [(None, (None, 0)), ("", (None, 0)), ("abc", ("abc", 0)), ("abc#3", ("abc", 3)),
+                            ("abc#", ("abc", 0)), ("abc#x", ("abc", 0))]:
+        if parse_session_id(value) != expected:
+            failures.append(f"parse_session_id({value!r}) = {parse_session_id(value)}, expected {expected}")
+
+    store = SessionStore()
+    history = [["where is the menu?", "Coordinate: (0.1, 0.2)"], ["and the search box?", "Coordinate: (0.5, 0.1)"]]
+    if store.open(None, history) != (None, history):
+        failures.append("a request without a session parameter did not get its own history back")
+
+    # New session, then turns recorded by the server
+    session, turns = store.open("a#0", None)
+    if turns != []:
+        failures.append(f"a new session started with turns {turns}")
+    store.append(session, history[0])
+    if store.open("a#1", None)[1] != history[:1]:
+        failures.append("the server did not return the turn it recorded")
+    # The client saw more (or fewer) turns than the server holds
+    _expect_unknown(store, "a#2", failures)
+    # A session the server never had (e.g. after a restart)
+    _expect_unknown(store, "b#2", failures)
+
+    # The client resends the full history once, then continues by reference
+    session, turns = store.open("b#2", history)
+    if turns != history or store.open("b#2", None)[1] != history:
+        failures.append(f"resync of an unknown session kept {turns}")
+    session, turns = store.open("a#1", history)
+    if turns != history:
+        failures.append(f"resync of a known session kept {turns}")
+    _expect_unknown(store, "a#1", failures)
+
+    # "#0" starts a conversation over; ended sessions are unknown again
+    if store.open("b#0", None)[1] != []:
+        failures.append("a restarted session kept its old turns")
+    store.end("a")
+    _expect_unknown(store, "a#2", failures)
+    if store.open("a#0", None)[1] != []:
+        failures.append("a session started after end() got the old turns")
+
+    stats = store.stats()
+    expected = {"created": 3, "turns": 1, "resyncs": 1, "unknown": 4, "ended": 1}
+    for name, count in expected.items():
+        if stats[name] != count:
+            failures.append(f"counter {name} = {stats[name]}, expected {count}")
+
+    # Sessions past their TTL are unknown
+    store = SessionStore(ttl=0)
+    session, _ = store.open("c#0", None)
+    store.append(session, history[0])
+    _expect_unknown(store, "c#1", failures)
+    if store.stats()["expired"] != 1:
+        failures.append(f"expired counter {store.stats()['expired']}, expected 1")
+    return failures
+
+
+if __name__ == "__main__":
+    import sys
+
+    failures = check_resync()
+    for failure in failures:
+        print(f"check_resync: {failure}")
+    print(f"check_resync: {'ok' if not failures else f'{len(failures)} failures'}")
+    sys.exit(1 if failures else 0)
@@ -34,11 +34,11 @@ else
     python3 -m pip install git+https://github.com/jwyang/transformers.git@dev/jwyang-v4.48.2
     
     # Install Gradio for the web interface
-    python3 -m pip install gradio matplotlib numpy
+    python3 -m pip install gradio==4.44.1 matplotlib numpy
 fi
 
 # Add these lines in the dependencies section:
-python3 -m pip install PyQt5 gradio_client
+python3 -m pip install PyQt5 httpx
 
 # Print the installed transformers version
 echo "Transformers installed version:"
@@ -0,0 +1,145 @@
+import queue
+import threading
+
+import torch
+
+import tracing
+
+try:
+    from transformers.generation.streamers import BaseStreamer
+except ImportError:  # very old transformers
+    BaseStreamer = object
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+_END = object()
+
+
+class TokenStream:
+    """Incrementally decoded answer of one request, filled by the scheduler thread
+
+    Iterating yields the text decoded so far after every new token; the last
+    item is the final response (exactly what submit() returns). cancel() asks
+    the scheduler to stop decoding this request at the next step.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.tokens = []
+        self.text = ""
+        self.cancelled = False
+        self.error = None
+        self.updates = queue.Queue()
+
+    def put(self, token_ids):
+        """Append newly generated token ids (called from the generating thread)"""
+        self.tokens.extend(token_ids)
+        # Decode the whole answer: tokens do not always map to whole characters
+        text = self.tokenizer.decode(self.tokens, skip_special_tokens=True).strip()
+        if text != self.text:
+            self.text = text
+            self.updates.put(text)
+
+    def finish(self, response=None, error=None):
+        if error is not None:
+            self.error = error
+        elif response is not None and response != self.text:
+            self.text = response
+            self.updates.put(response)
+        self.updates.put(_END)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __iter__(self):
+        while True:
+            item = self.updates.get()
+            if item is _END:
+                break
+            yield item
+        if self.error is not None:
+            raise self.error
+
+
+class GenerateStreamer(BaseStreamer):
+    """model.generate streamer that routes each batch row's tokens to its TokenStream
+
+    Rows without a stream are None. Tokens after a row's EOS (padding) are dropped.
+    """
+
+    def __init__(self, streams, eos_token_ids):
+        self.streams = streams
+        self.eos_token_ids = set(eos_token_ids)
+        self.finished = [stream is None for stream in streams]
+        self.prompt_seen = False
+
+    def put(self, value):
+        if not self.prompt_seen:
+            # generate() first passes the prompt
+            self.prompt_seen = True
+            return
+        for row, token in enumerate(value.reshape(len(self.streams), -1)[:, -1].tolist()):
+            if self.finished[row]:
+                continue
+            if token in self.eos_token_ids:
+                self.finished[row] = True
+                continue
+            self.streams[row].put([token])
+
+    def end(self):
+        pass
+
+
+class StreamCancelled(StoppingCriteria):
+    """Stop the rows whose TokenStream was cancelled"""
+
+    def __init__(self, streams):
+        self.streams = streams
+
+    def __call__(self, input_ids, scores, **kwargs):
+        cancelled = [stream is not None and stream.cancelled for stream in self.streams]
+        return torch.tensor(cancelled, dtype=torch.bool, device=input_ids.device)
+
+
+def eos_token_ids(model, tokenizer):
+    """All token ids that end a generation"""
+    eos = set()
+    for source in (tokenizer, getattr(model, "generation_config", None)):
+        value = getattr(source, "eos_token_id", None)
+        if value is None:
+            continue
+        eos.update(value if isinstance(value, (list, tuple)) else [value])
+    return eos
+
+
+def stream_generate_kwargs(model, tokenizer, streams, generation_args):
+    """Extra model.generate arguments that feed `streams` (one per batch row, or None)"""
+    if not streams or all(stream is None for stream in streams):
+        return {}
+    if int(generation_args.get("num_beams", 1)) > 1:
+        # Beams are reordered every step; the answer is only sent once it is final
+        return {}
+    return {
+        "streamer": GenerateStreamer(streams, eos_token_ids(model, tokenizer)),
+        "stopping_criteria": StoppingCriteriaList([StreamCancelled(streams)]),
+    }
+
+
+def submit_streaming(generator, tokenizer, inputs, generation_args, timeout=None, **options):
+    """Submit a request to any scheduler in a background thread and return its TokenStream
+
+    options are passed on to submit() (e.g. coordinate_mode).
+    """
+    stream = TokenStream(tokenizer)
+    trace = tracing.current()
+
+    def run():
+        try:
+            with tracing.attach(trace):
+                response = generator.submit(inputs, generation_args, timeout=timeout, stream=stream, **options)
+        except Exception as e:
+            stream.finish(error=e)
+        else:
+            stream.finish(response)
+
+    threading.Thread(target=run, name="stream-request", daemon=True).start()
+    return stream
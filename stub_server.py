@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+import uuid
+
+from admission import DEADLINE_EXCEEDED
+from image_transport import FORMATS, ImageStore
+from session_store import SessionStore
+
+# Stand-in for magma_gradio.py with no model behind it, for benchmarking and
+# testing clients (model_client.py): the same queue protocol (/queue/join,
+# /queue/data, /cancel), API layout (/config, /info), compact image routes
+# and /health + /ready, server-side sessions, answering a fixed coordinate token by token after a
+# configurable delay. It can also fail or stall a share of the requests.
+#   python stub_server.py --port 7870 --latency 0.2 --token-ms 10 --fail-rate 0.1
+
+ANSWER = "The button is here. Coordinate: (0.503, 0.754)"
+
+# generate_response(_stream) parameters in magma_gradio.py's order, with their defaults
+PARAMETERS = [
+    ("image_input", None),
+    ("system_prompt", ""),
+    ("user_prompt", ""),
+    ("chat_history", []),
+    ("max_new_tokens", 128),
+    ("temperature", 0.0),
+    ("do_sample", False),
+    ("num_beams", 1),
+    ("stop_at_coordinate", False),
+    ("constrain_coordinate", False),
+    ("image_ref", ""),
+    ("session_id", ""),
+    ("tile_grid", "off"),
+]
+APIS = ["generate_response_stream", "generate_response"]
+
+
+def diff(old, new, path=None):
+    """Edits turning old into new, as gradio sends streamed outputs ([(action, path, value)])"""
+    path = path or []
+    if old == new:
+        return []
+    if type(old) != type(new):
+        return [("replace", path, new)]
+    if isinstance(old, str) and new.startswith(old):
+        return [("append", path, new[len(old):])]
+    if isinstance(old, list):
+        edits = []
+        for i in range(min(len(old), len(new))):
+            edits += diff(old[i], new[i], path + [i])
+        edits += [("delete", path + [i], None) for i in range(len(new), len(old))]
+        edits += [("add", path + [i], new[i]) for i in range(len(old), len(new))]
+        return edits
+    return [("replace", path, new)]
+
+
+def create_app(latency=0.2, token_ms=5.0, concurrency=4, fail_rate=0.0, slow_rate=0.0, slow_factor=10.0,
+               max_side=1344, answer=ANSWER):
+    """FastAPI app answering like magma_gradio.py
+
+    concurrency requests are served at once (the rest queue), each taking
+    latency seconds plus token_ms per answer token; fail_rate of the joins
+    get a 503 and slow_rate of the requests take slow_factor times longer.
+    """
+    from fastapi import FastAPI, Request, Response
+    from fastapi.responses import JSONResponse, StreamingResponse
+    from starlette.requests import ClientDisconnect
+
+    app = FastAPI()
+    store = ImageStore()
+    chat_sessions = SessionStore()
+    slots = asyncio.Semaphore(concurrency)
+    sessions = {}  # session_hash -> asyncio.Queue of messages
+    running = {}  # event_id -> task
+    tokens = answer.split(" ")
+    stats = {"joined": 0, "rejected": 0, "completed": 0, "cancelled": 0, "expired": 0, "max_in_flight": 0}
+    in_flight = [0]
+
+    async def run(api_name, event_id, args, deadline, messages, simple_format=False):
+        stream = api_name == "generate_response_stream"
+        prompt = args.get("user_prompt", "")
+        try:
+            async with slots:
+                in_flight[0] += 1
+                stats["max_in_flight"] = max(stats["max_in_flight"], in_flight[0])
+                try:
+                    await messages.put({"msg": "process_starts", "event_id": event_id})
+                    if deadline is not None and time.monotonic() > deadline:
+                        # The client has given up already: skip the work
+                        stats["expired"] += 1
+                        await messages.put({"msg": "process_completed", "event_id": event_id, "success": False,
+                                            "output": {"error": DEADLINE_EXCEEDED}})
+                        return
+                    try:
+                        if args.get("image_ref"):
+                            store.get(args["image_ref"])
+                        session, history = chat_sessions.open(args.get("session_id"), args.get("chat_history") or [])
+                    except KeyError as e:
+                        await messages.put({"msg": "process_completed", "event_id": event_id, "success": False,
+                                            "output": {"error": e.args[0]}})
+                        return
+                    if session is not None:
+                        history = []  # session clients get the new turn only
+                    scale = slow_factor if random.random() < slow_rate else 1.0
+                    await asyncio.sleep(latency * scale)
+                    text = ""
+                    previous = None
+                    for token in tokens:
+                        await asyncio.sleep(token_ms / 1000 * scale)
+                        text = f"{text} {token}" if text else token
+                        if stream:
+                            data = [[[prompt, text]], None]
+                            # Like gradio: whole outputs first, then diffs unless the client asked for simple_format
+                            output = data if previous is None or simple_format else [
+                                diff(old, new) for old, new in zip(previous, data)]
+                            previous = data
+                            await messages.put({"msg": "process_generating", "event_id": event_id, "success": True,
+                                                "output": {"data": output, "is_generating": True}})
+                    stats["completed"] += 1
+                    if session is not None:
+                        chat_sessions.append(session, [prompt, text])
+                    await messages.put({"msg": "process_completed", "event_id": event_id, "success": True,
+                                        "output": {"data": [list(history) + [[prompt, text]], None]}})
+                finally:
+                    in_flight[0] -= 1
+        finally:
+            running.pop(event_id, None)
+
+    @app.get("/config")
+    def config():
+        return {"dependencies": [{"id": i, "api_name": name, "queue": True} for i, name in enumerate(APIS)]}
+
+    @app.get("/info")
+    def info():
+        parameters = [{"parameter_name": name, "parameter_has_default": True, "parameter_default": default}
+                      for name, default in PARAMETERS]
+        return {"named_endpoints": {f"/{name}": {"parameters": parameters} for name in APIS}}
+
+    @app.get("/health")
+    def health():
+        return {"status": "ok", "model": {"status": "ready"}}
+
+    @app.get("/ready")
+    def ready():
+        return {"status": "ready", "queued": len(running), "in_flight": in_flight[0]}
+
+    @app.get("/transport_info")
+    def transport_info():
+        return {"formats": list(FORMATS), "max_side": max_side}
+
+    @app.api_route("/images/{key}", methods=["HEAD", "GET"])
+    def has_image(key: str):
+        return Response(status_code=200 if key in store else 404)
+
+    @app.post("/images/{key}")
+    async def upload_image(key: str, request: Request):
+        try:
+            image = store.put(key, await request.body(), request.headers.get("X-Image-Format", "webp"),
+                              int(request.headers.get("X-Image-Width", "0")),
+                              int(request.headers.get("X-Image-Height", "0")))
+        except Exception as e:
+            return JSONResponse({"error": f"could not store image: {e}"}, status_code=400)
+        return {"ref": f"sha256:{key}", "width": image.width, "height": image.height}
+
+    @app.post("/queue/join")
+    async def join(request: Request):
+        try:
+            body = await request.json()
+        except ClientDisconnect:
+            return Response(status_code=499)
+        if random.random() < fail_rate:
+            stats["rejected"] += 1
+            return JSONResponse({"detail": "stub: injected failure"}, status_code=503)
+        api_name = APIS[body["fn_index"]]
+        args = {name: value for (name, _), value in zip(PARAMETERS, body["data"])}
+        deadline_ms = request.headers.get("X-Deadline-Ms")
+        deadline = time.monotonic() + int(deadline_ms) / 1000 if deadline_ms else None
+        event_id = uuid.uuid4().hex
+        messages = sessions.setdefault(body["session_hash"], asyncio.Queue())
+        await messages.put({"msg": "estimation", "event_id": event_id, "rank": len(running), "queue_size": len(running)})
+        stats["joined"] += 1
+        running[event_id] = asyncio.ensure_future(
+            run(api_name, event_id, args, deadline, messages, body.get("simple_format", False)))
+        return {"event_id": event_id}
+
+    @app.get("/queue/data")
+    async def data(session_hash: str):
+        messages = sessions.get(session_hash)
+        if messages is None:
+            return JSONResponse({"detail": "Session not found."}, status_code=404)
+
+        async def events():
+            try:
+                while True:
+                    message = await messages.get()
+                    yield f"data: {json.dumps(message)}\n\n"
+                    if message["msg"] == "process_completed":
+                        yield 'data: {"msg": "close_stream", "event_id": null}\n\n'
+                        return
+            finally:
+                sessions.pop(session_hash, None)
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/cancel")
+    async def cancel(request: Request):
+        body = await request.json()
+        task = running.pop(body["event_id"], None)
+        if task is not None:
+            task.cancel()
+            stats["cancelled"] += 1
+        return {"success": True}
+
+    @app.get("/sessions")
+    def session_stats():
+        return chat_sessions.stats()
+
+    @app.delete("/sessions/{session_id}")
+    def end_session(session_id: str):
+        return {"ended": chat_sessions.end(session_id)}
+
+    @app.get("/stub_stats")
+    def stub_stats():
+        return dict(stats, in_flight=in_flight[0], queued=len(running), images=store.stats(),
+                    sessions=chat_sessions.stats())
+
+    return app
+
+
+def start_stub_server(port=None, **options):
+    """Run a stub server in a daemon thread; returns (server, base_url). Stop it with server.should_exit = True"""
+    import uvicorn
+    from local_server import find_free_port
+
+    port = port or find_free_port(7870)
+    server = uvicorn.Server(uvicorn.Config(create_app(**options), host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name=f"stub-{port}", daemon=True).start()
+    while not server.started:
+        time.sleep(0.02)
+    return server, f"http://127.0.0.1:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Model server stand-in for client tests and benchmarks")
+    parser.add_argument("--port", type=int, default=7870)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--token-ms", type=float, default=5.0, help="milliseconds per answer token")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests served at once")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of requests rejected with a 503")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of requests slowed down")
+    parser.add_argument("--slow-factor", type=float, default=10.0)
+    args = parser.parse_args()
+
+    import uvicorn
+    print(f"Stub model server at http://127.0.0.1:{args.port}/")
+    uvicorn.run(create_app(latency=args.latency, token_ms=args.token_ms, concurrency=args.concurrency,
+                           fail_rate=args.fail_rate, slow_rate=args.slow_rate, slow_factor=args.slow_factor),
+                host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
+import os
 import torch
 from PIL import Image
 from io import BytesIO
 import requests
 
-from transformers import AutoModelForCausalLM, AutoProcessor
+from transformers import AutoProcessor
+from fast_loader import load_model, print_load_report
+from quantization import apply_precision, compute_dtype, load_dtype, model_nbytes
 
 
 # Inference
@@ -21,8 +24,7 @@ convs = [
 
 
 
-# Load the model and processor
-model = AutoModelForCausalLM.from_pretrained("microsoft/Magma-8B", trust_remote_code=True)
+# Load the processor
 processor = AutoProcessor.from_pretrained("microsoft/Magma-8B", trust_remote_code=True)
 
 # Automatically detect and use the appropriate device
@@ -34,14 +36,24 @@ elif torch.backends.mps.is_available():
     print("Using MPS (Apple Silicon)")
 else:
     device = "cpu"
-    print("Using CPU (warning: this will be very slow)")
+    print("Using CPU (warning: this will be very slow; try MAGMA_PRECISION=int8 or int4)")
 
-model.to(device)
+# fp32, bf16, int8 or int4 - only used on CPU
+precision = os.environ.get("MAGMA_PRECISION", "fp32") if device == "cpu" else "fp32"
+
+# Load the weights straight onto the device, one safetensors shard at a time
+# (from_pretrained if streaming fails)
+model, report = load_model("microsoft/Magma-8B", device=device, dtype=load_dtype(precision))
+if report is not None:
+    print_load_report(report)
+if precision != "fp32":
+    apply_precision(model, precision)
+    print(f"Using {precision} weights ({model_nbytes(model) / 1024 ** 3:.1f} GB)")
 
 prompt = processor.tokenizer.apply_chat_template(convs, tokenize=False, add_generation_prompt=True)
 inputs = processor(images=image, texts=prompt, return_tensors="pt")
 # inputs = processor(images=[image], texts=prompt, return_tensors="pt")
-inputs['pixel_values'] = inputs['pixel_values'].unsqueeze(0)
+inputs['pixel_values'] = inputs['pixel_values'].unsqueeze(0).to(compute_dtype(model))
 inputs['image_sizes'] = inputs['image_sizes'].unsqueeze(0)
 # inputs = inputs.to("cuda")
 inputs = inputs.to(device)
@@ -0,0 +1,178 @@
+import torch
+from PIL import Image
+from transformers import BatchFeature, LlamaConfig, LlamaForCausalLM
+
+# A tiny, randomly initialised stand-in for Magma-8B.
+# It mimics the parts of the model/processor API that magma_gradio.py uses
+# (apply_chat_template, processor(images=..., texts=...), pixel_values that
+# need an extra batch dimension, processor.decode) so the serving code can be
+# exercised on CPU in a few seconds without downloading the real checkpoint.
+
+SPECIAL_TOKENS = ["<pad>", "<s>", "</s>", "<image>"]
+PAD_ID, BOS_ID, EOS_ID, IMAGE_ID = range(len(SPECIAL_TOKENS))
+FIRST_CHAR_ID = len(SPECIAL_TOKENS)
+
+
+class TinyTokenizer:
+    """Character-level tokenizer with the subset of the HF tokenizer API used by the app"""
+
+    def __init__(self):
+        self.pad_token_id = PAD_ID
+        self.bos_token_id = BOS_ID
+        self.eos_token_id = EOS_ID
+        self.image_token_id = IMAGE_ID
+        self.padding_side = "left"
+        # Printable ASCII plus newline
+        self.chars = ["\n"] + [chr(c) for c in range(32, 127)]
+        self.char_to_id = {c: i + FIRST_CHAR_ID for i, c in enumerate(self.chars)}
+        self.vocab_size = FIRST_CHAR_ID + len(self.chars)
+
+    def __len__(self):
+        return self.vocab_size
+
+    def apply_chat_template(self, convs, tokenize=False, add_generation_prompt=True):
+        """Render a conversation the same way for every call"""
+        text = "".join(f"<|{turn['role']}|>\n{turn['content']}\n" for turn in convs)
+        if add_generation_prompt:
+            text += "<|assistant|>\n"
+        if tokenize:
+            return self.encode(text)
+        return text
+
+    def encode(self, text):
+        ids = [BOS_ID]
+        # Image placeholders are the only multi-character token
+        for i, chunk in enumerate(text.split("<image>")):
+            if i > 0:
+                ids.append(IMAGE_ID)
+            ids.extend(self.char_to_id.get(c, self.char_to_id[" "]) for c in chunk)
+        return ids
+
+    def __call__(self, texts, return_tensors="pt", padding=True):
+        if isinstance(texts, str):
+            texts = [texts]
+        encoded = [self.encode(t) for t in texts]
+        max_len = max(len(ids) for ids in encoded)
+        input_ids = torch.full((len(encoded), max_len), PAD_ID, dtype=torch.long)
+        attention_mask = torch.zeros((len(encoded), max_len), dtype=torch.long)
+        for row, ids in enumerate(encoded):
+            # Left padding, as expected by decoder-only generation
+            input_ids[row, max_len - len(ids):] = torch.tensor(ids)
+            attention_mask[row, max_len - len(ids):] = 1
+        return BatchFeature({"input_ids": input_ids, "attention_mask": attention_mask})
+
+    def decode(self, ids, skip_special_tokens=False):
+        if isinstance(ids, torch.Tensor):
+            ids = ids.tolist()
+        pieces = []
+        for i in ids:
+            if i >= FIRST_CHAR_ID and i < self.vocab_size:
+                pieces.append(self.chars[i - FIRST_CHAR_ID])
+            elif not skip_special_tokens and i < FIRST_CHAR_ID:
+                pieces.append(SPECIAL_TOKENS[i])
+        return "".join(pieces)
+
+    def batch_decode(self, sequences, skip_special_tokens=False):
+        return [self.decode(seq, skip_special_tokens=skip_special_tokens) for seq in sequences]
+
+    def convert_ids_to_tokens(self, ids):
+        return [self.decode([i]) for i in ids]
+
+
+class TinyImageProcessor:
+    """Resize + normalise an image into a fixed number of square crops"""
+
+    def __init__(self, image_size=32, num_crops=2):
+        self.image_size = image_size
+        self.num_crops = num_crops
+
+    def to_json_string(self):
+        return f'{{"image_size": {self.image_size}, "num_crops": {self.num_crops}}}'
+
+    def __call__(self, image):
+        image = image.convert("RGB").resize((self.image_size, self.image_size * self.num_crops), Image.BILINEAR)
+        pixels = torch.tensor(list(image.getdata()), dtype=torch.float32)
+        pixels = pixels.view(self.num_crops, self.image_size, self.image_size, 3).permute(0, 3, 1, 2)
+        return pixels / 127.5 - 1.0
+
+
+class TinyMagmaProcessor:
+    """Stand-in for the Magma processor: texts -> input_ids, images -> pixel_values/image_sizes"""
+
+    def __init__(self, image_size=32, num_crops=2):
+        self.tokenizer = TinyTokenizer()
+        self.image_processor = TinyImageProcessor(image_size, num_crops)
+
+    def __call__(self, images=None, texts=None, return_tensors="pt"):
+        inputs = self.tokenizer(texts, return_tensors=return_tensors)
+        if images is not None:
+            if isinstance(images, (list, tuple)):
+                images = images[0]
+            # Like Magma, image tensors come back without a batch dimension
+            inputs["pixel_values"] = self.image_processor(images)
+            inputs["image_sizes"] = torch.tensor([images.size[1], images.size[0]])
+        return inputs
+
+    def decode(self, ids, skip_special_tokens=False):
+        return self.tokenizer.decode(ids, skip_special_tokens=skip_special_tokens)
+
+    def batch_decode(self, sequences, skip_special_tokens=False):
+        return self.tokenizer.batch_decode(sequences, skip_special_tokens=skip_special_tokens)
+
+
+class TinyVisionTower(torch.nn.Module):
+    """Mean-pools each image's crops into one embedding"""
+
+    def __init__(self, hidden_size):
+        super().__init__()
+        self.proj = torch.nn.Linear(3, hidden_size)
+
+    def forward(self, pixel_values):
+        # pixel_values: [batch, crops, 3, H, W]
+        return self.proj(pixel_values.mean(dim=(1, 3, 4)))
+
+
+class TinyMagmaForCausalLM(LlamaForCausalLM):
+    """Tiny Llama that accepts Magma's image inputs through a small vision tower"""
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.vision_tower = TinyVisionTower(config.hidden_size)
+
+    def forward(self, input_ids=None, pixel_values=None, image_sizes=None, inputs_embeds=None, **kwargs):
+        past_key_values = kwargs.get("past_key_values")
+        is_prefill = past_key_values is None or (
+            hasattr(past_key_values, "get_seq_length") and past_key_values.get_seq_length() == 0
+        )
+        # Like Magma, images are only merged into the prompt on the prefill pass
+        if is_prefill and pixel_values is not None and input_ids is not None and (input_ids == IMAGE_ID).any():
+            # Replace each <image> placeholder with a pooled projection of its image
+            inputs_embeds = self.get_input_embeddings()(input_ids)
+            image_embeds = self.vision_tower(pixel_values.to(inputs_embeds.dtype))
+            for row in range(input_ids.shape[0]):
+                positions = (input_ids[row] == IMAGE_ID).nonzero().flatten()
+                inputs_embeds[row, positions] = image_embeds[min(row, image_embeds.shape[0] - 1)]
+            input_ids = None
+        return super().forward(input_ids=input_ids, inputs_embeds=inputs_embeds, **kwargs)
+
+
+def load_tiny_magma(device="cpu", hidden_size=64, num_layers=2, seed=0):
+    """Build a tiny random model and matching processor"""
+    torch.manual_seed(seed)
+    processor = TinyMagmaProcessor()
+    config = LlamaConfig(
+        vocab_size=processor.tokenizer.vocab_size,
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=2048,
+        pad_token_id=PAD_ID,
+        bos_token_id=BOS_ID,
+        eos_token_id=EOS_ID,
+    )
+    model = TinyMagmaForCausalLM(config)
+    model.to(device)
+    model.eval()
+    return model, processor
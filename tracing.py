@@ -0,0 +1,479 @@
+import atexit
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Spans for every stage of a request, across the apps, model_client.py and
+# the server, written to a local file as OpenTelemetry JSON (one OTLP
+# ExportTraceServiceRequest per line, the format of the collector's file
+# exporter, so the file loads into Jaeger, Tempo & co. as is).
+#
+# Tracing is off unless MAGMA_TRACE names the file; when it is off, span()
+# and friends return a shared do-nothing object at once. Processes may share
+# one file (MAGMA_TRACE_SERVICE tells them apart). The trace id is the request id: model_client.py sends
+# it to the server in a W3C traceparent header (serve_replicas.py forwards it),
+# so client and server spans of one request end up in one trace.
+#
+# Work done for several requests at once (a batched generate call) is traced
+# once per request: the current context is a tuple of parents and a span gets
+# an id under each of them.
+#
+#   MAGMA_TRACE=traces.jsonl python web_automation_app.py
+#   python tracing.py traces.jsonl              # slowest stages
+#   python tracing.py traces.jsonl --trace ID   # one request, span by span
+
+TRACE_FILE = os.environ.get("MAGMA_TRACE", "")
+SERVICE_NAME = os.environ.get("MAGMA_TRACE_SERVICE", "")
+# Spans buffered before they are written out
+FLUSH_SPANS = 256
+
+# OTLP span kinds and status codes
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+STATUS_OK, STATUS_ERROR = 1, 2
+
+_current = contextvars.ContextVar("magma_trace", default=())
+# time.monotonic() -> Unix nanoseconds, for spans recorded from monotonic stamps
+_EPOCH_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+
+def _new_id(nbytes):
+    return os.urandom(nbytes).hex()
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+class Span:
+    """A timed stage; one OTLP span per parent context it was started under"""
+
+    def __init__(self, name, parents, kind=INTERNAL, attributes=None, start=None):
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start = time.monotonic_ns() if start is None else start
+        self.error = None
+        # (trace_id, span_id, parent_span_id) per parent; a new trace without one
+        self.ids = [(trace_id, _new_id(8), parent_id) for trace_id, parent_id in parents] \
+            or [(_new_id(16), _new_id(8), "")]
+
+    @property
+    def context(self):
+        return tuple((trace_id, span_id) for trace_id, span_id, _ in self.ids)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, end=None):
+        end = time.monotonic_ns() if end is None else end
+        attributes = [_attribute(key, value) for key, value in self.attributes.items() if value is not None]
+        status = {"code": STATUS_ERROR, "message": self.error} if self.error else {"code": STATUS_OK}
+        for trace_id, span_id, parent_id in self.ids:
+            _exporter.add({
+                "traceId": trace_id,
+                "spanId": span_id,
+                "parentSpanId": parent_id,
+                "name": self.name,
+                "kind": self.kind,
+                "startTimeUnixNano": str(self.start + _EPOCH_OFFSET_NS),
+                "endTimeUnixNano": str(end + _EPOCH_OFFSET_NS),
+                "attributes": attributes,
+                "status": status,
+            })
+
+
+class _NoSpan:
+    """What span() and start() return when tracing is off"""
+
+    context = ()
+
+    def set(self, **attributes):
+        pass
+
+    def end(self, end=None):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Nothing:
+    def __enter__(self):
+        return _NO_SPAN
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOTHING = _Nothing()
+
+
+def start(name, kind=INTERNAL, root=False, parents=None, **attributes):
+    """A Span under parents (default: the current span(s)) that the caller end()s
+
+    root=True starts a new trace when there is no parent (e.g. a user action
+    in an app); without it, stages outside any request are not traced. For
+    stages that cannot be one with block, such as a generator's lifetime.
+    """
+    if _exporter is None:
+        return _NO_SPAN
+    parents = parents or _current.get()
+    if not parents and not root:
+        return _NO_SPAN
+    return Span(name, parents, kind, attributes)
+
+
+def span(name, kind=INTERNAL, root=False, parents=None, **attributes):
+    """Context manager timing a stage, as a child of the current span(s) unless parents are given"""
+    if _exporter is None:
+        return _NOTHING
+    started = start(name, kind, root, parents, **attributes)
+    if started is _NO_SPAN:
+        return _NOTHING
+    return _active(started)
+
+
+@contextmanager
+def _active(current):
+    token = _current.set(current.context)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        current.end()
+
+
+def record(name, start, end, parents=None, **attributes):
+    """A finished stage from time.monotonic() stamps, under parents (default: the current span)"""
+    if _exporter is None:
+        return
+    parents = _current.get() if parents is None else parents
+    if parents:
+        Span(name, parents, attributes=attributes, start=int(start * 1e9)).end(int(end * 1e9))
+
+
+def current():
+    """The current trace context, to hand to another thread or request (() when off)"""
+    return _current.get() if _exporter is not None else ()
+
+
+@contextmanager
+def _attached(parents):
+    token = _current.set(tuple(parents))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def attach(parents):
+    """Context manager making parents (a current() value, or several merged) the current context"""
+    if _exporter is None or not parents:
+        return _NOTHING
+    return _attached(parents)
+
+
+def carry(coroutine):
+    """coroutine wrapped to run under the caller's trace context (for run_coroutine_threadsafe)"""
+    parents = current()
+    if not parents:
+        return coroutine
+
+    async def traced():
+        with attach(parents):
+            return await coroutine
+    return traced()
+
+
+def iterate(span, iterator):
+    """Yield from iterator with span current while each item is produced, then end span
+
+    For generators whose steps run in different contexts (Gradio runs each
+    step in a worker thread), where a with block cannot stay open across a yield.
+    """
+    if not span.context:
+        yield from iterator
+        return
+    try:
+        while True:
+            with attach(span.context):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+    except BaseException as e:
+        if not isinstance(e, GeneratorExit):
+            span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        iterator.close()
+        span.end()
+
+
+def traceparent():
+    """W3C traceparent header value of the current span, or None"""
+    parents = current()
+    if not parents:
+        return None
+    trace_id, span_id = parents[0]
+    return f"00-{trace_id}-{span_id}-01"
+
+
+def from_traceparent(value):
+    """Trace context of a traceparent header (() if missing or malformed)"""
+    if _exporter is None or not value:
+        return ()
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return ()
+    return ((parts[1], parts[2]),)
+
+
+class StageTimer:
+    """Where a model.generate call turned from prefill into decoding
+
+    Passed in generate()'s logits_processor list: it is called once per
+    generated token, the first time right after the prefill forward pass.
+    """
+
+    def __init__(self):
+        self.start()
+
+    def start(self):
+        """Mark the beginning of the generate call"""
+        self.started = time.monotonic()
+        self.first_token = None
+        self.steps = 0
+
+    def __call__(self, input_ids, scores):
+        if self.first_token is None:
+            self.first_token = time.monotonic()
+        self.steps += 1
+        return scores
+
+    def record(self, parents=None):
+        """prefill and decode spans of the finished call"""
+        ended = time.monotonic()
+        first_token = self.first_token or ended
+        record("prefill", self.started, first_token, parents)
+        record("decode", first_token, ended, parents, steps=self.steps)
+
+
+def stage_timer(timer=None):
+    """timer, or a new StageTimer when the current request is traced, else None"""
+    if timer is not None or _exporter is None or not _current.get():
+        return timer
+    return StageTimer()
+
+
+def trace_module(module, name):
+    """Trace every forward() of a torch module (e.g. the vision tower) as a stage"""
+    if _exporter is None or getattr(module, "_traced", False):
+        return
+    starts = threading.local()
+
+    def before(module, args):
+        if _current.get():
+            starts.value = time.monotonic()
+
+    def after(module, args, output):
+        started = getattr(starts, "value", None)
+        if started is not None:
+            starts.value = None
+            record(name, started, time.monotonic())
+
+    module.register_forward_pre_hook(before)
+    module.register_forward_hook(after)
+    module._traced = True
+
+
+class Exporter:
+    """Buffers finished spans and appends them to the trace file as OTLP JSON lines"""
+
+    def __init__(self, path, service):
+        self.path = path
+        self.resource = {"attributes": [_attribute("service.name", service),
+                                        _attribute("process.pid", os.getpid())]}
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+            # A root, server or client span ends (a part of) a request: write it out while it is fresh
+            if len(self.spans) < FLUSH_SPANS and span["parentSpanId"] and span["kind"] == INTERNAL:
+                return
+            spans, self.spans = self.spans, []
+        self._write(spans)
+
+    def flush(self):
+        with self.lock:
+            spans, self.spans = self.spans, []
+        self._write(spans)
+
+    def _write(self, spans):
+        if not spans:
+            return
+        line = json.dumps({"resourceSpans": [{
+            "resource": self.resource,
+            "scopeSpans": [{"scope": {"name": "magma"}, "spans": spans}],
+        }]})
+        # One write per line in append mode, so several processes can share the file
+        with open(self.path, "a") as f:
+            f.write(line + "\n")
+
+
+_exporter = None
+
+
+def configure(path=TRACE_FILE, service=None):
+    """Start (or with path="" stop) exporting spans; MAGMA_TRACE configures it at import"""
+    global _exporter
+    if _exporter is not None:
+        _exporter.flush()
+    _exporter = Exporter(path, service or SERVICE_NAME or os.path.basename(sys.argv[0]) or "python") \
+        if path else None
+
+
+if TRACE_FILE:
+    configure(TRACE_FILE)
+atexit.register(lambda: _exporter is not None and _exporter.flush())
+
+
+# Summary of a trace file
+
+def load_spans(path):
+    """Every span in an OTLP JSON lines file, as dicts with start/end seconds and the service"""
+    spans = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for resource_spans in json.loads(line).get("resourceSpans", []):
+                service = next((a["value"].get("stringValue") for a in resource_spans["resource"]["attributes"]
+                                if a["key"] == "service.name"), "")
+                for scope_spans in resource_spans.get("scopeSpans", []):
+                    for item in scope_spans.get("spans", []):
+                        spans.append({
+                            "trace": item["traceId"],
+                            "id": item["spanId"],
+                            "parent": item.get("parentSpanId", ""),
+                            "name": item["name"],
+                            "service": service,
+                            "start": int(item["startTimeUnixNano"]) / 1e9,
+                            "end": int(item["endTimeUnixNano"]) / 1e9,
+                            "error": (item.get("status") or {}).get("message"),
+                            "attributes": {a["key"]: next(iter(a["value"].values())) for a in item.get("attributes", [])},
+                        })
+    return spans
+
+
+def self_times(spans):
+    """Span id -> its duration minus the time covered by its children"""
+    children = {}
+    for item in spans:
+        children.setdefault((item["trace"], item["parent"]), []).append(item)
+    result = {}
+    for item in spans:
+        covered = 0.0
+        end = item["start"]
+        # Children can overlap (hedged attempts, streamed stages): count covered time once
+        for child in sorted(children.get((item["trace"], item["id"]), []), key=lambda c: c["start"]):
+            start = max(child["start"], end)
+            if child["end"] > start:
+                covered += min(child["end"], item["end"]) - start
+                end = max(end, child["end"])
+        result[item["id"]] = max(0.0, item["end"] - item["start"] - covered)
+    return result
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))] if values else 0.0
+
+
+def summarize(spans, top=15):
+    """Print the stages that took the most time (self time: not spent in a sub-stage) and the slowest requests"""
+    own = self_times(spans)
+    stages = {}
+    for item in spans:
+        stages.setdefault((item["service"], item["name"]), []).append(item)
+    rows = []
+    for (service, name), items in stages.items():
+        durations = [item["end"] - item["start"] for item in items]
+        rows.append((sum(own[item["id"]] for item in items), service, name, len(items),
+                     percentile(durations, 0.5), percentile(durations, 0.9), max(durations),
+                     sum(1 for item in items if item["error"])))
+    rows.sort(reverse=True)
+    traces = {item["trace"] for item in spans}
+    print(f"{len(spans)} spans in {len(traces)} traces")
+    print(f"{'stage':<40} {'count':>6} {'self s':>8} {'p50 ms':>9} {'p90 ms':>9} {'max ms':>9} {'errors':>6}")
+    for self_total, service, name, count, p50, p90, longest, errors in rows[:top]:
+        print(f"{(service + ': ' + name)[:40]:<40} {count:>6} {self_total:8.2f} {p50 * 1000:9.1f} "
+              f"{p90 * 1000:9.1f} {longest * 1000:9.1f} {errors:>6}")
+
+    roots = sorted((item for item in spans if not item["parent"]), key=lambda s: s["start"] - s["end"])
+    if roots:
+        print("\nSlowest requests")
+        for item in roots[:5]:
+            print(f"  {item['trace']}  {(item['end'] - item['start']) * 1000:9.1f} ms  {item['service']}: {item['name']}")
+
+
+def print_trace(spans, trace_id):
+    """One trace as an indented timeline"""
+    items = [item for item in spans if item["trace"].startswith(trace_id)]
+    if not items:
+        print(f"No spans for trace {trace_id}")
+        return
+    children = {}
+    for item in items:
+        children.setdefault(item["parent"], []).append(item)
+    ids = {item["id"] for item in items}
+    origin = min(item["start"] for item in items)
+
+    def show(item, depth):
+        error = f"  ERROR {item['error']}" if item["error"] else ""
+        print(f"{(item['start'] - origin) * 1000:9.1f} ms {(item['end'] - item['start']) * 1000:9.1f} ms  "
+              f"{'  ' * depth}{item['service']}: {item['name']}{error}")
+        for child in sorted(children.get(item["id"], []), key=lambda c: c["start"]):
+            show(child, depth + 1)
+
+    # Roots, and spans whose parent is in another file or was not exported
+    for item in sorted((i for i in items if not i["parent"] or i["parent"] not in ids), key=lambda i: i["start"]):
+        show(item, 0)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarize a MAGMA_TRACE file")
+    parser.add_argument("path", nargs="+", help="trace file(s), OTLP JSON lines")
+    parser.add_argument("--top", type=int, default=15, help="stages to list")
+    parser.add_argument("--trace", help="print this trace (id or prefix) span by span")
+    args = parser.parse_args()
+
+    spans = [item for path in args.path for item in load_spans(path)]
+    if args.trace:
+        print_trace(spans, args.trace)
+    else:
+        summarize(spans, args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,29 @@
 import sys
 import os
-import time
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
                             QLabel, QLineEdit, QPushButton, QTextEdit, QProgressBar,
                             QScrollArea, QSplitter, QFrame, QGridLayout, QSlider, QDial, QTabWidget, QToolButton)
 from PyQt5.QtGui import QPixmap, QImage, QFont, QPainter, QColor, QPen
 from PyQt5.QtCore import Qt, QThread, pyqtSignal, QRect, QPropertyAnimation, QEasingCurve, pyqtProperty, QTimer, QSize, QPointF, QPoint, QParallelAnimationGroup, QSequentialAnimationGroup
 import requests
-from gradio_client import Client, handle_file
-from PIL import Image, ImageDraw
 from io import BytesIO
-import re
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.action_chains import ActionChains
-import tempfile
 from PyQt5.QtWidgets import (QGraphicsOpacityEffect, QGraphicsBlurEffect)
 import random
 from PyQt5.QtMultimedia import QSound
 import urllib.request
 import socket
+import tracing
+from browser_pool import BrowserPool
+from page_readiness import format_report, wait_until_ready
+from web_capture import capture_page, click_at
+from image_buffer import ImageBuffer, ImageStats, to_qpixmap
+from model_client import shared_client
+from overlay import draw_detections
+from coordinate_parser import extract_coordinates
+from concurrent.futures import CancelledError
 
 # Screen dimensions constants
 SCREENSHOT_WIDTH = 600
@@ -30,6 +31,13 @@ SCREENSHOT_HEIGHT = 600
 DISPLAY_WIDTH = 600
 DISPLAY_HEIGHT = 600
 
+# Warm browser sessions shared by capture and action
+BROWSER_POOL_SIZE = int(os.environ.get("MAGMA_BROWSER_POOL_SIZE", "2"))
+BROWSER_MAX_USES = int(os.environ.get("MAGMA_BROWSER_MAX_USES", "50"))
+# MAGMA_BROWSER_HEADLESS=0 shows the pooled browser windows, so the click can
+# be watched on the same page that was captured
+BROWSER_HEADLESS = os.environ.get("MAGMA_BROWSER_HEADLESS", "1") != "0"
+
 class AnimatedLabel(QLabel):
     """A label that can flash with an animated color effect"""
     def __init__(self, text="", parent=None):
@@ -63,203 +71,139 @@ class AnimatedLabel(QLabel):
 class WebCaptureThread(QThread):
     """Thread for capturing website screenshots without freezing UI"""
     progress_update = pyqtSignal(str, int)
-    screenshot_ready = pyqtSignal(str)
+    screenshot_ready = pyqtSignal(object)  # ImageBuffer
     error = pyqtSignal(str)
     
-    def __init__(self, url):
+    def __init__(self, url, pool, stats=None, stale_session_id=None):
         super().__init__()
         self.url = url
-        self.screenshot_path = None
+        self.pool = pool
+        self.stats = stats
+        self.stale_session_id = stale_session_id  # previous capture's pinned session, to give back
+        self.screenshot = None
+        self.session_id = None  # pinned browser session showing the captured page
+        self.trace = ()  # the capture's span; analysis and click join its trace
     
     def run(self):
+        # Each capture starts the trace of one automation run (see tracing.py)
+        with tracing.span("capture_website", root=True, url=self.url) as span:
+            self.trace = span.context
+            self.capture()
+            if self.stats is not None:
+                # Encode/decode/disk-write counters go on the span instead of stdout
+                span.set(**self.stats.as_dict())
+    
+    def capture(self):
+        session = None
         try:
-            self.progress_update.emit("Setting up browser...", 10)
-            
-            # Set up a headless browser with fixed dimensions
-            chrome_options = Options()
-            chrome_options.add_argument("--headless")
-            chrome_options.add_argument("--disable-gpu")
-            chrome_options.add_argument("--no-sandbox")
-            
-            # Set window size to match content plus some margin
-            chrome_options.add_argument("--window-size=600,600")
-            
-            self.progress_update.emit("Launching browser...", 20)
-            driver = webdriver.Chrome(options=chrome_options)
-            
-            self.progress_update.emit(f"Loading page: {self.url}", 30)
+            if self.stale_session_id is not None:
+                # Resetting (or replacing) a session is WebDriver work, kept off the GUI thread
+                self.pool.unpin(self.stale_session_id)
+            self.progress_update.emit("Getting browser session...", 10)
+            with tracing.span("browser_acquire"):
+                session = self.pool.acquire()
+            driver = session.driver
+            
+            # Screenshot stays in memory - no scaling needed
             try:
-                driver.get(self.url)
-                print(f"Driver reported page loaded with title: {driver.title}")
+                capture = capture_page(driver, self.url, on_progress=self.progress_update.emit, stats=self.stats)
             except Exception as e:
                 print(f"Page load exception: {str(e)}")
                 self.error.emit(f"Error loading page: {str(e)}")
-                driver.quit()
+                self.pool.release(session, discard=True)
                 return
+            print(f"Page {format_report(capture['readiness'])}")
             
-            # Wait for page to load
-            wait = WebDriverWait(driver, 10)
-            wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
-            time.sleep(1)  # Small delay to ensure everything renders
-            
-            self.progress_update.emit("Page loaded, capturing screenshot...", 70)
-            
-            # Take a simple screenshot - no scaling needed
-            fd, temp_path = tempfile.mkstemp(suffix='.png')
-            os.close(fd)
-            driver.save_screenshot(temp_path)
-            
-            # No scaling needed - content is already the right size
-            print(f"Screenshot saved to: {temp_path}")
+            self.screenshot = capture["screenshot"]
+            with tracing.span("archive"):
+                archived = self.screenshot.archive("capture")
+            print(f"Screenshot captured: {len(self.screenshot) / 1024:.0f} KB" +
+                  (f", archived to {archived}" if archived else ""))
             
-            self.screenshot_path = temp_path
             self.progress_update.emit("Screenshot captured!", 100)
             
-            # Close the browser
-            driver.quit()
+            # Keep the session on this page so the click runs on what was captured
+            self.session_id = self.pool.pin(session, self.url)
+            session = None
             
-            self.screenshot_ready.emit(self.screenshot_path)
+            self.screenshot_ready.emit(self.screenshot)
             
         except Exception as e:
+            if session is not None:
+                self.pool.release(session)
             self.error.emit(f"Error capturing website: {str(e)}")
             
 
 class ActionThread(QThread):
     """Thread for clicking on elements with visible feedback"""
     progress_update = pyqtSignal(str, int)
-    result_ready = pyqtSignal(str, str)
+    result_ready = pyqtSignal(object, str)  # ImageBuffer of the result, summary
     error = pyqtSignal(str)
     
-    def __init__(self, url, coords, coords_type):
+    def __init__(self, url, coords, coords_type, pool, session_id=None, stats=None, trace=()):
         super().__init__()
         self.url = url
         self.coords = coords
         self.coords_type = coords_type
+        self.pool = pool
+        self.session_id = session_id
+        self.stats = stats
+        self.trace = trace  # the capture's trace context
     
     def run(self):
+        with tracing.span("click_element", root=True, parents=self.trace, url=self.url) as span:
+            self.act()
+            if self.stats is not None:
+                span.set(**self.stats.as_dict())
+    
+    def act(self):
+        session = None
         try:
-            self.progress_update.emit("Setting up browser...", 10)
-            
-            # Set up a visible browser (not headless) to show the interaction
-            chrome_options = Options()
-            # Make browser visible to see the interaction
-            # chrome_options.add_argument("--start-maximized")
-            chrome_options.add_argument("--window-size=800,800")
-            chrome_options.add_argument("--no-sandbox")
-            
-            self.progress_update.emit("Launching browser...", 20)
-            driver = webdriver.Chrome(options=chrome_options)
-            
-            # Load the webpage
-            self.progress_update.emit(f"Loading page: {self.url}", 30)
-            try:
-                driver.get(self.url)
-                print(f"Driver reported page loaded with title: {driver.title}")
-            except Exception as e:
-                print(f"Page load exception: {str(e)}")
-                self.error.emit(f"Error loading page: {str(e)}")
-                driver.quit()
-                return
-            
-            # Wait for page to load
-            self.progress_update.emit("Waiting for page to load...", 40)
-            wait = WebDriverWait(driver, 10)
-            wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
+            self.progress_update.emit("Getting browser session...", 10)
+            with tracing.span("browser_acquire", pinned=self.session_id is not None):
+                session = self.pool.acquire(session_id=self.session_id)
+            driver = session.driver
+            
+            if session.id == self.session_id and session.pinned_url == self.url:
+                # Same session and page state that was captured and analyzed
+                self.progress_update.emit("Using the captured page", 40)
+            else:
+                # The captured session is gone (or the URL changed): load the page again
+                self.progress_update.emit(f"Loading page: {self.url}", 30)
+                try:
+                    with tracing.span("page_load", url=self.url):
+                        driver.get(self.url)
+                    print(f"Driver reported page loaded with title: {driver.title}")
+                except Exception as e:
+                    print(f"Page load exception: {str(e)}")
+                    self.error.emit(f"Error loading page: {str(e)}")
+                    self.pool.release(session)
+                    return
+                
+                # Wait for page to load
+                self.progress_update.emit("Waiting for page to load...", 40)
+                with tracing.span("page_ready"):
+                    wait = WebDriverWait(driver, 10)
+                    wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
+                    report = wait_until_ready(driver, self.url)
+                print(f"Page {format_report(report)}")
             
             # Take a "before" screenshot
-            before_screenshot = tempfile.mktemp(suffix='.png')
-            driver.save_screenshot(before_screenshot)
+            with tracing.span("screenshot_before"):
+                before_screenshot = ImageBuffer.from_driver(driver, self.stats, "before")
             self.progress_update.emit("Pre-click screenshot captured", 50)
             
-            # Get viewport size
-            viewport_width = driver.execute_script("return window.innerWidth")
-            viewport_height = driver.execute_script("return window.innerHeight")
-            
-            # Calculate click position in pixels
-            if self.coords_type == 'point':
-                x_rel, y_rel = self.coords
-                x_px = int(x_rel * viewport_width)
-                y_px = int(y_rel * viewport_height)
-            else:  # bbox
-                # Click in the middle of the box
-                x_min, y_min, x_max, y_max = self.coords
-                x_rel = (x_min + x_max) / 2
-                y_rel = (y_min + y_max) / 2
-                x_px = int(x_rel * viewport_width)
-                y_px = int(y_rel * viewport_height)
-                
-                print(f"Bounding box: ({x_min}, {y_min}, {x_max}, {y_max})")
-                print(f"Clicking on center point: ({x_rel}, {y_rel}) -> {x_px}px, {y_px}px")
-            
-            # Highlight the element before clicking (using JavaScript)
-            highlight_script = """
-            var clickPoint = document.elementFromPoint(arguments[0], arguments[1]);
-            if (clickPoint) {
-                // Save original styles
-                var originalOutline = clickPoint.style.outline;
-                var originalBoxShadow = clickPoint.style.boxShadow;
-                
-                // Apply highlight
-                clickPoint.style.outline = '3px solid #FF5722';
-                clickPoint.style.boxShadow = '0 0 10px #FF5722';
-                
-                // Return element info for logging
-                return {
-                    tagName: clickPoint.tagName,
-                    id: clickPoint.id,
-                    className: clickPoint.className,
-                    text: clickPoint.textContent.substring(0, 50)
-                };
-            }
-            return null;
-            """
-            
-            # Try to highlight and get element info
-            element_info = driver.execute_script(highlight_script, x_px, y_px)
-            if element_info:
-                info_text = f"Element: {element_info.get('tagName', 'Unknown')} "
-                if element_info.get('id'):
-                    info_text += f"ID: {element_info['id']} "
-                if element_info.get('className'):
-                    info_text += f"Class: {element_info['className']} "
-                if element_info.get('text'):
-                    info_text += f"Text: {element_info['text']}"
-                    
-                self.progress_update.emit(f"Target: {info_text}", 55)
-            
-            # Take screenshot of highlighted element
-            highlight_screenshot = tempfile.mktemp(suffix='.png')
-            driver.save_screenshot(highlight_screenshot)
-            
-            # Small delay to see the highlight
-            time.sleep(0.5)
-            
-            self.progress_update.emit(f"Clicking at coordinates ({x_rel:.3f}, {y_rel:.3f})...", 60)
-            
-            # Create ActionChains to move and click
-            actions = ActionChains(driver)
-            # First move to (0,0) to ensure relative movement works correctly
-            actions.move_to_element(driver.find_element(By.TAG_NAME, "body"))
-            actions.move_by_offset(x_px, y_px)
-            actions.click()
-            actions.perform()
-            
-            self.progress_update.emit("Click performed! Observing changes...", 70)
-            
-            # Wait longer to observe changes
-            time.sleep(2)
-            
-            # Take a screenshot of results
-            fd, result_path = tempfile.mkstemp(suffix='.png')
-            os.close(fd)
-            driver.save_screenshot(result_path)
-            
-            # Get page title and content for summary
-            page_title = driver.title
-            try:
-                page_content = driver.find_element(By.TAG_NAME, "body").text[:500]
-            except:
-                page_content = "Content could not be extracted"
+            # Highlight, click and wait for the page to react
+            click = click_at(driver, self.coords, self.coords_type, highlight=True,
+                             on_progress=self.progress_update.emit, stats=self.stats)
+            print(f"After click: page {format_report(click['readiness'])}")
+            with tracing.span("archive"):
+                for screenshot in (before_screenshot, click["highlight"], click["screenshot"]):
+                    screenshot.archive()
+            x_rel, y_rel = click["x_rel"], click["y_rel"]
+            element_info = click["element"]
+            page_title = click["title"]
+            page_content = click["content"]
                 
             # Create a more detailed summary with before/after comparison
             summary = f"Page Title: {page_title}\n\n"
@@ -272,85 +216,78 @@ class ActionThread(QThread):
             
             self.progress_update.emit("Action completed! Processing results...", 90)
             
-            # Keep browser open for a bit longer to see the result
-            time.sleep(1)
-            
-            # Close the browser
-            driver.quit()
+            # Hand the session back (its state is reset for the next user)
+            self.pool.release(session)
+            session = None
             
             # Return the result with the final screenshot
-            self.result_ready.emit(result_path, summary)
+            self.result_ready.emit(click["screenshot"], summary)
             
         except Exception as e:
             import traceback
             traceback.print_exc()
+            if session is not None:
+                self.pool.release(session)
             self.error.emit(f"Error performing action: {str(e)}")
 
 
 class ModelThread(QThread):
     """Thread for running API calls to the model"""
     finished = pyqtSignal(dict)
+    partial = pyqtSignal(str)  # answer text generated so far
     error = pyqtSignal(str)
     
-    def __init__(self, client, image_path, system_prompt, user_prompt):
+    def __init__(self, client, screenshot, system_prompt, user_prompt, trace=()):
         super().__init__()
-        self.client = client
-        self.image_path = image_path
+        self.client = client  # model_client.SharedClient
+        self.screenshot = screenshot  # ImageBuffer
         self.system_prompt = system_prompt
         self.user_prompt = user_prompt
+        self.trace = trace  # the capture's trace context
+        self.future = None
     
     def run(self):
+        # The client's request and attempt spans, and the server's, nest under this one
+        with tracing.span("analyze_screenshot", root=True, parents=self.trace):
+            self.analyze()
+    
+    def analyze(self):
         try:
-            result = self.client.predict(
-                image_input=handle_file(self.image_path) if self.image_path else None,
+            # Stream the answer; only the coordinate matters here, so the server
+            # stops generating as soon as a complete one has been produced.
+            # The screenshot goes up compactly (skipped if the server has it).
+            self.future = self.client.submit(
+                "generate",
+                self.screenshot,
+                self.user_prompt,
                 system_prompt=self.system_prompt,
-                user_prompt=self.user_prompt,
-                chat_history=[],
-                api_name="/generate_response"
+                on_partial=self.partial.emit,
+                stop_at_coordinate=True,
+                priority="interactive"  # ahead of batch sweeps on a shared server
             )
+            result = self.future.result()
             
-            response_text = result[0][0][1] if result and result[0] and len(result[0]) > 0 else ""
+            response_text = result["text"]
             
             # Extract coordinates
-            coordinates_data = self.extract_coordinates(response_text)
+            with tracing.span("extract_coordinates"):
+                coordinates_data = extract_coordinates(response_text)
             
             self.finished.emit({
                 "response": response_text,
                 "coordinates": coordinates_data,
-                "raw_result": result
+                "raw_result": result["data"]
             })
+        except CancelledError:
+            self.error.emit("Analysis cancelled")
         except Exception as e:
             self.error.emit(str(e))
     
-    def extract_coordinates(self, text):
-        """Extract coordinate pattern from text - handles both formats"""
-        # Try four-value bounding box pattern first
-        pattern_bbox = r"Coordinate: \(([0-9.]+), ([0-9.]+), ([0-9.]+), ([0-9.]+)\)"
-        match = re.search(pattern_bbox, text)
-        if match:
-            try:
-                x_min = float(match.group(1))
-                y_min = float(match.group(2))
-                x_max = float(match.group(3))
-                y_max = float(match.group(4))
-                return {'type': 'bbox', 'coords': (x_min, y_min, x_max, y_max)}
-            except ValueError:
-                return None
-        
-        # Try two-value center point pattern
-        pattern_point = r"Coordinate: \(([0-9.]+), ([0-9.]+)\)"
-        match = re.search(pattern_point, text)
-        if match:
-            try:
-                x = float(match.group(1))
-                y = float(match.group(2))
-                return {'type': 'point', 'coords': (x, y)}
-            except ValueError:
-                return None
-            
-        return None
-
-
+    def cancel(self):
+        """Abandon the request (the server stops generating too)"""
+        if self.future is not None:
+            self.future.cancel()
+    
 class InteractiveImageViewer(QWidget):
     """Advanced image viewer with zoom, pan and HUD overlay"""
     element_clicked = pyqtSignal(QPointF)
@@ -517,26 +454,22 @@ class InteractiveImageViewer(QWidget):
         self.setMouseTracking(True)
         self.image_label.setMouseTracking(True)
     
-    def set_image(self, image_path):
-        """Load and display an image with improved visibility"""
+    def set_image(self, image):
+        """Display an image (file path, ImageBuffer or PIL image) with improved visibility"""
         try:
             # Skip if this is a text message
-            if isinstance(image_path, str) and (image_path.startswith("No image") or image_path.startswith("Failed")):
-                self.image_label.setText(image_path)
+            if isinstance(image, str) and (image.startswith("No image") or image.startswith("Failed")):
+                self.image_label.setText(image)
                 self.pixmap = None
                 self.original_pixmap = None
-                print(f"Setting text message: {image_path}")
+                print(f"Setting text message: {image}")
                 return
             
-            print(f"LOADING IMAGE FROM: {image_path}")
-            print(f"File exists: {os.path.exists(image_path)}")
-            print(f"File size: {os.path.getsize(image_path)} bytes")
-            
-            # Create and check pixmap directly
-            pixmap = QPixmap(image_path)
+            # Create and check pixmap directly (in-memory images are never written to disk)
+            pixmap = to_qpixmap(image)
             if pixmap.isNull():
-                print(f"ERROR: Pixmap is NULL for {image_path}")
-                self.image_label.setText(f"Failed to load image: {image_path}")
+                print(f"ERROR: Pixmap is NULL for {image}")
+                self.image_label.setText(f"Failed to load image: {image}")
                 return
             
             print(f"Pixmap loaded successfully: {pixmap.width()}x{pixmap.height()}")
@@ -1059,10 +992,26 @@ class WebAutomationApp(QMainWindow):
         
         self.api_url = "https://002d2d34e0b38b34c9.gradio.live/"
         self.client = None
-        self.screenshot_path = None
+        self.screenshot = None  # ImageBuffer of the last capture
+        self.image_stats = None  # encode/decode counters of the current capture -> action request
+        
+        # Warm browser sessions; one is started now so the first capture skips the launch
+        self.browser_pool = BrowserPool(
+            size=BROWSER_POOL_SIZE, max_uses=BROWSER_MAX_USES, headless=BROWSER_HEADLESS,
+            window_size=(SCREENSHOT_WIDTH, SCREENSHOT_HEIGHT)
+        ).start(warm=1)
+        self.browser_session_id = None  # session still showing the last captured page
+        self.trace = ()  # trace context of the last capture (tracing.py)
         
         self.init_ui()
     
+    def closeEvent(self, event):
+        """Quit the pooled browsers with the window, and drop a running analysis"""
+        if getattr(self, "model_thread", None) is not None:
+            self.model_thread.cancel()
+        self.browser_pool.close()
+        super().closeEvent(event)
+    
     def init_ui(self):
         self.setWindowTitle("Web Automation Assistant")
         # Make window size more compact, especially height
@@ -1320,7 +1269,8 @@ class WebAutomationApp(QMainWindow):
         """Connect to the Gradio API"""
         try:
             self.api_url = self.api_input.text()
-            self.client = Client(self.api_url)
+            self.client = shared_client(self.api_url)
+            self.client.connect()
             
             self.api_status.setText("Connected!")
             self.api_status.setStyleSheet("color: #00FF00; font-style: italic;")
@@ -1355,26 +1305,27 @@ class WebAutomationApp(QMainWindow):
         self.summary_area.clear()
         self.result_viewer.set_image("No image")
         
-        # Create and start worker thread
-        self.capture_thread = WebCaptureThread(url)
+        # Each capture starts a new request for the image counters
+        self.image_stats = ImageStats(url)
+        
+        # Create and start worker thread; it also gives back the previous
+        # capture's page, which is no longer needed
+        self.capture_thread = WebCaptureThread(url, self.browser_pool, self.image_stats, self.browser_session_id)
+        self.browser_session_id = None
         self.capture_thread.progress_update.connect(self.update_status)
         self.capture_thread.screenshot_ready.connect(self.handle_screenshot)
         self.capture_thread.error.connect(self.handle_error)
         self.capture_thread.start()
     
-    def handle_screenshot(self, screenshot_path):
+    def handle_screenshot(self, screenshot):
         """Display the captured screenshot with a clean, simple approach"""
-        self.screenshot_path = screenshot_path
-        
-        if not os.path.exists(screenshot_path):
-            self.update_status(f"Screenshot file not found: {screenshot_path}", 0)
-            return
-        
-        print(f"DIRECT DISPLAY: Loading image from {screenshot_path}")
+        self.screenshot = screenshot
+        self.browser_session_id = self.capture_thread.session_id
+        self.trace = self.capture_thread.trace
         
         # Create a clean image display without extra controls
         direct_display = QLabel()
-        direct_pixmap = QPixmap(screenshot_path)
+        direct_pixmap = screenshot.qpixmap()
         
         if not direct_pixmap.isNull():
             # Set pixmap with appropriate scaling for the view
@@ -1415,7 +1366,7 @@ class WebAutomationApp(QMainWindow):
     
     def analyze_screenshot(self):
         """Send the screenshot to the API for analysis"""
-        if not self.screenshot_path:
+        if not self.screenshot:
             self.update_status("No screenshot available. Capture a website first.", 0)
             return
         
@@ -1429,14 +1380,21 @@ class WebAutomationApp(QMainWindow):
         # Create and start worker thread
         self.model_thread = ModelThread(
             self.client,
-            self.screenshot_path,
+            self.screenshot,
             self.system_prompt.text(),
-            self.user_prompt.text()
+            self.user_prompt.text(),
+            trace=self.trace
         )
+        self.model_thread.partial.connect(self.handle_model_partial)
         self.model_thread.finished.connect(self.handle_model_response)
         self.model_thread.error.connect(self.handle_error)
         self.model_thread.start()
     
+    def handle_model_partial(self, text):
+        """Show the answer while it is being generated"""
+        self.response_area.setText(text)
+        self.update_status("Receiving AI analysis...", 60)
+    
     def handle_model_response(self, result):
         """Handle the model's response and show highlighted image"""
         response_text = result.get("response", "")
@@ -1477,149 +1435,17 @@ class WebAutomationApp(QMainWindow):
     
     def create_highlighted_image(self):
         """Create a highlighted image with more prominent visualization"""
-        if not self.coordinates_data or not self.screenshot_path:
+        if not self.coordinates_data or not self.screenshot:
             return None
         
         try:
-            # Load the image
-            img = Image.open(self.screenshot_path)
-            width, height = img.size
-            
-            # Make sure image is in RGB mode
-            if img.mode != "RGB":
-                img = img.convert("RGB")
+            # Rings and crosshair on a point, filled box with corner brackets, coordinates as text
+            img = draw_detections(self.screenshot.pil(), [self.coordinates_data], style="highlight", labels=True)
             
-            # Create a more visible drawing context
-            draw = ImageDraw.Draw(img)
+            # Display the highlighted image straight from memory
+            self.display_image_in_tab(img, 0, "CAPTURE VIEW")
             
-            if self.coordinates_data['type'] == 'point':
-                # Get coordinates
-                x, y = self.coordinates_data['coords']
-                center_x = int(x * width)
-                center_y = int(y * height)
-                
-                # Make a more visible targeting element
-                radius = max(15, min(width, height) // 25)
-                
-                # 1. Draw pulsing circles (multiple rings with different colors)
-                colors = ["#00E5FF", "#FF5722", "#FFEB3B"]
-                for i, color in enumerate(colors):
-                    r = radius - (i * 3)
-                    if r > 0:
-                        draw.ellipse(
-                            (center_x - r, center_y - r, center_x + r, center_y + r),
-                            outline=color,
-                            width=3
-                        )
-                
-                # 2. Draw crosshair with extended lines
-                line_length = radius * 2
-                # Horizontal line
-                draw.line(
-                    (center_x - line_length, center_y, center_x - radius, center_y),
-                    fill="#FF5722",
-                    width=2
-                )
-                # Vertical line
-                draw.line(
-                    (center_x, center_y - line_length, center_x, center_y + line_length),
-                    fill="#FF5722",
-                    width=2
-                )
-                
-                # 3. Add coordinate text near the point
-                font_size = 20
-                # PIL doesn't come with fonts, so we'll draw the text outline
-                coord_text = f"({x:.3f}, {y:.3f})"
-                # Draw text with outline effect
-                for dx, dy in [(-1,-1), (-1,1), (1,-1), (1,1)]:
-                    draw.text(
-                        (center_x + radius + dx, center_y - radius + dy),
-                        coord_text,
-                        fill="#000000"
-                    )
-                draw.text(
-                    (center_x + radius, center_y - radius),
-                    coord_text,
-                    fill="#FFFFFF"
-                )
-                
-            else:  # bbox
-                # Get coordinates
-                x_min, y_min, x_max, y_max = self.coordinates_data['coords']
-                
-                # Convert to pixel coordinates
-                x_min_px = int(x_min * width)
-                y_min_px = int(y_min * height)
-                x_max_px = int(x_max * width)
-                y_max_px = int(y_max * height)
-                
-                # Calculate dimensions
-                box_width = x_max_px - x_min_px
-                box_height = y_max_px - y_min_px
-                
-                # 1. Draw semi-transparent highlight overlay
-                # Create a transparent overlay for the inside of the box
-                overlay = Image.new('RGBA', (box_width, box_height), (255, 87, 34, 80))  # Semi-transparent orange
-                img.paste(overlay, (x_min_px, y_min_px), overlay)
-                
-                # 2. Draw border with multiple lines for visibility
-                for i in range(3):
-                    draw.rectangle(
-                        [(x_min_px+i, y_min_px+i), (x_max_px-i, y_max_px-i)],
-                        outline="#00E5FF",
-                        width=2
-                    )
-                
-                # 3. Add corner brackets for a targeting effect
-                corner_len = min(30, box_width//4, box_height//4)
-                
-                # Draw corner brackets with bright color
-                for x, y in [(x_min_px, y_min_px), (x_max_px, y_min_px), 
-                             (x_min_px, y_max_px), (x_max_px, y_max_px)]:
-                    # Determine direction for each corner
-                    dx = 1 if x == x_min_px else -1
-                    dy = 1 if y == y_min_px else -1
-                    
-                    # Horizontal line
-                    draw.line(
-                        (x, y, x + (corner_len * dx), y),
-                        fill="#FFEB3B",
-                        width=3
-                    )
-                    # Vertical line
-                    draw.line(
-                        (x, y, x, y + (corner_len * dy)),
-                        fill="#FFEB3B",
-                        width=3
-                    )
-                
-                # 4. Add coordinate text
-                coord_text = f"({x_min:.2f}, {y_min:.2f}, {x_max:.2f}, {y_max:.2f})"
-                text_x = x_min_px + 5
-                text_y = y_min_px - 25 if y_min_px > 25 else y_max_px + 5
-                
-                # Draw text with outline for visibility
-                for dx, dy in [(-1,-1), (-1,1), (1,-1), (1,1)]:
-                    draw.text(
-                        (text_x + dx, text_y + dy),
-                        coord_text,
-                        fill="#000000"
-                    )
-                draw.text(
-                    (text_x, text_y),
-                    coord_text,
-                    fill="#FFFFFF"
-                )
-            
-            # Save highlighted image
-            highlight_path = "temp_highlight_image.png"
-            img.save(highlight_path)
-            
-            # Also make sure to display this highlighted image
-            self.display_image_in_tab(highlight_path, 0, "CAPTURE VIEW")
-            
-            return highlight_path
+            return img
             
         except Exception as e:
             print(f"Error creating highlighted image: {str(e)}")
@@ -1627,15 +1453,15 @@ class WebAutomationApp(QMainWindow):
             traceback.print_exc()
             return None
     
-    def display_image_in_tab(self, image_path, tab_index, tab_name):
-        """Display an image in the specified tab with a clean approach"""
-        if not image_path or not os.path.exists(image_path):
-            print(f"Image not found: {image_path}")
+    def display_image_in_tab(self, image, tab_index, tab_name):
+        """Display an image (ImageBuffer or PIL image) in the specified tab with a clean approach"""
+        if image is None:
+            print(f"No image for tab {tab_index}")
             return
         
         # Create a clean image display
         direct_display = QLabel()
-        direct_pixmap = QPixmap(image_path)
+        direct_pixmap = to_qpixmap(image)
         
         if not direct_pixmap.isNull():
             # Set the pixmap directly
@@ -1677,21 +1503,20 @@ class WebAutomationApp(QMainWindow):
         
         self.update_status("Executing click on detected element...", 30)
         
-        # Create and start worker thread
-        self.action_thread = ActionThread(url, coords, coords_type)
+        # Create and start worker thread; the click runs in the session that
+        # still shows the captured page
+        self.action_thread = ActionThread(url, coords, coords_type, self.browser_pool, self.browser_session_id,
+                                          self.image_stats, trace=self.trace)
+        self.browser_session_id = None
         self.action_thread.progress_update.connect(self.update_status)
         self.action_thread.result_ready.connect(self.handle_action_result)
         self.action_thread.error.connect(self.handle_error)
         self.action_thread.start()
     
-    def handle_action_result(self, screenshot_path, summary):
+    def handle_action_result(self, screenshot, summary):
         """Handle the results after clicking the element"""
-        if not os.path.exists(screenshot_path):
-            self.update_status("Screenshot not found after action", 0)
-            return
-        
         # Display the new screenshot in the Results tab
-        self.display_image_in_tab(screenshot_path, 2, "RESULTS")
+        self.display_image_in_tab(screenshot, 2, "RESULTS")
         
         # Switch to the Results tab
         self.right_panel.setCurrentIndex(2)
@@ -1756,13 +1581,13 @@ class WebAutomationApp(QMainWindow):
         
         # Re-enable buttons
         self.capture_btn.setEnabled(True)
-        self.analyze_btn.setEnabled(bool(self.screenshot_path))
+        self.analyze_btn.setEnabled(bool(self.screenshot))
         self.execute_btn.setEnabled(bool(getattr(self, 'coordinates_data', None)))
 
     def handle_element_click(self, point):
         """Handle user clicking on image directly"""
         # This enables clicking directly on the image to select elements
-        if self.screenshot_path:
+        if self.screenshot:
             self.coordinates_data = {'type': 'point', 'coords': (point.x(), point.y())}
             self.draw_element_highlight(point.x(), point.y())
             self.execute_btn.setEnabled(True)
@@ -1770,83 +1595,14 @@ class WebAutomationApp(QMainWindow):
         
     def draw_element_highlight(self, x, y):
         """Draw futuristic highlight on selected element"""
-        if not self.screenshot_path:
+        if not self.screenshot:
             return
         
-        # Create a copy of the screenshot
-        img = Image.open(self.screenshot_path)
-        width, height = img.size
-        draw = ImageDraw.Draw(img)
-        
-        # Calculate pixel coordinates
-        center_x = int(x * width)
-        center_y = int(y * height)
-        radius = max(20, min(width, height) // 20)
-        
-        # Draw targeting reticle/crosshair (more futuristic)
-        # Outer circle
-        draw.ellipse((center_x - radius, center_y - radius, 
-                     center_x + radius, center_y + radius), 
-                     outline="#00E5FF", width=2)
-        
-        # Inner circle
-        inner_radius = radius // 2
-        draw.ellipse((center_x - inner_radius, center_y - inner_radius, 
-                     center_x + inner_radius, center_y + inner_radius), 
-                     outline="#00E5FF", width=1)
-        
-        # Crosshair lines
-        line_length = radius * 1.5
-        # Horizontal
-        draw.line((center_x - line_length, center_y, 
-                   center_x - radius, center_y), 
-                   fill="#00E5FF", width=2)
-        draw.line((center_x + radius, center_y, 
-                   center_x + line_length, center_y), 
-                   fill="#00E5FF", width=2)
-        # Vertical
-        draw.line((center_x, center_y - line_length, 
-                   center_x, center_y - radius), 
-                   fill="#00E5FF", width=2)
-        draw.line((center_x, center_y + radius, 
-                   center_x, center_y + line_length), 
-                   fill="#00E5FF", width=2)
-        
-        # Draw diagonal corners (like a targeting system)
-        corner_size = radius // 2
-        # Top-left
-        draw.line((center_x - radius, center_y - radius, 
-                   center_x - radius + corner_size, center_y - radius), 
-                   fill="#00E5FF", width=2)
-        draw.line((center_x - radius, center_y - radius, 
-                   center_x - radius, center_y - radius + corner_size), 
-                   fill="#00E5FF", width=2)
-        # Top-right
-        draw.line((center_x + radius, center_y - radius, 
-                   center_x + radius - corner_size, center_y - radius), 
-                   fill="#00E5FF", width=2)
-        draw.line((center_x + radius, center_y - radius, 
-                   center_x + radius, center_y - radius + corner_size), 
-                   fill="#00E5FF", width=2)
-        # Bottom-left
-        draw.line((center_x - radius, center_y + radius, 
-                   center_x - radius + corner_size, center_y + radius), 
-                   fill="#00E5FF", width=2)
-        draw.line((center_x - radius, center_y + radius, 
-                   center_x - radius, center_y + radius - corner_size), 
-                   fill="#00E5FF", width=2)
-        # Bottom-right
-        draw.line((center_x + radius, center_y + radius, 
-                   center_x + radius - corner_size, center_y + radius), 
-                   fill="#00E5FF", width=2)
-        draw.line((center_x + radius, center_y + radius, 
-                   center_x + radius, center_y + radius - corner_size), 
-                   fill="#00E5FF", width=2)
-        
-        # Save and display the highlighted image
-        temp_path = "temp_highlight_image.png"
-        img.save(temp_path)
-        self.image_viewer.set_image(temp_path)
+        # Targeting reticle
+        img = draw_detections(self.screenshot.pil(), [(x, y)], style="reticle")
+        
+        # Display the highlighted image straight from memory
+        self.image_viewer.set_image(img)
 
 
 if __name__ == "__main__":
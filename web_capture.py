@@ -0,0 +1,169 @@
+import time
+
+from selenium.webdriver.common.action_chains import ActionChains
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+
+import tracing
+from image_buffer import ImageBuffer
+from page_readiness import wait_until_ready
+
+# Browser steps shared by the GUI threads (WebCaptureThread, ActionThread) and
+# the headless tools (batch_capture.py, pipeline.py): load a URL, wait for it
+# to settle and take a screenshot; click at a model-given coordinate.
+# Screenshots are returned as in-memory ImageBuffers; a path is only written
+# when one is given.
+
+
+def capture_page(driver, url, screenshot_path=None, timeout=30, readiness=None, on_progress=None, stats=None):
+    """Load url in driver and take a screenshot once the page is ready
+
+    timeout bounds the whole capture (page load, body, readiness wait); a
+    slower page raises selenium's TimeoutException. on_progress(message,
+    percent) is called between steps. Returns timing and page info, with the
+    screenshot as an ImageBuffer under "screenshot".
+    """
+    def progress(message, percent):
+        if on_progress is not None:
+            on_progress(message, percent)
+
+    started = time.monotonic()
+    progress(f"Loading page: {url}", 30)
+    driver.set_page_load_timeout(timeout)
+    driver.get(url)
+    loaded = time.monotonic()
+    print(f"Driver reported page loaded with title: {driver.title}")
+
+    remaining = max(1.0, timeout - (loaded - started))
+    WebDriverWait(driver, remaining).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
+
+    progress("Waiting for the page to settle...", 50)
+    config = dict(readiness or {})
+    config["timeout"] = min(config.get("timeout", 10.0), max(0.5, timeout - (time.monotonic() - started)))
+    report = wait_until_ready(driver, url, config)
+    ready = time.monotonic()
+
+    progress(f"Page loaded ({report['ended_by']}), capturing screenshot...", 70)
+    screenshot = ImageBuffer.from_driver(driver, stats, "capture")
+    finished = time.monotonic()
+    tracing.record("page_load", started, loaded, url=url)
+    tracing.record("page_ready", loaded, ready, ended_by=report["ended_by"])
+    tracing.record("screenshot", ready, finished)
+    if screenshot_path:
+        screenshot.save(screenshot_path)
+    return {
+        "screenshot": screenshot,
+        "title": driver.title,
+        "load_seconds": round(loaded - started, 3),
+        "ready_seconds": round(ready - loaded, 3),
+        "screenshot_seconds": round(finished - ready, 3),
+        "seconds": round(finished - started, 3),
+        "readiness": report,
+    }
+
+
+# Outlines the element under the click point and returns a short description of it
+HIGHLIGHT_SCRIPT = """
+var clickPoint = document.elementFromPoint(arguments[0], arguments[1]);
+if (clickPoint) {
+    clickPoint.style.outline = '3px solid #FF5722';
+    clickPoint.style.boxShadow = '0 0 10px #FF5722';
+    return {
+        tagName: clickPoint.tagName,
+        id: clickPoint.id,
+        className: clickPoint.className,
+        text: clickPoint.textContent.substring(0, 50)
+    };
+}
+return null;
+"""
+
+
+def click_position(driver, coords, coords_type):
+    """(x_rel, y_rel, x_px, y_px) of the click for a 'point' or 'bbox' (its centre) answer"""
+    viewport_width = driver.execute_script("return window.innerWidth")
+    viewport_height = driver.execute_script("return window.innerHeight")
+    if coords_type == 'point':
+        x_rel, y_rel = coords
+    else:
+        x_min, y_min, x_max, y_max = coords
+        x_rel = (x_min + x_max) / 2
+        y_rel = (y_min + y_max) / 2
+    return x_rel, y_rel, int(x_rel * viewport_width), int(y_rel * viewport_height)
+
+
+def describe_element(element_info):
+    text = f"Element: {element_info.get('tagName', 'Unknown')} "
+    if element_info.get('id'):
+        text += f"ID: {element_info['id']} "
+    if element_info.get('className'):
+        text += f"Class: {element_info['className']} "
+    if element_info.get('text'):
+        text += f"Text: {element_info['text']}"
+    return text
+
+
+def click_at(driver, coords, coords_type, result_path=None, highlight=False, readiness=None, on_progress=None,
+             stats=None):
+    """Highlight and click the element at normalised coords on the current page
+
+    Waits for whatever the click started (navigation, requests, animations)
+    to settle and takes a screenshot ("screenshot", also saved to result_path
+    if given; with highlight=True, "highlight" shows the outlined target).
+    Returns the click position, the clicked element and the resulting page
+    title and text.
+    """
+    def progress(message, percent):
+        if on_progress is not None:
+            on_progress(message, percent)
+
+    started = time.monotonic()
+    x_rel, y_rel, x_px, y_px = click_position(driver, coords, coords_type)
+    if coords_type != 'point':
+        print(f"Bounding box: {tuple(coords)}")
+        print(f"Clicking on center point: ({x_rel}, {y_rel}) -> {x_px}px, {y_px}px")
+
+    element_info = driver.execute_script(HIGHLIGHT_SCRIPT, x_px, y_px)
+    if element_info:
+        progress(f"Target: {describe_element(element_info)}", 55)
+    highlight_screenshot = ImageBuffer.from_driver(driver, stats, "highlight") if highlight else None
+
+    progress(f"Clicking at coordinates ({x_rel:.3f}, {y_rel:.3f})...", 60)
+    actions = ActionChains(driver)
+    # First move to the body so the offset is relative to a known point
+    actions.move_to_element(driver.find_element(By.TAG_NAME, "body"))
+    actions.move_by_offset(x_px, y_px)
+    actions.click()
+    actions.perform()
+    clicked = time.monotonic()
+
+    progress("Click performed! Observing changes...", 70)
+    report = wait_until_ready(driver, driver.current_url, readiness)
+    settled = time.monotonic()
+    screenshot = ImageBuffer.from_driver(driver, stats, "result")
+    tracing.record("click", started, clicked)
+    tracing.record("page_settle", clicked, settled, ended_by=report["ended_by"])
+    tracing.record("screenshot", settled, time.monotonic())
+    if result_path:
+        screenshot.save(result_path)
+
+    try:
+        content = driver.find_element(By.TAG_NAME, "body").text[:500]
+    except Exception:
+        content = "Content could not be extracted"
+    return {
+        "screenshot": screenshot,
+        "highlight": highlight_screenshot,
+        "x_rel": x_rel,
+        "y_rel": y_rel,
+        "x_px": x_px,
+        "y_px": y_px,
+        "element": element_info,
+        "title": driver.title,
+        "url": driver.current_url,
+        "content": content,
+        "click_seconds": round(clicked - started, 3),
+        "settle_seconds": round(time.monotonic() - clicked, 3),
+        "readiness": report,
+    }